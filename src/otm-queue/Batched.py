@@ -0,0 +1,259 @@
+from typing import Optional
+import numpy as np
+from core import Scenario
+from Branching import Candidate
+from Signal import BulbColor
+from Topology import SlotTopology, sum_slots
+
+# Lockstep simulation of B variants of a scenario, in fixed time steps of dt seconds. The
+# variants share the network, demands and splits, and each has its own timing plans
+# (see Branching.Candidate). The state of all variants is kept in arrays, so that every
+# step is a fixed number of numpy operations whatever the number of variants:
+#   - waiting[n,s,b]: vehicles of variant b in the waiting queue of lane group n, bound for
+#     the link of slot s (see Topology.py)
+#   - transit[r*N+n,s,b]: the same, in transit, for the vehicles that reach the waiting
+#     queue at a step equal to r modulo R
+#   - stage[c,b]: stage of controller c, as ControllerStage.get_stage_for_time
+# The variant axis is last, so that gathers and scatters by lane group move whole rows.
+#
+# Each step applies, in this order: the stages and bulb colors, the arrivals from transit,
+# the services, the demands. The model is that of the event engine, with vehicles counted
+# instead of queued:
+#   - services are Poisson at the saturation flow rate, gated by the bulb color, and are
+#     shared among the next links in proportion to the waiting vehicles. A full next link
+#     only holds back the vehicles bound to it, not the whole lane group.
+#   - a link accepts in a step at most the supply it had at the start of the step. When
+#     requests exceed it, each is scaled down in proportion.
+#   - vehicles entering a link are shared among its lane groups in proportion to their
+#     supply, and those entering from a demand join the first lane group for their next link.
+#   - transit times are rounded up to whole steps.
+
+class BatchedScenario:
+
+    scenario: Scenario
+    topology: SlotTopology
+    num_variants: int
+    dt: float
+    rng: np.random.Generator
+    time: float
+    step: int
+    transit_steps: np.ndarray
+
+    # signals
+    signalized: np.ndarray              # lane groups of the signals of the controllers
+    signal_ctrl: np.ndarray             # controller position of each
+    stage_green: np.ndarray             # (controllers, most stages, lane groups) green in the stage
+    num_stages: np.ndarray
+    cycle: np.ndarray                   # (controllers, B)
+    offset: np.ndarray
+    stage_end: np.ndarray               # (controllers, most stages, B) end of each stage in the cycle
+    stage: np.ndarray                   # (controllers, B)
+
+    # state
+    waiting: np.ndarray                 # (lane groups, slots, B)
+    transit: np.ndarray                 # (R * lane groups, slots, B)
+    vehicles: np.ndarray                # (lane groups, B) in transit and waiting
+    exits: np.ndarray                   # (lane groups, B) released since the start
+    vehicle_seconds: np.ndarray         # (B,)
+
+    def __init__(self, scenario:Scenario, candidates:list[Candidate], dt:float=1.0,
+                 random_seed:Optional[int]=None) -> None:
+
+        self.scenario = scenario
+        self.num_variants = len(candidates)
+        self.dt = dt
+        self.rng = np.random.default_rng(random_seed)
+        self.time = scenario.dispatcher.current_time
+        self.step = 0
+
+        network = scenario.network
+        N = network.num_lgs
+        B = self.num_variants
+        self.topology = SlotTopology(network)
+        self.topology.set_inputs(scenario.demands.values())
+        K = self.topology.num_slots
+        self.transit_steps = np.maximum(1,np.ceil(self.topology.transit_time_sec/dt - 1e-9)).astype(np.int64)
+
+        # signals. The last phase of a lane group decides its color, as in ActuatorSignal
+        controllers = list(scenario.controllers.values())
+        C = len(controllers)
+        S = max([1]+[len(cnt.stages) for cnt in controllers])
+        lg_ctrl = np.full(N,-1,dtype=np.int64)
+        self.stage_green = np.zeros((C,S,N),dtype=bool)
+        self.num_stages = np.array([len(cnt.stages) for cnt in controllers],dtype=np.int64)
+        for c, cnt in enumerate(controllers):
+            for k in range(len(cnt.stages)):
+                command = cnt.get_command_for_stage_index(k).value
+                for phase_id, phase in cnt.signal.signal_phases.items():
+                    green = command.get(phase_id,BulbColor.RED)==BulbColor.GREEN
+                    for lg in phase.lanegroups:
+                        lg_ctrl[lg.index] = c
+                        self.stage_green[c,k,lg.index] = green
+        self.signalized = np.nonzero(lg_ctrl>=0)[0]
+        self.signal_ctrl = lg_ctrl[self.signalized]
+
+        # timing plans of the variants
+        self.cycle = np.empty((C,B))
+        self.offset = np.empty((C,B))
+        self.stage_end = np.zeros((C,S,B))
+        position = {cnt.id:c for c, cnt in enumerate(controllers)}
+        for c, cnt in enumerate(controllers):
+            self.cycle[c] = cnt.cycle
+            self.offset[c] = cnt.offset
+            for b in range(B):
+                self.set_stage_end(c,b,[stage.duration for stage in cnt.stages])
+        for b, candidate in enumerate(candidates):
+            for cntid, timing in candidate.items():
+                c = position[cntid]
+                if timing.get('durations') is not None:
+                    if len(timing['durations'])!=self.num_stages[c]:
+                        raise(Exception(f"Error: Controller {cntid} has {self.num_stages[c]} stages"))
+                    self.set_stage_end(c,b,timing['durations'])
+                if timing.get('cycle') is not None:
+                    self.cycle[c,b] = timing['cycle']
+                if timing.get('offset') is not None:
+                    self.offset[c,b] = timing['offset']
+        self.stage = np.zeros((C,B),dtype=np.int64)
+
+        # state, from the current queues of the scenario
+        R = int(self.transit_steps.max()) + 1
+        self.waiting = np.zeros((N,K,B),dtype=np.int64)
+        self.transit = np.zeros((R*N,K,B),dtype=np.int64)
+        now = self.time
+        for lg in network.lanegroups:
+            for k, count in lg.waiting_queue.counts.items():
+                self.waiting[lg.index,self.topology.get_slot(lg,k)] += count
+            times, next_links = lg.transit_queue.get_contents()
+            for t, k in zip(times.tolist(),next_links.tolist()):
+                steps = max(0,int(np.ceil((t + lg.transit_time_sec - now)/dt - 1e-9)))
+                if steps==0:
+                    self.waiting[lg.index,self.topology.get_slot(lg,k)] += 1
+                else:
+                    self.transit[(steps%R)*N+lg.index,self.topology.get_slot(lg,k)] += 1
+        self.vehicles = sum_slots(self.waiting) + sum_slots(self.transit).reshape(R,N,B).sum(axis=0)
+        self.exits = np.zeros((N,B),dtype=np.int64)
+        self.vehicle_seconds = np.zeros(B)
+
+    def set_stage_end(self, c:int, b:int, durations:list[float]) -> None:
+        n = len(durations)
+        self.stage_end[c,:n,b] = np.cumsum(durations)
+        self.stage_end[c,n:,b] = np.sum(durations)
+
+    # stage of every controller of every variant, as ControllerStage.get_stage_for_time
+    def get_stages(self, time:float) -> np.ndarray:
+        reltime = (time - self.offset) % self.cycle
+        stage = (self.stage_end <= reltime[:,None,:]).sum(axis=1)
+        stage[stage>=self.num_stages[:,None]] = 0
+        return stage
+
+    # vehicles (lane groups, B) entering each lane group -> (lane groups, slots, B) by next link
+    def route(self, x:np.ndarray) -> np.ndarray:
+        topology = self.topology
+        y = np.zeros((x.shape[0],topology.num_slots,x.shape[1]),dtype=np.int64)
+        n, b = np.nonzero(x)
+        y[n,:,b] = self.rng.multinomial(x[n,b],topology.split[topology.lg_link[n]])
+        return y
+
+    # share the vehicles entering each link (links, B) among its lane groups, in proportion
+    # to their supply and never beyond it
+    def enter_links(self, entering:np.ndarray, link_lg_supply:np.ndarray) -> np.ndarray:
+        lgs = self.topology.link_lgs
+        x = np.zeros((self.topology.lg_link.shape[0],self.num_variants),dtype=np.int64)
+        remaining = entering.astype(float)
+        total = link_lg_supply.sum(axis=1)
+        for g in range(lgs.shape[1]):
+            s = link_lg_supply[:,g]
+            share = np.where(total>0, np.ceil(remaining * s / np.where(total>0,total,1.0) - 1e-9), 0.0)
+            share = np.minimum(share,s)
+            valid = lgs[:,g]>=0
+            x[lgs[valid,g]] = share[valid].astype(np.int64)
+            remaining -= share
+            total -= s
+        return x
+
+    def advance_step(self) -> None:
+        topology = self.topology
+        B = self.num_variants
+        dt = self.dt
+        N = topology.lg_link.shape[0]
+        K = topology.num_slots
+        R = self.transit.shape[0] // N
+
+        # signals
+        self.stage = self.get_stages(self.time)
+        rate = np.repeat(topology.nom_rate_vps[:,None],B,axis=1)
+        green = self.stage_green[self.signal_ctrl[:,None],self.stage[self.signal_ctrl],self.signalized[:,None]]
+        rate[self.signalized] *= green
+        topology.update_splits(self.time)
+
+        # arrivals to the waiting queues
+        r = self.step % R
+        self.waiting += self.transit[r*N:(r+1)*N]
+        self.transit[r*N:(r+1)*N] = 0
+
+        # services, shared among the next links in proportion to the waiting vehicles.
+        # Random draws are only made for the lane groups with vehicles to serve.
+        total = sum_slots(self.waiting)
+        n, b = np.nonzero((total>0) & (rate>0))
+        total = total[n,b]
+        served = np.minimum(total, self.rng.poisson(rate[n,b]*dt))
+        waiting = self.waiting[n,:,b]
+        x = np.zeros_like(self.waiting)
+        for s in range(K-1):
+            good = waiting[:,s]
+            x[n,s,b] = self.rng.hypergeometric(good, total-good, served)
+            total = total - good
+            served = served - x[n,s,b]
+        x[n,K-1,b] = served
+
+        # next links accept at most their supply, in whole vehicles
+        supply = np.floor(np.maximum(topology.max_vehicles[:,None] - self.vehicles,0.0))
+        link_lg_supply = topology.get_link_lg_values(supply)
+        link_supply = link_lg_supply.sum(axis=1)
+        x = x.reshape(N*K,B)
+        bound = topology.slot_order
+        requests = topology.sum_by_next_link(x)
+        ratio = np.where(requests>link_supply, link_supply/np.maximum(requests,1), 1.0)
+        x[bound] = np.floor(x[bound]*ratio[topology.slot_link[bound]] + 1e-9).astype(np.int64)
+        entering = topology.sum_by_next_link(x)
+        x = x.reshape(N,K,B)
+        self.waiting -= x
+        released = sum_slots(x)
+        self.vehicles -= released
+        self.exits += released
+
+        # released vehicles enter their next links, and demands join the first lane group
+        # for their next link
+        y = self.route(self.enter_links(entering,link_lg_supply))
+        for demand, slot_lgs in topology.demands:
+            vps = topology.get_demand_vps(demand,self.time)
+            if vps<=0:
+                continue
+            arrivals = self.rng.multinomial(self.rng.poisson(vps*dt,B),topology.split[demand.link.index])
+            for s in range(K):
+                y[slot_lgs[s],s] += arrivals[:,s]
+        self.transit[((self.step + self.transit_steps) % R)*N + np.arange(N)] += y
+        self.vehicles += sum_slots(y)
+
+        self.vehicle_seconds += self.vehicles.sum(axis=0) * dt
+        self.step += 1
+        self.time += dt
+
+    def advance(self, duration:float) -> None:
+        for _ in range(int(round(duration/self.dt))):
+            self.advance_step()
+
+    # metrics of every variant, as Branching.get_branch_metrics
+    def get_metrics(self) -> list[dict]:
+        exits = self.exits[self.topology.sink_lgs].sum(axis=0)
+        vehicles = self.vehicles.sum(axis=0)
+        return [{'exits':int(exits[b]), 'vehicle_hours':float(self.vehicle_seconds[b])/3600.0, 'vehicles':int(vehicles[b])}
+                for b in range(self.num_variants)]
+
+# Simulate each candidate for duration seconds from the current state of the scenario, in
+# lockstep, and return the metrics of each. A fast, approximate alternative to Branching.branch.
+def batch_branch(scenario:Scenario, candidates:list[Candidate], duration:float, dt:float=1.0,
+                 random_seed:Optional[int]=None) -> list[dict]:
+    batch = BatchedScenario(scenario,candidates,dt,random_seed)
+    batch.advance(duration)
+    return batch.get_metrics()
@@ -0,0 +1,186 @@
+from typing import Any, Callable, Optional
+from concurrent.futures import ProcessPoolExecutor
+import gc
+import os
+import pickle
+import numpy as np
+from core import Scenario
+from abstract import AbstractOutputTimed, EventPeriodicPoke
+from Sinks import ColumnarSink
+from LaneGroup import LaneGroupCounters
+
+# What-if branching of a live scenario. Each candidate is a set of timing plans,
+# controller id -> keyword arguments of ControllerStage.set_timing, e.g.
+# {1:{'cycle':90,'durations':[40,50]}}. Every candidate is simulated for the same
+# duration from the current state of the scenario, in a child process, and the child
+# returns summary metrics. The scenario itself is left untouched.
+#
+# With os.fork the children share the memory of the parent, copy-on-write, so nothing
+# is copied or rebuilt. Otherwise the scenario is saved to a checkpoint, and workers of a
+# process pool rebuild it from its construction arguments and restore the checkpoint.
+# All candidates continue the same random streams (common random numbers).
+
+Candidate = dict[int,dict[str,Any]]
+Metrics = Callable[['Scenario','BranchRecorder'],dict]
+
+class BranchRecorder:
+
+    # Samples the network every dt while a branch runs
+
+    dt: float
+    start_time: float
+    start_exits: int                # vehicles that had left the network when the branch started
+    vehicle_seconds: float          # [veh.sec] vehicles in the network, integrated over time
+    sink_lgs: np.ndarray            # dense indices of the lane groups of sink links
+    counters: 'LaneGroupCounters'
+
+    def __init__(self, scenario:'Scenario', dt:float) -> None:
+        self.dt = dt
+        self.start_time = scenario.dispatcher.current_time
+        self.sink_lgs = np.array([lg.index for lg in scenario.network.lanegroups if lg.link.is_sink],dtype=np.int64)
+        self.start_exits = int(scenario.network.counters.exits[self.sink_lgs].sum())
+        self.vehicle_seconds = 0.0
+        self.counters = scenario.network.counters
+
+    def poke(self, dispatcher, timestamp:float) -> None:
+        self.vehicle_seconds += float(self.counters.vehicles.sum()) * self.dt
+
+# Default metrics: vehicles that left the network, vehicle hours in the network, and
+# vehicles in the network at the end
+def get_branch_metrics(scenario:'Scenario', recorder:BranchRecorder) -> dict:
+    counters = scenario.network.counters
+    return {
+        'exits' : int(counters.exits[recorder.sink_lgs].sum()) - recorder.start_exits,
+        'vehicle_hours' : recorder.vehicle_seconds / 3600.0,
+        'vehicles' : int(counters.vehicles.sum())
+    }
+
+# Send all outputs to memory, so that a branch does not write to the files, or memory
+# maps, of the parent. Returns the sinks and files that were replaced, which must be
+# kept alive until the process exits: releasing them would flush the buffers copied
+# from the parent.
+def detach_outputs(scenario:'Scenario') -> list:
+    detached = list()
+    for output in scenario.outputs:
+        if isinstance(output,AbstractOutputTimed):
+            detached.append(output.sink)
+            output.sink = ColumnarSink()
+            output.sink.open(output.get_columns())
+        else:
+            detached.append(output.file)
+            output.file = None
+            output.rows = list()
+    return detached
+
+def run_branch(scenario:'Scenario', candidate:Candidate, duration:float, sample_dt:float, metrics:Metrics) -> dict:
+    dispatcher = scenario.dispatcher
+    for cntid, timing in candidate.items():
+        controller = scenario.controllers[cntid]
+        controller.set_timing(**timing)
+        if controller.is_started(dispatcher):
+            controller.poke(dispatcher,dispatcher.current_time)
+    recorder = BranchRecorder(scenario,sample_dt)
+    dispatcher.register_event(EventPeriodicPoke(dispatcher,70,dispatcher.current_time,recorder,sample_dt))
+    scenario.advance(duration)
+    return metrics(scenario,recorder)
+
+def branch_fork(scenario:'Scenario', candidates:list[Candidate], duration:float, sample_dt:float,
+                metrics:Metrics, max_workers:int) -> list[dict]:
+
+    # keep the garbage collector from touching, and so copying, the pages of the parent
+    gc.freeze()
+    results = [None] * len(candidates)
+    try:
+        for first in range(0,len(candidates),max_workers):
+            children = list()
+            for i in range(first,min(first+max_workers,len(candidates))):
+                r, w = os.pipe()
+                pid = os.fork()
+                if pid==0:
+                    try:
+                        os.close(r)
+                        detached = detach_outputs(scenario)
+                        try:
+                            result = (True, run_branch(scenario,candidates[i],duration,sample_dt,metrics))
+                        except Exception as e:
+                            result = (False, repr(e))
+                        with os.fdopen(w,'wb') as f:
+                            pickle.dump(result,f,protocol=pickle.HIGHEST_PROTOCOL)
+                    finally:
+                        os._exit(0)
+                os.close(w)
+                children.append((i,pid,r))
+
+            for i, pid, r in children:
+                with os.fdopen(r,'rb') as f:
+                    data = f.read()
+                os.waitpid(pid,0)
+                if len(data)==0:
+                    raise(Exception(f"Error: Branch {i} exited without a result"))
+                ok, result = pickle.loads(data)
+                if not ok:
+                    raise(Exception(f"Error: Branch {i} failed with {result}"))
+                results[i] = result
+    finally:
+        gc.unfreeze()
+    return results
+
+# Scenario built by the initializer of each worker process, when fork is not used
+worker_scenario: Optional[Scenario] = None
+
+def init_worker(network:Any, control:Any, output_requests:Optional[list[dict[str,str]]],
+                scheduler:Optional[str], cache_folder:Optional[str],
+                hybrid_threshold:Optional[int], hybrid_dt:float) -> None:
+    global worker_scenario
+    worker_scenario = Scenario(network, control,
+                               output_requests=output_requests,
+                               scheduler=scheduler,
+                               cache_folder=cache_folder,
+                               hybrid_threshold=hybrid_threshold,
+                               hybrid_dt=hybrid_dt)
+
+def run_branch_from_checkpoint(blob:bytes, candidate:Candidate, duration:float, sample_dt:float, metrics:Metrics) -> dict:
+    scenario = worker_scenario
+    scenario.restore_checkpoint(blob)
+    return run_branch(scenario,candidate,duration,sample_dt,metrics)
+
+# Output requests of the workers, in memory as in detach_outputs, since they have no output folder
+def get_memory_requests(output_requests:Optional[list[dict[str,str]]]) -> Optional[list[dict[str,str]]]:
+    if output_requests is None:
+        return None
+    return [{key:value for key, value in request.items() if key not in ('sink','dtype')} for request in output_requests]
+
+def branch_pool(scenario:'Scenario', candidates:list[Candidate], duration:float, sample_dt:float,
+                metrics:Metrics, max_workers:int) -> list[dict]:
+    blob = scenario.get_checkpoint()
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             initializer=init_worker,
+                             initargs=(scenario.network_file, scenario.control_file, get_memory_requests(scenario.output_requests),
+                                       scenario.scheduler_name, scenario.cache_folder,
+                                       scenario.hybrid_threshold, scenario.hybrid_dt)) as executor:
+        futures = [executor.submit(run_branch_from_checkpoint,blob,candidate,duration,sample_dt,metrics)
+                   for candidate in candidates]
+        return [future.result() for future in futures]
+
+# Simulate each candidate for duration seconds from the current state of the scenario, and
+# return the metrics of each, in the order of the candidates. metrics(scenario, recorder) is
+# evaluated at the end of each branch, and must be picklable (a module level function)
+# when fork is not used. use_fork defaults to whether os.fork is available.
+def branch(scenario:'Scenario',
+           candidates:list[Candidate],
+           duration:float,
+           sample_dt:float=10.0,
+           metrics:Optional[Metrics]=None,
+           max_workers:Optional[int]=None,
+           use_fork:Optional[bool]=None) -> list[dict]:
+
+    if metrics is None:
+        metrics = get_branch_metrics
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    if use_fork is None:
+        use_fork = hasattr(os,'fork')
+
+    if use_fork:
+        return branch_fork(scenario,candidates,duration,sample_dt,metrics,max_workers)
+    return branch_pool(scenario,candidates,duration,sample_dt,metrics,max_workers)
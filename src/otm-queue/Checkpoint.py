@@ -0,0 +1,308 @@
+from typing import TYPE_CHECKING, Any
+import pickle
+import zlib
+import numpy as np
+import static
+from abstract import AbstractEvent, EventPoke, EventPeriodicPoke
+from Events import Dispatcher, EventDemandChange, EventSplitChange, EventCreateVehicle, \
+    EventTransitToWaiting, EventSeviceLanegroupWaitingQueue
+from Scheduler import get_scheduler
+from Demand import Demand
+from Splits import SplitMatrixProfile
+from Vehicle import Vehicle
+
+if TYPE_CHECKING:
+    from core import Scenario
+
+# A checkpoint is the dynamic state of a scenario as plain data (numbers, strings, NumPy
+# arrays, and the actuator commands), pickled and compressed. It is restored into a
+# scenario built from the same network, control and output requests. Events are
+# stored with their insertion sequence numbers, so that a restored run dispatches them
+# in the same order as the original run. Cancelled events are dropped.
+# Blobs are unpickled, so only restore checkpoints from trusted sources.
+
+CHECKPOINT_VERSION = 2
+
+# Events refer to their recipient by (kind, id): ('lg', dense index), ('demand', link id),
+# ('split', link id), ('ctrl', id), ('act', id) or ('out', position in the outputs)
+def get_recipient_refs(scenario:'Scenario') -> dict[int,tuple[str,int]]:
+    refs = dict()
+    for lg in scenario.network.lanegroups:
+        refs[id(lg)] = ('lg',lg.index)
+    for linkid, demand in scenario.demands.items():
+        refs[id(demand)] = ('demand',linkid)
+    for link in scenario.network.linklist:
+        if link.split_profile is not None:
+            refs[id(link.split_profile)] = ('split',link.id)
+    for cntid, controller in scenario.controllers.items():
+        refs[id(controller)] = ('ctrl',cntid)
+    for actid, actuator in scenario.actuators.items():
+        refs[id(actuator)] = ('act',actid)
+    for i, output in enumerate(scenario.outputs):
+        refs[id(output)] = ('out',i)
+    return refs
+
+def get_recipient(scenario:'Scenario', ref:tuple[str,int]) -> Any:
+    kind, i = ref
+    if kind=='lg':
+        return scenario.network.lanegroups[i]
+    elif kind=='demand':
+        return scenario.demands[i]
+    elif kind=='split':
+        return scenario.network.links[i].split_profile
+    elif kind=='ctrl':
+        return scenario.controllers[i]
+    elif kind=='act':
+        return scenario.actuators[i]
+    elif kind=='out':
+        return scenario.outputs[i]
+    else:
+        raise(Exception(f"Error: Unknown event recipient {kind}"))
+
+# (class name, timestamp, dispatch order, sequence number, recipient, class specific value)
+def get_event_record(entry, refs:dict[int,tuple[str,int]]) -> tuple:
+    timestamp, dispatch_order, seq, event = entry
+    if isinstance(event,EventDemandChange):
+        value = event.demand_vps
+    elif isinstance(event,EventSplitChange):
+        value = event.outlink2value
+    elif isinstance(event,EventPeriodicPoke):
+        value = event.period
+    else:
+        value = None
+    return type(event).__name__, timestamp, dispatch_order, seq, refs[id(event.recipient)], value
+
+# Recreate an event and set the handle that its recipient keeps, if any
+def make_event(dispatcher:Dispatcher, record:tuple, recipient) -> AbstractEvent:
+    name, timestamp, dispatch_order, seq, ref, value = record
+    if name=='EventDemandChange':
+        event = EventDemandChange(dispatcher,timestamp,recipient,value)
+    elif name=='EventSplitChange':
+        event = EventSplitChange(dispatcher,timestamp,recipient,value)
+    elif name=='EventCreateVehicle':
+        event = EventCreateVehicle(dispatcher,timestamp,recipient)
+        recipient.create_event = event
+    elif name=='EventTransitToWaiting':
+        event = EventTransitToWaiting(dispatcher,timestamp,recipient)
+        recipient.transit_event = event
+    elif name=='EventSeviceLanegroupWaitingQueue':
+        event = EventSeviceLanegroupWaitingQueue(dispatcher,timestamp,recipient)
+        recipient.service_event = event
+    elif name=='EventPoke':
+        event = EventPoke(dispatcher,dispatch_order,timestamp,recipient)
+        recipient.stage_event = event
+    elif name=='EventPeriodicPoke':
+        event = EventPeriodicPoke(dispatcher,dispatch_order,timestamp,recipient,value)
+        if ref[0]!='out':
+            recipient.poke_event = event
+    else:
+        raise(Exception(f"Error: Unknown event {name}"))
+    return event
+
+# The arrival times of the current batch are drawn again from the stream state they
+# were drawn from
+def get_demand_state(demand:Demand) -> dict:
+    return {
+        'link' : demand.link.id,
+        'profile' : demand.profile,
+        'dt' : demand.dt,
+        'current_demand_vps' : demand.current_demand_vps,
+        'arrival_index' : demand.arrival_index,
+        'interval_end' : demand.interval_end,
+        'batch_start' : demand.batch_start,
+        'batch_end' : demand.batch_end,
+        'in_batch' : demand.arrival_index<len(demand.arrival_times),
+        'batch_rng_state' : demand.batch_rng_state,
+        'rng' : demand.rng.get_state()
+    }
+
+def make_demand(x:dict, scenario:'Scenario') -> Demand:
+    demjson = {'link':x['link'], 'value':x['profile'].tolist()}
+    if x['dt'] is not None:
+        demjson['dt'] = x['dt']
+    demand = Demand(demjson,scenario)
+    demand.current_demand_vps = x['current_demand_vps']
+    demand.interval_end = x['interval_end']
+    if x['in_batch']:
+        demand.batch_end = x['batch_start']
+        demand.rng.set_state(x['batch_rng_state'])
+        demand.draw_arrival_batch()
+        demand.arrival_index = x['arrival_index']
+    demand.batch_end = x['batch_end']
+    demand.rng.set_state(x['rng'])
+    return demand
+
+def get_split_state(smp:SplitMatrixProfile) -> dict:
+    return {
+        'link_in' : smp.linkin.id,
+        'dt' : smp.dt,
+        'values' : smp.profile.values,
+        'current' : getattr(smp,'outlink2split',None),
+        'rng' : smp.rng.get_state()
+    }
+
+def make_split(x:dict, scenario:'Scenario') -> SplitMatrixProfile:
+    splitjson = {'link_in':x['link_in'],
+                 'link_out_value':{str(linkid):v.tolist() for linkid, v in x['values'].items()}}
+    if x['dt'] is not None:
+        splitjson['dt'] = x['dt']
+    smp = SplitMatrixProfile(splitjson,scenario)
+    if x['current'] is not None:
+        smp.set_all_current_splits(x['current'])
+    smp.rng.set_state(x['rng'])
+    return smp
+
+# Queues of all lane groups in CSR form: the contents of lane group j are
+# times[ptr[j]:ptr[j+1]] and next_links[ptr[j]:ptr[j+1]]
+def get_queues_state(queues:list) -> dict[str,np.ndarray]:
+    contents = [queue.get_contents() for queue in queues]
+    return {
+        'ptr' : np.cumsum([0]+[queue.size for queue in queues]),
+        'times' : np.concatenate([np.empty(0)]+[c[0] for c in contents]),
+        'next_links' : np.concatenate([np.empty(0,dtype=np.int32)]+[c[1] for c in contents])
+    }
+
+def set_queues_state(queues:list, x:dict[str,np.ndarray]) -> None:
+    ptr = x['ptr']
+    for j, queue in enumerate(queues):
+        queue.set_contents(x['times'][ptr[j]:ptr[j+1]],x['next_links'][ptr[j]:ptr[j+1]])
+
+# states of the streams that have been used, by position in the list
+def get_stream_states(streams:list) -> dict[int,tuple]:
+    states = dict()
+    for i, stream in enumerate(streams):
+        state = stream.get_state()
+        if state is not None:
+            states[i] = state
+    return states
+
+def get_state(scenario:'Scenario') -> dict:
+
+    network = scenario.network
+    lgs = network.lanegroups
+    refs = get_recipient_refs(scenario)
+    dispatcher = scenario.dispatcher
+
+    # pending events
+    events = [get_event_record(e,refs) for e in dispatcher.scheduler if not e[3].cancelled]
+
+    # ids of the Vehicle objects in the lane groups that materialize them
+    vehicle_ids = dict()
+    for lg in lgs:
+        if len(lg.transit_queue.vehicles)>0 or len(lg.waiting_queue.vehicles)>0:
+            vehicle_ids[lg.index] = ([v.id for v in lg.transit_queue.vehicles],
+                                     [v.id for v in lg.waiting_queue.vehicles])
+
+    return {
+        'version' : CHECKPOINT_VERSION,
+        'links' : np.array([link.id for link in network.linklist]),
+        'outputs' : [output.get_name() for output in scenario.outputs],
+        'current_time' : dispatcher.current_time,
+        'seq' : dispatcher.seq,
+        'events' : events,
+        'entropy' : scenario.random_streams.entropy,
+        'vehicle_id_count' : static.vehicle_id_count,
+        'counters_vehicles' : network.counters.vehicles.copy(),
+        'counters_exits' : network.counters.exits.copy(),
+        'saturation_flow_rate_vps' : np.array([lg.saturation_flow_rate_vps for lg in lgs]),
+        'aggregate_threshold' : np.array([lg.aggregate_threshold for lg in lgs]),
+        'aggregate_dt' : np.array([lg.aggregate_dt for lg in lgs]),
+        'blocked_upstream' : {lg.index:[x.index for x in lg.blocked_upstream] for lg in lgs if len(lg.blocked_upstream)>0},
+        'transit' : get_queues_state([lg.transit_queue for lg in lgs]),
+        'waiting' : get_queues_state([lg.waiting_queue for lg in lgs]),
+        'vehicle_ids' : vehicle_ids,
+        'link_rngs' : get_stream_states([link.rng for link in network.linklist]),
+        'lg_rngs' : get_stream_states([lg.rng for lg in lgs]),
+        'demands' : [get_demand_state(demand) for demand in scenario.demands.values()],
+        'splits' : [get_split_state(link.split_profile) for link in network.linklist if link.split_profile is not None],
+        'controllers' : {cntid:(getattr(controller,'curr_stage_index',None),dict(controller.command),
+                                {'cycle':controller.cycle, 'offset':controller.offset,
+                                 'durations':[stage.duration for stage in controller.stages]})
+                         for cntid, controller in scenario.controllers.items()},
+        'actuators' : {actid:(actuator.command,
+                              {phaseid:getattr(phase,'bulbcolor',None) for phaseid, phase in actuator.signal_phases.items()})
+                       for actid, actuator in scenario.actuators.items()}
+    }
+
+def set_state(scenario:'Scenario', x:dict) -> None:
+
+    network = scenario.network
+    if x['version']!=CHECKPOINT_VERSION:
+        raise(Exception(f"Error: Unsupported checkpoint version {x['version']}"))
+    if not np.array_equal(x['links'],[link.id for link in network.linklist]):
+        raise(Exception("Error: The checkpoint does not match the network"))
+    if x['outputs']!=[output.get_name() for output in scenario.outputs]:
+        raise(Exception("Error: The checkpoint does not match the output requests"))
+
+    # clear the scenario and restart the outputs. The events registered by the
+    # outputs are replaced with those of the checkpoint.
+    scenario.reset(x['entropy'])
+    dispatcher = Dispatcher(get_scheduler(scenario.scheduler_name))
+    scenario.dispatcher = dispatcher
+    dispatcher.current_time = x['current_time']
+    dispatcher.seq = x['seq']
+
+    # lane groups
+    lgs = network.lanegroups
+    set_queues_state([lg.transit_queue for lg in lgs],x['transit'])
+    set_queues_state([lg.waiting_queue for lg in lgs],x['waiting'])
+    for index, (transit_ids, waiting_ids) in x['vehicle_ids'].items():
+        lg = lgs[index]
+        for queue, ids in ((lg.transit_queue,transit_ids),(lg.waiting_queue,waiting_ids)):
+            _, next_links = queue.get_contents()
+            for vehid, next_link in zip(ids,next_links.tolist()):
+                v = Vehicle()
+                v.id = vehid
+                v.next_link = next_link
+                v.move_to_queue(lg,queue)
+                queue.vehicles.append(v)
+    static.vehicle_id_count = x['vehicle_id_count']
+    network.counters.vehicles[:] = x['counters_vehicles']
+    network.counters.exits[:] = x['counters_exits']
+    for lg, rate in zip(lgs,x['saturation_flow_rate_vps'].tolist()):
+        lg.saturation_flow_rate_vps = rate
+        lg.update_long_supply()
+    for lg, threshold, dt in zip(lgs,x['aggregate_threshold'].tolist(),x['aggregate_dt'].tolist()):
+        lg.aggregate_threshold = threshold
+        lg.aggregate_dt = dt
+    for index, upstream in x['blocked_upstream'].items():
+        lgs[index].blocked_upstream = {lgs[i] for i in upstream}
+
+    # random streams
+    for index, state in x['link_rngs'].items():
+        network.linklist[index].rng.set_state(state)
+    for index, state in x['lg_rngs'].items():
+        lgs[index].rng.set_state(state)
+
+    # demands and splits
+    for demandstate in x['demands']:
+        demand = make_demand(demandstate,scenario)
+        scenario.demands[demand.link.id] = demand
+    for splitstate in x['splits']:
+        smp = make_split(splitstate,scenario)
+        smp.linkin.split_profile = smp
+
+    # control
+    for cntid, (stage_index, command, timing) in x['controllers'].items():
+        controller = scenario.controllers[cntid]
+        controller.set_timing(**timing)
+        if stage_index is not None:
+            controller.curr_stage_index = stage_index
+        controller.command = command
+    for actid, (command, bulbcolors) in x['actuators'].items():
+        actuator = scenario.actuators[actid]
+        actuator.command = command
+        for phaseid, color in bulbcolors.items():
+            if color is not None:
+                actuator.signal_phases[phaseid].bulbcolor = color
+
+    # pending events
+    for record in x['events']:
+        event = make_event(dispatcher,record,get_recipient(scenario,record[4]))
+        dispatcher.insert_event(event,record[3])
+
+def to_blob(x:dict) -> bytes:
+    return zlib.compress(pickle.dumps(x,protocol=pickle.HIGHEST_PROTOCOL))
+
+def from_blob(blob:bytes) -> dict:
+    return pickle.loads(zlib.decompress(blob))
@@ -0,0 +1,243 @@
+from typing import TYPE_CHECKING, Optional, Union
+import hashlib
+import json
+import os
+import numpy as np
+from static import parse_list
+
+if TYPE_CHECKING:
+    from core import Network
+
+# Compiled scenarios. The processed topology (road connections with their lanes filled
+# in), the lane group layout, the signal phase maps, the controller stages and the
+# demand and split profiles are stored as flat arrays in an npz file named by a content
+# hash of the json inputs. Loading one gives back the json objects with every value
+# already parsed, and the lane group layout, so the scenario is built without
+# re-deriving the lane groups from the road connections.
+#
+# This saves the parsing, not the construction. The scenario is still made of Python
+# objects: a Link and a LaneGroup per link, two queues and a random stream per lane
+# group, an actuator and a controller per signal. On a 100x100 signalized grid (20k links,
+# 40k road connections) loading takes about 0.65 s against 0.8 s from json, of which
+# decompile_scenario is 0.07 s and creating the objects about 0.45 s. Startup in
+# milliseconds would need lane groups held as arrays instead of objects, which the event
+# engine does not do.
+
+# sha256 of json inputs given as file names (hash of the file contents) or parsed objects
+def get_content_hash(*xs:Union[str,dict,list,None]) -> str:
+    h = hashlib.sha256()
+    for x in xs:
+        if isinstance(x,str):
+            with open(x,'rb') as f:
+                data = f.read()
+        else:
+            data = json.dumps(x,sort_keys=True).encode()
+        h.update(hashlib.sha256(data).digest())
+    return h.hexdigest()
+
+def get_cache_file(cache_folder:str, kind:str, content_hash:str, extension:str='npz') -> str:
+    return os.path.join(cache_folder,f"{kind}_{content_hash}.{extension}")
+
+def save_compiled(filename:str, arrays:dict[str,np.ndarray]) -> None:
+    # write and rename, so that concurrent readers never see a partial file
+    tmpfile = f"{filename}.{os.getpid()}.tmp.npz"
+    np.savez(tmpfile, **arrays)
+    os.replace(tmpfile,filename)
+
+def load_compiled(filename:str) -> dict[str,np.ndarray]:
+    with np.load(filename) as data:
+        return {key:data[key] for key in data.files}
+
+def to_nan(x:Optional[str]) -> float:
+    return np.nan if x is None else float(x)
+
+def from_nan(x:float) -> Optional[float]:
+    return None if np.isnan(x) else float(x)
+
+# concatenate lists into (pointers, values), with the values of list i in values[ptr[i]:ptr[i+1]]
+def to_csr(lists:list[list], dtype=np.int64) -> tuple[np.ndarray,np.ndarray]:
+    ptr = np.cumsum([0]+[len(x) for x in lists]).astype(np.int64)
+    values = np.array([v for x in lists for v in x],dtype=dtype)
+    return ptr, values
+
+def from_csr(ptr:np.ndarray, values:np.ndarray) -> list[list]:
+    values = values.tolist()
+    ptr = ptr.tolist()
+    return [values[ptr[i]:ptr[i+1]] for i in range(len(ptr)-1)]
+
+# network and control ####################################################
+
+def compile_scenario(network:'Network', control:dict) -> dict[str,np.ndarray]:
+    a = dict()
+
+    a['node_id'] = np.array(list(network.nodes.keys()),dtype=np.int64)
+
+    links = network.linklist
+    roadparams = dict()
+    link_roadparam = list()
+    for link in links:
+        rp = (link.roadparam.capacity, link.roadparam.speed, link.roadparam.jam_density)
+        link_roadparam.append(roadparams.setdefault(rp,len(roadparams)))
+    a['roadparam'] = np.array(list(roadparams.keys()),dtype=np.float64).reshape(-1,3)
+    a['link_id'] = np.array([link.id for link in links],dtype=np.int64)
+    a['link_full_lanes'] = np.array([link.full_lanes for link in links],dtype=np.int64)
+    a['link_length'] = np.array([link.length for link in links],dtype=np.float64)
+    a['link_start'] = np.array([link.startnode.id for link in links],dtype=np.int64)
+    a['link_end'] = np.array([link.endnode.id for link in links],dtype=np.int64)
+    a['link_roadparam'] = np.array(link_roadparam,dtype=np.int64)
+
+    rcs = list(network.roadconn.values())
+    a['rc_id'] = np.array([rc.id for rc in rcs],dtype=np.int64)
+    a['rc_in_link'] = np.array([rc.in_link for rc in rcs],dtype=np.int64)
+    a['rc_in_link_lanes'] = np.array([rc.in_link_lanes for rc in rcs],dtype=np.int64).reshape(-1,2)
+    a['rc_out_link'] = np.array([rc.out_link for rc in rcs],dtype=np.int64)
+
+    lgs = network.lanegroups
+    a['lg_link'] = np.array([lg.link.id for lg in lgs],dtype=np.int64)
+    a['lg_start_lane'] = np.array([lg.start_lane for lg in lgs],dtype=np.int64)
+    a['lg_num_lanes'] = np.array([lg.num_lanes for lg in lgs],dtype=np.int64)
+
+    # signals: one row per actuator and per phase
+    acts = list(control['actuators'].items())
+    for strid, jsonact in acts:
+        if jsonact['type']!='signal' or jsonact['target']['type']!='node':
+            raise(Exception(f"Error: Cannot compile actuator {strid}"))
+    a['act_id'] = np.array([int(strid) for strid, _ in acts],dtype=np.int64)
+    a['act_node'] = np.array([int(jsonact['target']['id']) for _, jsonact in acts],dtype=np.int64)
+    a['act_dt'] = np.array([to_nan(jsonact.get('dt')) for _, jsonact in acts],dtype=np.float64)
+    phases = [(k,jsonphase) for k, (_, jsonact) in enumerate(acts) for jsonphase in jsonact['signal']]
+    a['phase_act'] = np.array([k for k, _ in phases],dtype=np.int64)
+    a['phase_id'] = np.array([int(jsonphase['phase']) for _, jsonphase in phases],dtype=np.int64)
+    a['phase_rc_ptr'], a['phase_rc'] = to_csr([parse_list(jsonphase['roadconnections'],int) for _, jsonphase in phases])
+
+    # pretimed controllers: one row per controller and per stage
+    ctrls = list(control['controllers'].items())
+    cycle, offset = list(), list()
+    for strid, jsoncnt in ctrls:
+        if jsoncnt['type']!='sig_pretimed':
+            raise(Exception(f"Error: Cannot compile controller {strid}"))
+        params = {p['name']:float(p['value']) for p in jsoncnt['parameters']}
+        cycle.append(params['cycle'])
+        offset.append(params['offset'])
+    a['ctrl_id'] = np.array([int(strid) for strid, _ in ctrls],dtype=np.int64)
+    a['ctrl_dt'] = np.array([to_nan(jsoncnt.get('dt')) for _, jsoncnt in ctrls],dtype=np.float64)
+    a['ctrl_cycle'] = np.array(cycle,dtype=np.float64)
+    a['ctrl_offset'] = np.array(offset,dtype=np.float64)
+    a['ctrl_act_ptr'], a['ctrl_act'] = to_csr([parse_list(jsoncnt['target_actuators'],int) for _, jsoncnt in ctrls])
+    stages = [jsoncnt['stages'] for _, jsoncnt in ctrls]
+    a['ctrl_stage_ptr'] = np.cumsum([0]+[len(x) for x in stages]).astype(np.int64)
+    a['stage_duration'] = np.array([float(s['duration']) for x in stages for s in x],dtype=np.float64)
+    a['stage_phase_ptr'], a['stage_phase'] = to_csr([parse_list(s['phases'],int) for x in stages for s in x])
+
+    return a
+
+# json objects for the network and the control with parsed values, and the lane group
+# layout: link id -> [(start lane, number of lanes)] in lane group order
+def decompile_scenario(a:dict[str,np.ndarray]) -> tuple[dict,dict[int,list[tuple[int,int]]],dict]:
+
+    roadparams = {k:{'capacity':rp[0], 'speed':rp[1], 'jam_density':rp[2]} for k, rp in enumerate(a['roadparam'].tolist())}
+    links = {linkid:{'full_lanes':full_lanes, 'length':length, 'start':start, 'end':end, 'roadparam':rp}
+             for linkid, full_lanes, length, start, end, rp in zip(a['link_id'].tolist(),
+                                                                     a['link_full_lanes'].tolist(),
+                                                                     a['link_length'].tolist(),
+                                                                     a['link_start'].tolist(),
+                                                                     a['link_end'].tolist(),
+                                                                     a['link_roadparam'].tolist())}
+    rcs = {rcid:{'in_link':in_link, 'in_link_lanes':lanes, 'out_link':out_link}
+           for rcid, in_link, lanes, out_link in zip(a['rc_id'].tolist(),
+                                                     a['rc_in_link'].tolist(),
+                                                     a['rc_in_link_lanes'].tolist(),
+                                                     a['rc_out_link'].tolist())}
+    network = {
+        'nodes':{nodeid:{} for nodeid in a['node_id'].tolist()},
+        'links':links,
+        'roadparams':roadparams,
+        'roadconnections':rcs
+    }
+
+    layout = dict()
+    for linkid, start_lane, num_lanes in zip(a['lg_link'].tolist(),a['lg_start_lane'].tolist(),a['lg_num_lanes'].tolist()):
+        layout.setdefault(linkid,list()).append((start_lane,num_lanes))
+
+    actuators = dict()
+    for actid, node, dt in zip(a['act_id'].tolist(),a['act_node'].tolist(),a['act_dt'].tolist()):
+        jsonact = {'type':'signal', 'target':{'type':'node', 'id':node}, 'signal':list()}
+        if from_nan(dt) is not None:
+            jsonact['dt'] = dt
+        actuators[actid] = jsonact
+    actids = a['act_id'].tolist()
+    for k, phaseid, rcids in zip(a['phase_act'].tolist(),a['phase_id'].tolist(),from_csr(a['phase_rc_ptr'],a['phase_rc'])):
+        actuators[actids[k]]['signal'].append({'phase':phaseid, 'roadconnections':rcids})
+
+    controllers = dict()
+    stage_phases = from_csr(a['stage_phase_ptr'],a['stage_phase'])
+    durations = a['stage_duration'].tolist()
+    stage_ptr = a['ctrl_stage_ptr'].tolist()
+    ctrl_acts = from_csr(a['ctrl_act_ptr'],a['ctrl_act'])
+    for k, (cntid, dt, cycle, offset) in enumerate(zip(a['ctrl_id'].tolist(),a['ctrl_dt'].tolist(),
+                                                      a['ctrl_cycle'].tolist(),a['ctrl_offset'].tolist())):
+        jsoncnt = {
+            'type':'sig_pretimed',
+            'target_actuators':ctrl_acts[k],
+            'parameters':[{'name':'cycle', 'value':cycle}, {'name':'offset', 'value':offset}],
+            'stages':[{'phases':stage_phases[i], 'duration':durations[i]} for i in range(stage_ptr[k],stage_ptr[k+1])]
+        }
+        if from_nan(dt) is not None:
+            jsoncnt['dt'] = dt
+        controllers[cntid] = jsoncnt
+
+    return network, layout, {'actuators':actuators, 'controllers':controllers}
+
+# inputs ###################################################################
+
+def compile_inputs(inputs:dict) -> dict[str,np.ndarray]:
+    a = dict()
+    demands = inputs.get('demands',list())
+    a['dem_link'] = np.array([int(d['link']) for d in demands],dtype=np.int64)
+    a['dem_dt'] = np.array([to_nan(d.get('dt')) for d in demands],dtype=np.float64)
+    a['dem_ptr'], a['dem_value'] = to_csr([parse_list(d['value'],float) for d in demands],np.float64)
+
+    # split profiles: one row per split, per out link, and per time
+    splits = inputs.get('splits',list())
+    a['split_node'] = np.array([int(x['node']) if 'node' in x else -1 for x in splits],dtype=np.int64)
+    a['split_link_in'] = np.array([int(x['link_in']) for x in splits],dtype=np.int64)
+    a['split_dt'] = np.array([to_nan(x.get('dt')) for x in splits],dtype=np.float64)
+    a['split_out_ptr'], a['split_out_link'] = to_csr([[int(s) for s in x['link_out_value'].keys()] for x in splits])
+    a['split_value_ptr'], a['split_value'] = to_csr([parse_list(v,float) for x in splits for v in x['link_out_value'].values()],np.float64)
+    return a
+
+def decompile_inputs(a:dict[str,np.ndarray]) -> dict[str,list[dict]]:
+    demands = list()
+    for linkid, dt, value in zip(a['dem_link'].tolist(),a['dem_dt'].tolist(),from_csr(a['dem_ptr'],a['dem_value'])):
+        demand = {'link':linkid, 'value':value}
+        if from_nan(dt) is not None:
+            demand['dt'] = dt
+        demands.append(demand)
+
+    splits = list()
+    values = from_csr(a['split_value_ptr'],a['split_value'])
+    out_ptr = a['split_out_ptr'].tolist()
+    out_links = a['split_out_link'].tolist()
+    for k, (node, linkin, dt) in enumerate(zip(a['split_node'].tolist(),a['split_link_in'].tolist(),a['split_dt'].tolist())):
+        split = {'link_in':linkin,
+                 'link_out_value':{out_links[i]:values[i] for i in range(out_ptr[k],out_ptr[k+1])}}
+        if node>=0:
+            split['node'] = node
+        if from_nan(dt) is not None:
+            split['dt'] = dt
+        splits.append(split)
+
+    return {'demands':demands, 'splits':splits}
+
+# inputs of an input file or object, from the cache if it has been compiled before
+def load_inputs(input_file:Union[str,dict], cache_folder:str) -> dict[str,list[dict]]:
+    cache_file = get_cache_file(cache_folder,'inputs',get_content_hash(input_file))
+    if os.path.exists(cache_file):
+        return decompile_inputs(load_compiled(cache_file))
+    if isinstance(input_file,str):
+        with open(input_file) as f:
+            inputs = json.load(f)
+    else:
+        inputs = input_file
+    save_compiled(cache_file,compile_inputs(inputs))
+    return inputs
@@ -1,7 +1,9 @@
 from dataclasses import dataclass
 from typing import TYPE_CHECKING
 from Signal import BulbColor, CommandSignal
-from abstract import AbstractController, EventPoke
+from typing import Optional
+from abstract import AbstractController, EventPoke, is_pending
+from static import parse_list
 
 if TYPE_CHECKING:
     from abstract import AbstractActuator
@@ -20,7 +22,7 @@ class Stage:
 
     def __init__(self,jsonstage) -> None:
         self.duration = float(jsonstage['duration'])
-        self.phase_ids = {int(s) for s in jsonstage['phases'].split(',')}
+        self.phase_ids = set(parse_list(jsonstage['phases'],int))
 
 class ControllerStage(AbstractController):
 
@@ -29,11 +31,13 @@ class ControllerStage(AbstractController):
     stages: list[Stage]
     curr_stage_index: int
     signal:'ActuatorSignal'
+    stage_event:Optional[EventPoke]     # next stage change, reused from stage to stage
 
     def __init__(self,selfid:int, jsoncntrl,acts:dict[int,'AbstractActuator']) -> None:
         super().__init__(selfid,jsoncntrl,acts)
 
         self.signal = next(iter(self.actuators.values()))  # type: ignore
+        self.stage_event = None
 
         self.stages = list()
         for jsonstage in jsoncntrl['stages']:
@@ -51,14 +55,37 @@ class ControllerStage(AbstractController):
             else:
                 print(f"Error: Unknown parameter {name}")
 
-        # set start_time
+        self.set_stage_start_times()
+
+    # set start_time
+    def set_stage_start_times(self) -> None:
         relstarttime = 0.0
         for stage in self.stages:
             stage.cycle_starttime = relstarttime%self.cycle
             relstarttime += stage.duration
 
+    # Change the timing plan. The new plan applies from the next poke of the controller.
+    def set_timing(self,
+                   cycle:Optional[float]=None,
+                   offset:Optional[float]=None,
+                   durations:Optional[list[float]]=None) -> None:
+        if durations is not None:
+            if len(durations)!=len(self.stages):
+                raise(Exception(f"Error: Controller {self.id} has {len(self.stages)} stages"))
+            for stage, duration in zip(self.stages,durations):
+                stage.duration = float(duration)
+        if cycle is not None:
+            self.cycle = float(cycle)
+        if offset is not None:
+            self.offset = float(offset)
+        self.set_stage_start_times()
+
     def reset(self) -> None:
-        pass
+        self.stage_event = None
+        self.poke_event = None
+
+    def is_started(self, dispatcher) -> bool:
+        return is_pending(self.stage_event,dispatcher) or is_pending(self.poke_event,dispatcher)
 
     def update_command(self, dispatcher) -> None:
         now = dispatcher.current_time
@@ -67,9 +94,15 @@ class ControllerStage(AbstractController):
         self.set_stage_index(x.index)
         self.write_event(dispatcher.current_time,str(x.index))
 
-        # register next poke
+        # register next poke. A stage change that is already pending is replaced.
         next_stage_start = now - x.reltime + self.stages[x.index].duration
-        dispatcher.register_event(EventPoke(dispatcher,2,next_stage_start,self))
+        if is_pending(self.stage_event,dispatcher):
+            dispatcher.cancel_event(self.stage_event)
+            self.stage_event = None
+        if self.stage_event is None or self.stage_event.dispatcher is not dispatcher:
+            self.stage_event = dispatcher.register_event(EventPoke(dispatcher,2,next_stage_start,self))
+        else:
+            dispatcher.reschedule_event(self.stage_event,next_stage_start)
 
     # Get the command that represents a given stage index
     def get_command_for_stage_index(self,index:int) -> CommandSignal:
@@ -1,8 +1,8 @@
 from typing import TYPE_CHECKING, Optional
 import numpy as np
 from Events import Dispatcher, EventDemandChange, EventCreateVehicle
-from static import get_service_period
-from Vehicle import Vehicle
+from Streams import RandomStream, STREAM_DEMAND
+from static import parse_list
 
 if TYPE_CHECKING:
     from core import Scenario
@@ -13,49 +13,100 @@ class Demand:
     link: 'Link'
     profile: np.array
     dt: Optional[float]
+    rng: RandomStream      # inter-arrival times
 
     # current status
     current_demand_vps:float  # vps
-    vehicle_scheduled:bool
+    create_event:Optional[EventCreateVehicle]   # pending vehicle creation, reused for every arrival
+
+    # Arrival times are drawn in batches, for the current interval of constant demand
+    arrival_times:list[float]
+    arrival_index:int
+    interval_end:float        # time of the next demand change
+    batch_end:float           # last arrival time drawn, possibly beyond interval_end
+    batch_start:float         # batch_end before the current batch was drawn
+    batch_rng_state:Optional[tuple]   # stream state before the current batch was drawn, for checkpoints
+
+    max_batch_size = 1024
 
     def __init__(self,demjson:dict[str,str],scenario:'Scenario') -> None:
         linkid = int(demjson['link'])
 
         self.link = scenario.network.links[linkid]
-        self.profile = np.array([float(s) for s in demjson['value'].split(',')])
+        self.profile = np.array(parse_list(demjson['value'],float))
         self.dt = None if ('dt' not in demjson.keys()) else float(demjson['dt'])
+        self.rng = scenario.random_streams.get_stream(STREAM_DEMAND,linkid)
         self.current_demand_vps = 0
-        self.vehicle_scheduled = False
+        self.create_event = None
+        self.arrival_times = list()
+        self.arrival_index = 0
+        self.interval_end = float('inf')
+        self.batch_end = float('inf')
+        self.batch_start = float('inf')
+        self.batch_rng_state = None
 
         if self.profile.shape[0]==1:
             self.dt=None
 
     def set_current_demand_vps(self, dispatcher:Dispatcher, value:float) -> None:
         self.current_demand_vps = value / 3600.0
+
+        # drop arrivals drawn for the previous rate
+        if self.create_event is not None:
+            dispatcher.cancel_event(self.create_event)
+            self.create_event = None
+        self.arrival_times = list()
+        self.arrival_index = 0
+
         if value>0:
+            now = dispatcher.current_time
+            self.interval_end = self.get_next_change_time(now)
+            self.batch_end = now
             self.schedule_next_vehicle(dispatcher)
 
+    # Draw the arrivals that follow batch_end, as a cumulative sum of exponentials
+    def draw_arrival_batch(self) -> None:
+        self.batch_start = self.batch_end
+        self.batch_rng_state = self.rng.get_state()
+        rate = self.current_demand_vps
+        expected = rate * (self.interval_end - self.batch_end)
+        n = self.max_batch_size if expected>self.max_batch_size else int(expected + 3.0*np.sqrt(expected)) + 1
+        times = self.batch_end + np.cumsum(self.rng.exponentials(n)) / rate
+        self.batch_end = float(times[-1])
+        self.arrival_times = times[times<self.interval_end].tolist()
+        self.arrival_index = 0
+
     def schedule_next_vehicle(self,dispatcher:Dispatcher) -> None:
 
-        if self.vehicle_scheduled:
-            return
+        if self.arrival_index>=len(self.arrival_times):
+            if self.current_demand_vps>0 and self.batch_end<self.interval_end:
+                self.draw_arrival_batch()
+            if self.arrival_index>=len(self.arrival_times):
+                self.create_event = None
+                return
 
-        now = dispatcher.current_time
-        wait_time = get_service_period(self.current_demand_vps)
-        if wait_time is not None:
-            dispatcher.register_event(EventCreateVehicle(dispatcher, now + wait_time, self))
-            self.vehicle_scheduled = True
+        timestamp = self.arrival_times[self.arrival_index]
+        self.arrival_index += 1
 
-    def insert_vehicle(self,dispatcher:Dispatcher ) -> None:
+        # reuse the event that has just fired, if any
+        if self.create_event is None:
+            self.create_event = dispatcher.register_event(EventCreateVehicle(dispatcher, timestamp, self))
+        else:
+            dispatcher.reschedule_event(self.create_event,timestamp)
 
-        # create a vehicle
-        vehicle = Vehicle()
+    def insert_vehicle(self,dispatcher:Dispatcher ) -> None:
 
-        # add vehicle to link
-        self.link.add_vehicle(vehicle,dispatcher)
+        # add a vehicle to the link. Vehicle objects are created by the lane group
+        # if needed.
+        self.link.add_vehicle(None,dispatcher)
 
-        # this scheduled vehicle has been created
-        self.vehicle_scheduled = False
+    def get_next_change_time(self,now:float) -> float:
+        if self.dt is None:
+            return float('inf')
+        index = int(now / self.dt) + 1
+        if index<self.profile.shape[0]:
+            return index * self.dt
+        return float('inf')
 
     def register_next_change(self,dispatcher:Dispatcher) -> None:
 
@@ -1,6 +1,6 @@
-from typing import TYPE_CHECKING
-from abstract import AbstractEvent
-import heapq
+from typing import TYPE_CHECKING, Optional
+from abstract import AbstractEvent, AbstractScheduler
+from Scheduler import HeapScheduler
 
 if TYPE_CHECKING:
     from Demand import Demand
@@ -16,6 +16,7 @@ Event prioties:
 '''
 
 class EventDemandChange(AbstractEvent):
+    __slots__ = ('demand_vps','demand')
     demand_vps:float
     demand:'Demand'
 
@@ -29,6 +30,7 @@ class EventDemandChange(AbstractEvent):
         self.demand.register_next_change(self.dispatcher)
 
 class EventSplitChange(AbstractEvent):
+    __slots__ = ('outlink2value',)
 
     outlink2value: 'Link2Split'
 
@@ -46,6 +48,7 @@ class EventSplitChange(AbstractEvent):
             smp.register_next_change(self.dispatcher,time, splitvalue)
 
 class EventCreateVehicle(AbstractEvent):
+    __slots__ = ()
 
     def __init__(self,dispatcher , timestamp:float , demand:'Demand' ) -> None:
         super().__init__(dispatcher,40,timestamp,demand)
@@ -56,22 +59,17 @@ class EventCreateVehicle(AbstractEvent):
         demand.schedule_next_vehicle(self.dispatcher)
 
 class EventTransitToWaiting(AbstractEvent):
+    __slots__ = ()
 
-    def __init__(self,dispatcher,timestamp:float , vehicle ) -> None:
-        super().__init__(dispatcher,44,timestamp,vehicle)
+    def __init__(self,dispatcher,timestamp:float , lanegroup ) -> None:
+        super().__init__(dispatcher,44,timestamp,lanegroup)
 
     def action(self) -> None:
-
-        vehicle = self.recipient
-        lanegroup = vehicle.lg
-        next_link = vehicle.next_link_id
-
-        if next_link is None:
-            vehicle.waiting_for_lane_change=False
-
-        vehicle.move_to_queue(lanegroup,lanegroup.waiting_queue)
+        self.recipient.release_transit_vehicles(self.dispatcher)
 
 class EventSeviceLanegroupWaitingQueue(AbstractEvent):
+    __slots__ = ()
+    pooled = True
 
     def __init__(self,dispatcher,timestamp:float, obj) -> None:
         super().__init__(dispatcher,45,timestamp,obj)
@@ -80,24 +78,120 @@ class EventSeviceLanegroupWaitingQueue(AbstractEvent):
         self.recipient.service_waiting_queue(self.dispatcher)
 
 class Dispatcher:
-    events: list[tuple[float,int,AbstractEvent]]
+    scheduler: AbstractScheduler
     current_time: float
+    num_cancelled: int      # cancelled events still in the scheduler
+    seq: int                # insertion counter, breaks ties in (timestamp, dispatch_order)
 
-    def __init__(self) -> None:
-        self.events = list()
-        self.current_time = 0.0
+    # Free lists of event objects whose class sets pooled=True. Those events are
+    # recycled once they fire or are dropped, so their owners must not keep references.
+    free_events: dict[type,list[AbstractEvent]]
+    pool_events: bool
 
-    def register_event(self,event:AbstractEvent) -> None:
+    # compact the scheduler when cancelled events exceed this count and half of its size
+    min_compact_size = 64
+
+    def __init__(self, scheduler:Optional[AbstractScheduler]=None, pool_events:bool=True) -> None:
+        self.scheduler = HeapScheduler() if scheduler is None else scheduler
+        self.current_time = 0.0
+        self.num_cancelled = 0
+        self.seq = 0
+        self.free_events = dict()
+        self.pool_events = pool_events
+
+    # Returns the event, which serves as a handle for cancel_event, or None if the
+    # event is in the past.
+    def register_event(self,event:AbstractEvent) -> Optional[AbstractEvent]:
         if event.timestamp<self.current_time:
+            return None
+        self.seq += 1
+        event.cancelled = False
+        event.pending = True
+        self.scheduler.push((event.timestamp,event.dispatch_order,self.seq,event))
+        return event
+
+    # Insert an event with a given insertion sequence number, to restore a checkpoint
+    def insert_event(self,event:AbstractEvent,seq:int) -> None:
+        event.cancelled = False
+        event.pending = True
+        self.scheduler.push((event.timestamp,event.dispatch_order,seq,event))
+
+    # Register again an event that has fired, at a new time
+    def reschedule_event(self,event:AbstractEvent,timestamp:float) -> Optional[AbstractEvent]:
+        if event.pending:
+            raise(Exception("Error: Rescheduling a pending event"))
+        event.timestamp = timestamp
+        return self.register_event(event)
+
+    # Get an event of a pooled class, recycled if possible. The class constructor must
+    # take (dispatcher, timestamp, recipient).
+    def acquire_event(self,clazz,timestamp:float,recipient) -> AbstractEvent:
+        free = self.free_events.get(clazz)
+        if free:
+            event = free.pop()
+            event.timestamp = timestamp
+            event.recipient = recipient
+            return event
+        return clazz(self,timestamp,recipient)
+
+    def release_event(self,event:AbstractEvent) -> None:
+        if self.pool_events:
+            event.recipient = None
+            self.free_events.setdefault(type(event),list()).append(event)
+
+    # Lazy O(1) cancellation. The event is left in the scheduler and discarded when popped.
+    def cancel_event(self,event:AbstractEvent) -> None:
+        if event.cancelled or not event.pending:
             return
-        heapq.heappush(self.events,(event.timestamp,event.dispatch_order,event))
+        event.cancelled = True
+        self.num_cancelled += 1
+        self.check_compact()
+
+    def check_compact(self) -> None:
+        if self.num_cancelled>self.min_compact_size and 2*self.num_cancelled>len(self.scheduler):
+            self.compact()
+
+    def compact(self) -> None:
+        for e in self.scheduler:
+            event = e[3]
+            if event.cancelled:
+                event.pending = False
+                if event.pooled:
+                    self.release_event(event)
+        self.scheduler.remove_cancelled()
+        self.num_cancelled = 0
 
     def remove_events_for_recipient(self,clazz,recipient) -> None:
-        self.events = [e for e in self.events if (not isinstance(e[2],clazz)) or (e[2].recipient is not recipient)]
+        for e in self.scheduler:
+            event = e[3]
+            if isinstance(event,clazz) and (event.recipient is recipient) and not event.cancelled:
+                event.cancelled = True
+                self.num_cancelled += 1
+        self.check_compact()
+
+    def get_num_pending_events(self) -> int:
+        return len(self.scheduler) - self.num_cancelled
 
     def advance(self,duration:float) -> None:
-        stop_time = self.current_time + duration
-        while len(self.events)>0 and self.current_time<=stop_time:
-            timestamp, dispatchorder, event = heapq.heappop(self.events)
+        self.advance_to(self.current_time + duration)
+
+    # Dispatch all events up to and including stop_time, and move the clock to stop_time
+    def advance_to(self,stop_time:float) -> None:
+        scheduler = self.scheduler
+        while len(scheduler)>0:
+            entry = scheduler.pop()
+            timestamp, dispatchorder, seq, event = entry
+            if timestamp>stop_time:
+                scheduler.push(entry)
+                break
+            event.pending = False
+            if event.cancelled:
+                self.num_cancelled -= 1
+                if event.pooled:
+                    self.release_event(event)
+                continue
             self.current_time = timestamp
-            event.action()
\ No newline at end of file
+            event.action()
+            if event.pooled and not event.pending:
+                self.release_event(event)
+        self.current_time = max(self.current_time,stop_time)
\ No newline at end of file
@@ -0,0 +1,183 @@
+from typing import TYPE_CHECKING, Iterable, Optional
+import numpy as np
+from abstract import EventPeriodicPoke, is_pending
+from Topology import SlotTopology, sum_slots
+
+if TYPE_CHECKING:
+    from core import Scenario
+    from Demand import Demand
+    from Events import Dispatcher
+    from LaneGroup import LaneGroup
+
+# Time stepped fluid model, the 'fluid' engine of Scenario. The queues of the lane groups
+# are continuous quantities per slot (see Topology.py), advanced in steps of dt seconds:
+#   - waiting[n,s]: vehicles in the waiting queue of lane group n bound for slot s
+#   - transit[r*N+n,s]: the same, in transit, for the vehicles that reach the waiting
+#     queue at a step equal to r modulo R
+# The network, controllers, actuators, demands, splits and outputs are those of the
+# scenario. The controllers and actuators run as events and set the saturation flow rate
+# of the lane groups, which the model reads at every step. The outputs read the counters
+# of the network, which hold floats in this engine.
+#
+# Each step applies, in this order: the arrivals from transit, the services, the demands.
+#   - a lane group serves at most its saturation flow rate times dt, shared among the
+#     next links in proportion to the waiting vehicles.
+#   - a link accepts in a step at most the supply it had at the start of the step. When
+#     requests exceed it, each is scaled down in proportion.
+#   - vehicles entering a link are shared among its lane groups in proportion to their
+#     supply, and those entering from a demand join the first lane group for their next link.
+#   - a transit time of m steps, at least 1, is split between the steps floor(m) and
+#     floor(m)+1, so that the mean transit time is exact.
+
+class FluidModel:
+
+    scenario: 'Scenario'
+    topology: SlotTopology
+    dt: float
+    step: int
+    signalized: list['LaneGroup']       # lane groups of the signals, whose rate changes
+    signalized_index: np.ndarray
+    transit_lo: np.ndarray              # whole steps of the transit time of each lane group
+    transit_frac: np.ndarray            # and the fraction that takes one more step
+    poke_event: Optional[EventPeriodicPoke]
+
+    # state
+    waiting: np.ndarray                 # (lane groups, slots)
+    transit: np.ndarray                 # (R * lane groups, slots)
+
+    def __init__(self, scenario:'Scenario', dt:float) -> None:
+        if dt<=0:
+            raise(Exception("Error: The fluid time step must be positive"))
+        self.scenario = scenario
+        self.dt = dt
+        network = scenario.network
+        self.topology = SlotTopology(network)
+        self.signalized = list({lg.index:lg for act in scenario.actuators.values()
+                                for phase in act.signal_phases.values() for lg in phase.lanegroups}.values())
+        self.signalized_index = np.array([lg.index for lg in self.signalized],dtype=np.int64)
+        steps = np.maximum(1.0,self.topology.transit_time_sec/dt)
+        self.transit_lo = np.floor(steps).astype(np.int64)
+        self.transit_frac = steps - self.transit_lo
+
+        # outputs read the counters, which hold continuous quantities in this engine
+        network.counters.vehicles = np.zeros(network.num_lgs)
+        network.counters.exits = np.zeros(network.num_lgs)
+        self.clear()
+
+    def clear(self) -> None:
+        N = self.topology.lg_link.shape[0]
+        K = self.topology.num_slots
+        R = int(self.transit_lo.max()) + 2
+        self.step = 0
+        self.poke_event = None
+        self.waiting = np.zeros((N,K))
+        self.transit = np.zeros((R*N,K))
+        self.scenario.network.counters.vehicles[:] = 0.0
+        self.scenario.network.counters.exits[:] = 0.0
+
+    def set_inputs(self, demands:Iterable['Demand']) -> None:
+        self.topology.set_inputs(demands)
+
+    # add num vehicles bound for next_link to the transit ('t') or waiting ('w') queue of lg
+    def add_vehicles(self, lg:'LaneGroup', num:float, queuestr:str, next_link:Optional[int]) -> None:
+        s = 0 if next_link is None else self.topology.get_slot(lg,next_link)
+        if queuestr=='w':
+            self.waiting[lg.index,s] += num
+        elif queuestr=='t':
+            y = np.zeros_like(self.waiting)
+            y[lg.index,s] = num
+            self.enter_transit(y)
+        else:
+            raise(Exception(f"Error: Unknown queue {queuestr}"))
+        self.scenario.network.counters.vehicles[lg.index] += num
+
+    # vehicles per (lane group, slot), in the format of Scenario.get_vehicles
+    def get_vehicles(self) -> dict:
+        network = self.scenario.network
+        N = self.waiting.shape[0]
+        transit = self.transit.reshape(-1,N,self.topology.num_slots).sum(axis=0)
+        vehicles = dict()
+        for lg in network.lanegroups:
+            outlinks = lg.link.outlink_indices
+            for s in range(max(1,len(outlinks))):
+                nextlinkid = network.linklist[outlinks[s]].id if len(outlinks)>0 else None
+                for queuestr, x in (('t',transit),('w',self.waiting)):
+                    if x[lg.index,s]>0:
+                        vehicles[(lg.link.id,lg.start_lane,queuestr,nextlinkid)] = float(x[lg.index,s])
+        return vehicles
+
+    # y (lane groups, slots) enters the transit queues at the current step
+    def enter_transit(self, y:np.ndarray) -> None:
+        N = y.shape[0]
+        R = self.transit.shape[0] // N
+        rows = np.arange(N)
+        lo = self.step + self.transit_lo
+        self.transit[(lo % R)*N + rows] += y * (1.0 - self.transit_frac)[:,None]
+        self.transit[((lo + 1) % R)*N + rows] += y * self.transit_frac[:,None]
+
+    def poke(self, dispatcher:'Dispatcher', timestamp:float) -> None:
+        self.advance_step(timestamp)
+
+    # step every dt from the current time, after the controllers and outputs of each time
+    def start(self, dispatcher:'Dispatcher') -> None:
+        if not is_pending(self.poke_event,dispatcher):
+            self.poke_event = dispatcher.register_event(
+                EventPeriodicPoke(dispatcher,80,dispatcher.current_time,self,self.dt))
+
+    def advance_step(self, time:float) -> None:
+        topology = self.topology
+        counters = self.scenario.network.counters
+        dt = self.dt
+        N, K = self.waiting.shape
+        R = self.transit.shape[0] // N
+
+        # saturation flow rates, as set by the actuators
+        rate = topology.nom_rate_vps.copy()
+        if len(self.signalized)>0:
+            rate[self.signalized_index] = [lg.saturation_flow_rate_vps for lg in self.signalized]
+        topology.update_splits(time)
+
+        # arrivals to the waiting queues
+        r = self.step % R
+        self.waiting += self.transit[r*N:(r+1)*N]
+        self.transit[r*N:(r+1)*N] = 0.0
+
+        # services, shared among the next links in proportion to the waiting vehicles
+        total = sum_slots(self.waiting)
+        fraction = np.minimum(1.0, rate*dt / np.where(total>0,total,1.0))
+        x = self.waiting * fraction[:,None]
+
+        # next links accept at most their supply
+        supply = np.maximum(topology.max_vehicles - counters.vehicles,0.0)
+        link_lg_supply = topology.get_link_lg_values(supply)
+        link_supply = link_lg_supply.sum(axis=1)
+        x = x.reshape(N*K)
+        bound = topology.slot_order
+        requests = topology.sum_by_next_link(x)
+        ratio = np.where(requests>link_supply, link_supply/np.where(requests>0,requests,1.0), 1.0)
+        x[bound] *= ratio[topology.slot_link[bound]]
+        entering = topology.sum_by_next_link(x)
+        x = x.reshape(N,K)
+        self.waiting -= x
+        released = sum_slots(x)
+        counters.vehicles -= released
+        counters.exits += released
+
+        # released vehicles enter their next links in proportion to the supply of the lane
+        # groups, and are routed by the splits of the link
+        lgs = topology.link_lgs
+        valid = lgs>=0
+        share = entering[:,None] * link_lg_supply / np.where(link_supply>0,link_supply,1.0)[:,None]
+        into = np.zeros(N)
+        into[lgs[valid]] = share[valid]
+        y = into[:,None] * topology.split[topology.lg_link]
+
+        # demands join the first lane group for their next link
+        for demand, slot_lgs in topology.demands:
+            vps = topology.get_demand_vps(demand,time)
+            if vps>0:
+                np.add.at(y,(slot_lgs,np.arange(K)),vps*dt*topology.split[demand.link.index])
+
+        self.enter_transit(y)
+        counters.vehicles += sum_slots(y)
+        self.step += 1
@@ -0,0 +1,215 @@
+from typing import Optional, Union
+import os
+import pickle
+import numpy as np
+from core import Scenario, read_json
+from Compiled import get_content_hash, get_cache_file
+from Checkpoint import CHECKPOINT_VERSION
+from Events import EventDemandChange, EventSplitChange
+from Splits import Profile2D
+from static import parse_list
+
+# Incremental re-simulation. A run advances in segments and saves, every checkpoint_dt
+# seconds, a checkpoint of the scenario together with the outputs written so far. The
+# checkpoint at time t is keyed by a hash of everything the state at t depends on: the
+# network, control, output requests, seed, scheduler, checkpoint_dt, and the parts of
+# the inputs that have taken effect by t. A later run restarts from its latest
+# checkpoint whose key is found in the cache folder, and its outputs are bit-identical
+# to those of a run from time zero. The key includes the checkpoint version, so that
+# checkpoints of another version are not found.
+#
+# Inputs take effect at these times:
+#   - value i of a demand or split profile at i*dt. Whether a profile has more values
+#     after t is also part of the key.
+#   - a timing change {'time':t, 'controller':id, ...}, with t>=0 and the other items
+#     passed to ControllerStage.set_timing, at t. Runs are split into segments at these times.
+#   - the network and control files at time zero. Changes to a signal plan from some time
+#     on must be given as timing changes to avoid a run from zero.
+
+TimingChange = dict[str,Union[int,float,list[float]]]
+
+# index of the profile value in effect at time t, with the profile times computed as the
+# demands and splits compute them
+def get_index_in_effect(t:float, dt:Optional[float]) -> int:
+    if dt is None or dt==0:
+        return 0
+    k = int(t/dt)
+    while (k+1)*dt<=t:
+        k += 1
+    while k>0 and k*dt>t:
+        k -= 1
+    return k
+
+# values of a profile that have taken effect by time t, and whether more follow
+def get_profile_prefix(values:list[float], dt:Optional[float], t:float) -> tuple[list[float],bool]:
+    if len(values)==1:
+        return values, False
+    k = get_index_in_effect(t,dt)
+    return values[:k+1], len(values)>k+1
+
+def get_dt(x:dict) -> Optional[float]:
+    return float(x['dt']) if 'dt' in x.keys() else None
+
+# The inputs that have taken effect by time t, in a form that can be hashed. Split
+# profiles keep the order of the out links, which the sampling depends on.
+def get_inputs_prefix(inputs:dict, timings:list[TimingChange], t:float) -> dict:
+    demands = list()
+    for x in inputs.get('demands',list()):
+        dt = get_dt(x)
+        demands.append([int(x['link']), dt, get_profile_prefix(parse_list(x['value'],float),dt,t)])
+    splits = list()
+    for x in inputs.get('splits',list()):
+        dt = get_dt(x)
+        splits.append([int(x['link_in']), dt,
+                       [[int(linkid), get_profile_prefix(parse_list(v,float),dt,t)]
+                        for linkid, v in x['link_out_value'].items()]])
+    return {
+        'time' : t,
+        'demands' : demands,
+        'splits' : splits,
+        'timings' : [timing for timing in timings if timing['time']<t]
+    }
+
+# output name -> (columns, data) of two consecutive parts of a run
+def concatenate_outputs(first:dict, second:dict) -> dict:
+    data = dict()
+    for name, (columns, x) in second.items():
+        y = first[name][1]
+        if isinstance(x,np.ndarray):
+            data[name] = (columns, np.vstack((y,x)))
+        else:
+            data[name] = (columns, y + x)
+    return data
+
+class IncrementalRunner:
+
+    network_file: Union[str,dict]
+    control_file: Union[str,dict]
+    output_requests: list[dict[str,str]]
+    random_seed: int
+    scheduler: Optional[str]
+    hybrid_threshold: Optional[int]     # see Scenario
+    hybrid_dt: float
+    checkpoint_dt: float
+    cache_folder: str
+    scenario: Scenario
+    base_hash: str
+    restart_time: float     # time at which the last run started, 0 unless it restored a checkpoint
+
+    def __init__(self,
+                 network_file:Union[str,dict],
+                 control_file:Union[str,dict],
+                 output_requests:list[dict[str,str]],
+                 cache_folder:str,
+                 random_seed:int,
+                 checkpoint_dt:float=300.0,
+                 scheduler:Optional[str]=None,
+                 hybrid_threshold:Optional[int]=None,
+                 hybrid_dt:float=1.0) -> None:
+        self.network_file = network_file
+        self.control_file = control_file
+        self.output_requests = output_requests
+        self.random_seed = random_seed
+        self.scheduler = scheduler
+        self.hybrid_threshold = hybrid_threshold
+        self.hybrid_dt = hybrid_dt
+        self.checkpoint_dt = checkpoint_dt
+        self.cache_folder = cache_folder
+        self.scenario = Scenario(network_file, control_file,
+                                 output_requests=output_requests,
+                                 random_seed=random_seed,
+                                 scheduler=scheduler,
+                                 hybrid_threshold=hybrid_threshold,
+                                 hybrid_dt=hybrid_dt)
+        self.base_hash = get_content_hash(network_file, control_file,
+                                          {'outputs':output_requests, 'seed':random_seed,
+                                           'scheduler':scheduler, 'checkpoint_dt':checkpoint_dt,
+                                           'hybrid':[hybrid_threshold,hybrid_dt],
+                                           'version':CHECKPOINT_VERSION})
+        self.restart_time = 0.0
+
+    def get_checkpoint_file(self, inputs:dict, timings:list[TimingChange], t:float) -> str:
+        content_hash = get_content_hash({'base':self.base_hash, 'inputs':get_inputs_prefix(inputs,timings,t)})
+        return get_cache_file(self.cache_folder,'checkpoint',content_hash,'pkl')
+
+    def save_checkpoint(self, filename:str, outputs:dict) -> None:
+        # write and rename, so that concurrent readers never see a partial file
+        tmpfile = f"{filename}.{os.getpid()}.tmp"
+        with open(tmpfile,'wb') as f:
+            pickle.dump({'blob':self.scenario.get_checkpoint(), 'outputs':outputs}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpfile,filename)
+
+    # Replace the demand and split profiles of a restored scenario with those of the
+    # inputs, including the values carried by the pending profile changes
+    def set_inputs(self, inputs:dict) -> None:
+        scenario = self.scenario
+        for x in inputs.get('demands',list()):
+            demand = scenario.demands[int(x['link'])]
+            demand.profile = np.array(parse_list(x['value'],float))
+        for x in inputs.get('splits',list()):
+            smp = scenario.network.links[int(x['link_in'])].split_profile
+            smp.profile = Profile2D(x['link_out_value'],smp.dt)
+        for e in scenario.dispatcher.scheduler:
+            event = e[3]
+            if event.cancelled:
+                continue
+            if isinstance(event,EventDemandChange):
+                demand = event.demand
+                event.demand_vps = demand.profile[get_index_in_effect(event.timestamp,demand.dt)]
+            elif isinstance(event,EventSplitChange):
+                smp = event.recipient
+                event.outlink2value = smp.profile.get_ith_value(get_index_in_effect(event.timestamp,smp.dt))
+
+    # Run from time zero to duration with the given inputs (demands and splits, as in the
+    # input json) and timing changes. Returns output name -> (columns, data), as
+    # Scenario.get_output_data.
+    def run(self, inputs:Union[str,dict], duration:float, timings:Optional[list[TimingChange]]=None) -> dict:
+
+        inputs = read_json(inputs)
+        timings = sorted(timings if timings is not None else list(), key=lambda x:x['time'])
+        checkpoint_times = [k*self.checkpoint_dt for k in range(1,int(np.ceil(duration/self.checkpoint_dt)))
+                            if k*self.checkpoint_dt<duration]
+        boundaries = sorted(set(checkpoint_times) | {timing['time'] for timing in timings if 0<timing['time']<duration} | {duration})
+        scenario = self.scenario
+
+        # restart from the latest checkpoint, or from zero
+        self.restart_time = 0.0
+        outputs = None
+        for t in reversed(checkpoint_times):
+            filename = self.get_checkpoint_file(inputs,timings,t)
+            if os.path.exists(filename):
+                with open(filename,'rb') as f:
+                    x = pickle.load(f)
+                scenario.restore_checkpoint(x['blob'])
+                self.set_inputs(inputs)
+                outputs = x['outputs']
+                self.restart_time = t
+                break
+        if outputs is None:
+            scenario.reset(random_seed=self.random_seed)
+            scenario.set_state_and_inputs(demands=inputs.get('demands'), splits=inputs.get('splits'))
+
+        # timing changes are applied at the start of the segment at their time
+        dispatcher = scenario.dispatcher
+        start = self.restart_time
+        for t in boundaries:
+            if t<=self.restart_time:
+                continue
+            for timing in timings:
+                if timing['time']==start:
+                    args = {key:value for key, value in timing.items() if key not in ('time','controller')}
+                    controller = scenario.controllers[int(timing['controller'])]
+                    controller.set_timing(**args)
+                    if controller.is_started(dispatcher):
+                        controller.poke(dispatcher,start)
+            scenario.advance_to(t)
+            start = t
+            if t in checkpoint_times:
+                filename = self.get_checkpoint_file(inputs,timings,t)
+                if not os.path.exists(filename):
+                    data = scenario.get_output_data()
+                    self.save_checkpoint(filename, data if outputs is None else concatenate_outputs(outputs,data))
+
+        data = scenario.get_output_data()
+        return data if outputs is None else concatenate_outputs(outputs,data)
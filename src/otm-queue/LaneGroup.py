@@ -1,5 +1,6 @@
 from typing import TYPE_CHECKING, Optional
 from Events import EventSeviceLanegroupWaitingQueue, EventTransitToWaiting
+from abstract import EventPeriodicPoke
 from collections import deque
 from static import get_service_period
 import numpy as np
@@ -9,31 +10,158 @@ if TYPE_CHECKING:
     from core import Link
     from SimpleClasses import RoadParams
     from Events import Dispatcher
+    from Streams import RandomStream
+    from Output import OutputVehicleEvents
 
 class VehicleQueue:
+
+    # FIFO queue stored as ring buffers of entry times and next link indices (-1 for
+    # none), plus the number of vehicles per next link. Vehicle objects are kept
+    # alongside only in lane groups that write per-vehicle output.
+
+    __slots__ = ('typestr','times','next_links','vehicles','head','size','counts')
+
     typestr:str
-    queue:deque
+    times:np.ndarray            # [sec] time the vehicle entered the queue
+    next_links:np.ndarray       # dense next link index, -1 for none
+    vehicles:deque              # Vehicle objects, empty unless materialized
+    head:int
+    size:int
+    counts:dict[int,int]        # next link index (-1 for none) -> number of vehicles
+
+    initial_capacity = 8
 
     def __init__(self,typestr:str):
         self.typestr = typestr
-        self.queue = deque()
+        self.clear()
 
     def clear(self) -> None:
-        self.queue = deque()
+        self.times = np.empty(self.initial_capacity)
+        self.next_links = np.empty(self.initial_capacity,dtype=np.int32)
+        self.vehicles = deque()
+        self.head = 0
+        self.size = 0
+        self.counts = dict()
 
     def get_total_vehicles(self) -> int:
-        return len(self.queue)
-
-    def add_vehicle(self,v:'Vehicle') -> None:
-        self.queue.append(v)
-
-    def remove_lead_vehicle(self) -> None:
-        self.queue.popleft()
-
-    def peek_lead_vehicle(self) -> 'Vehicle':
-        return self.queue[0]
+        return self.size
+
+    def grow(self) -> None:
+        order = (self.head + np.arange(self.size)) % self.times.shape[0]
+        capacity = 2 * self.times.shape[0]
+        self.times = np.concatenate((self.times[order],np.empty(capacity-self.size)))
+        self.next_links = np.concatenate((self.next_links[order],np.empty(capacity-self.size,dtype=np.int32)))
+        self.head = 0
+
+    def add_vehicle(self,timestamp:float,next_link:Optional[int],v:Optional['Vehicle']=None) -> None:
+        if self.size==self.times.shape[0]:
+            self.grow()
+        i = (self.head + self.size) % self.times.shape[0]
+        k = -1 if next_link is None else next_link
+        self.times[i] = timestamp
+        self.next_links[i] = k
+        self.size += 1
+        self.counts[k] = self.counts.get(k,0) + 1
+        if v is not None:
+            self.vehicles.append(v)
+
+    # remove the lead vehicle and return its entry time, next link index, and Vehicle object if any
+    def remove_lead_vehicle(self) -> tuple[float,Optional[int],Optional['Vehicle']]:
+        i = self.head
+        timestamp = float(self.times[i])
+        k = int(self.next_links[i])
+        self.head = (i + 1) % self.times.shape[0]
+        self.size -= 1
+        if self.counts[k]==1:
+            del self.counts[k]
+        else:
+            self.counts[k] -= 1
+        v = self.vehicles.popleft() if len(self.vehicles)>0 else None
+        return timestamp, (None if k<0 else k), v
+
+    # remove the n lead vehicles and return their entry times and next link indices.
+    # Only for queues without Vehicle objects.
+    def remove_lead_vehicles(self,n:int) -> tuple[np.ndarray,np.ndarray]:
+        order = (self.head + np.arange(n)) % self.times.shape[0]
+        times = self.times[order]
+        next_links = self.next_links[order]
+        self.head = (self.head + n) % self.times.shape[0]
+        self.size -= n
+        counts = self.counts
+        for k in next_links.tolist():
+            if counts[k]==1:
+                del counts[k]
+            else:
+                counts[k] -= 1
+        return times, next_links
+
+    # add vehicles that entered at timestamp, with the given next link indices
+    def add_vehicles(self,timestamp:float,next_links:np.ndarray) -> None:
+        n = next_links.shape[0]
+        while self.size + n > self.times.shape[0]:
+            self.grow()
+        order = (self.head + self.size + np.arange(n)) % self.times.shape[0]
+        self.times[order] = timestamp
+        self.next_links[order] = next_links
+        self.size += n
+        counts = self.counts
+        for k in next_links.tolist():
+            counts[k] = counts.get(k,0) + 1
+
+    # entry times and next link indices, from the lead vehicle back
+    def get_contents(self) -> tuple[np.ndarray,np.ndarray]:
+        order = (self.head + np.arange(self.size)) % self.times.shape[0]
+        return self.times[order], self.next_links[order]
+
+    # replace the contents. Vehicle objects, if any, must be appended to vehicles.
+    def set_contents(self,times:np.ndarray,next_links:np.ndarray) -> None:
+        self.clear()
+        self.size = times.shape[0]
+        capacity = max(self.initial_capacity,self.size)
+        self.times = np.empty(capacity)
+        self.times[:self.size] = times
+        self.next_links = np.empty(capacity,dtype=np.int32)
+        self.next_links[:self.size] = next_links
+        keys, counts = np.unique(next_links,return_counts=True)
+        self.counts = dict(zip(keys.tolist(),counts.tolist()))
+
+    def peek_lead_time(self) -> float:
+        return float(self.times[self.head])
+
+    # number of lead vehicles that entered at or before timestamp
+    def count_lead_entered_by(self,timestamp:float) -> int:
+        times = self.times
+        capacity = times.shape[0]
+        n = 0
+        while n<self.size and times[(self.head + n) % capacity]<=timestamp:
+            n += 1
+        return n
+
+    def peek_lead_next_link(self) -> Optional[int]:
+        k = int(self.next_links[self.head])
+        return None if k<0 else k
+
+class LaneGroupCounters:
+
+    # Vehicles in (transit and waiting), and vehicles released by, every lane group of
+    # a network, in flat arrays indexed by the dense lane group index. Maintained
+    # incrementally so that outputs can take vectorized snapshots.
+
+    __slots__ = ('vehicles','exits')
+
+    vehicles:np.ndarray
+    exits:np.ndarray
+
+    def __init__(self,num_lgs:int) -> None:
+        self.vehicles = np.zeros(num_lgs,dtype=np.int64)
+        self.exits = np.zeros(num_lgs,dtype=np.int64)
 
 class LaneGroup:
+    __slots__ = ('link','num_lanes','start_lane','max_vehicles','transit_time_sec',
+                 'saturation_flow_rate_vps','nom_saturation_flow_rate_vps','longitudinal_supply',
+                 'index','counters','lgs_by_link','has_actuator','transit_queue','waiting_queue','service_event',
+                 'blocked_upstream','transit_event','rng','vehicle_writer','outbox',
+                 'aggregate_threshold','aggregate_dt','poke_event')
 
     link : "Link"
     num_lanes : int
@@ -44,13 +172,36 @@ class LaneGroup:
     saturation_flow_rate_vps : float
     nom_saturation_flow_rate_vps : float
     longitudinal_supply: float       # [veh]
-    exit_count:int                  # [veh]
-    nextlinks:list['Link']
 
-    actuator : bool
+    index: int                      # dense lane group index in the network
+    counters: Optional[LaneGroupCounters]
+    lgs_by_link: list[list['LaneGroup']]  # dense link index -> lane groups, shared by the network
+
+    has_actuator : bool
     transit_queue: VehicleQueue
     waiting_queue: VehicleQueue
 
+    # event-driven service: the lane group is idle unless a service event is pending
+    service_event: Optional[EventSeviceLanegroupWaitingQueue]
+    blocked_upstream: set['LaneGroup']    # lane groups waiting for supply in this one
+
+    # a single event releases the head of the transit queue, which is FIFO in release time
+    transit_event: Optional[EventTransitToWaiting]
+
+    rng: Optional['RandomStream']    # service times
+    vehicle_writer: Optional['OutputVehicleEvents']   # Vehicle objects are materialized only if set
+
+    # Set for the lane groups of another region that this one feeds, in partitioned runs
+    # (see Partition.py). Vehicles sent to the lane group are appended to it as (time,
+    # lane group index, vehicle id or -1), and the lane group only keeps a supply estimate.
+    outbox: Optional[list[tuple[float,int,int]]]
+
+    # Aggregate mode, for long waiting queues (see start_aggregate). The lane group is in
+    # aggregate mode while poke_event is set.
+    aggregate_threshold: float          # waiting vehicles beyond which the mode starts, inf for never
+    aggregate_dt: float                 # [sec] period of the discharge
+    poke_event: Optional[EventPeriodicPoke]
+
     def __init__(self,link:"Link", num_lanes:int , start_lane:int, rp:'RoadParams') -> None:
 
         self.link = link
@@ -65,17 +216,37 @@ class LaneGroup:
         self.saturation_flow_rate_vps = rp.capacity*self.num_lanes/3600
         self.nom_saturation_flow_rate_vps = self.saturation_flow_rate_vps
         self.longitudinal_supply = 0.
-        self.exit_count = 0
+        self.index = -1
+        self.counters = None
+        self.lgs_by_link = list()
 
         self.has_actuator = False
         self.transit_queue = VehicleQueue('transit')
         self.waiting_queue = VehicleQueue('waiting')
+        self.service_event = None
+        self.blocked_upstream = set()
+        self.transit_event = None
+        self.rng = None
+        self.vehicle_writer = None
+        self.outbox = None
+        self.aggregate_threshold = float('inf')
+        self.aggregate_dt = 1.0
+        self.poke_event = None
 
         self.update_long_supply()
 
     def get_id(self):
         return self.link.id, self.start_lane
 
+    def set_index(self,index:int,counters:LaneGroupCounters,lgs_by_link:list[list['LaneGroup']]) -> None:
+        self.index = index
+        self.counters = counters
+        self.lgs_by_link = lgs_by_link
+
+    def register_vehicle_writer(self,x:'OutputVehicleEvents') -> None:
+        if self.vehicle_writer is None:
+            self.vehicle_writer = x
+
     def register_signal(self):
         if self.has_actuator:
             raise(Exception("Lanegroup is assigned multiple actuators"))
@@ -84,20 +255,30 @@ class LaneGroup:
     def clear(self) -> None:
         self.transit_queue.clear()
         self.waiting_queue.clear()
+        self.service_event = None
+        self.blocked_upstream = set()
+        self.transit_event = None
+        self.poke_event = None
+        self.saturation_flow_rate_vps = self.nom_saturation_flow_rate_vps
+        self.counters.vehicles[self.index] = 0
+        self.counters.exits[self.index] = 0
+        self.update_long_supply()
 
     def update_long_supply(self) -> None:
         self.longitudinal_supply =  self.max_vehicles - self.get_total_vehicles()
 
-    def set_vehicles(self,vehs:int,queue:str,nextlinkid:int,dispatcher:'Dispatcher'):
+    # next_link is a dense link index
+    def set_vehicles(self,vehs:int,queue:str,next_link:Optional[int],dispatcher:'Dispatcher'):
         if vehs>self.longitudinal_supply:
             raise(Exception("Setting too many vehicles"))
         for i in range(vehs):
-            vehicle = Vehicle()
-            vehicle.next_link_id = nextlinkid
-            self.add_vehicle_to_queue(vehicle, queue, dispatcher)
+            self.add_vehicle_to_queue(None, next_link, queue, dispatcher)
 
     def get_total_vehicles(self) -> float:
-        return self.transit_queue.get_total_vehicles() + self.transit_queue.get_total_vehicles()
+        return self.transit_queue.get_total_vehicles() + self.waiting_queue.get_total_vehicles()
+
+    def get_exit_count(self) -> int:
+        return int(self.counters.exits[self.index])
 
     def get_supply_per_lane(self) -> float:
         return self.longitudinal_supply / self.num_lanes
@@ -105,95 +286,224 @@ class LaneGroup:
     def set_actuator_capacity_vps(self,rate_vps:float,dispatcher:'Dispatcher') -> None:
         if rate_vps<0:
             return
-        self.saturation_flow_rate_vps = min(self.nom_saturation_flow_rate_vps,rate_vps)
+        rate_vps = min(self.nom_saturation_flow_rate_vps,rate_vps)
+
+        # service is memoryless, so pending events remain valid if the rate does not change
+        if rate_vps==self.saturation_flow_rate_vps:
+            return
+        self.saturation_flow_rate_vps = rate_vps
 
         # Recompute exit times for all vehicles in the waiting queue
         self.reset_exit_times(dispatcher)
 
     def reset_exit_times(self,dispatcher:'Dispatcher')->None:
-        now = dispatcher.current_time
-        dispatcher.remove_events_for_recipient(EventSeviceLanegroupWaitingQueue,self)
 
-        if self.saturation_flow_rate_vps<=0.0:
-            return
+        # cancel the pending service event
+        if self.service_event is not None:
+            dispatcher.cancel_event(self.service_event)
+            self.service_event = None
 
         # reschedule for all vehicles in waiting queue
-        next_release = now + get_service_period(self.saturation_flow_rate_vps)
-        dispatcher.register_event(EventSeviceLanegroupWaitingQueue(dispatcher,next_release,self))
+        self.schedule_service_waiting_queue(dispatcher)
 
-    def add_vehicle_to_queue(self, veh: 'Vehicle', queuestr: str, dispatcher: Optional['Dispatcher']=None) -> None:
+    # timestamp is the entry time, if earlier than the current time (see Partition.py)
+    def add_vehicle_to_queue(self, veh: Optional['Vehicle'], next_link: Optional[int], queuestr: str, dispatcher: 'Dispatcher',
+                             timestamp: Optional[float]=None) -> None:
 
         if queuestr=='t':
             queue = self.transit_queue
         elif queuestr=='w':
             queue = self.waiting_queue
         else:
-            queue = None
+            raise(Exception(f"Error: Unknown queue {queuestr}"))
 
-        # tell the vehicle it has moved
-        veh.move_to_queue(self,queue)
+        now = dispatcher.current_time if timestamp is None else timestamp
 
-        # dispatch to go to waiting queue
-        if queue is self.transit_queue:
-            now = dispatcher.current_time
-            dispatcher.register_event(EventTransitToWaiting(dispatcher,now + self.transit_time_sec,veh))
+        # materialize the vehicle only if this lane group writes per-vehicle output
+        if self.vehicle_writer is None:
+            veh = None
+        else:
+            if veh is None:
+                veh = Vehicle()
+                veh.next_link = -1 if next_link is None else next_link
+            veh.move_to_queue(self,queue)
+            self.vehicle_writer.write_event(now,veh,self,queuestr)
+
+        queue.add_vehicle(now,next_link,veh)
+        self.counters.vehicles[self.index] += 1
+
+        # dispatch to go to waiting queue, unless the release of an earlier vehicle is pending
+        # or the lane group is in aggregate mode
+        if queue is self.transit_queue and self.transit_event is None and self.poke_event is None:
+            self.transit_event = dispatcher.register_event(EventTransitToWaiting(dispatcher,now + self.transit_time_sec,self))
 
         self.update_long_supply()
 
+    # move the vehicles that have completed their transit to the waiting queue
+    def release_transit_vehicles(self, dispatcher:'Dispatcher') -> None:
+
+        now = dispatcher.current_time
+        transit_queue = self.transit_queue
+        while transit_queue.size>0 and transit_queue.peek_lead_time() + self.transit_time_sec <= now:
+            timestamp, next_link, veh = transit_queue.remove_lead_vehicle()
+            self.waiting_queue.add_vehicle(now,next_link,veh)
+            if veh is not None:
+                veh.move_to_queue(self,self.waiting_queue)
+                self.vehicle_writer.write_event(now,veh,self,'w')
+
+        # re-arm the event for the new head of the transit queue
+        if transit_queue.size>0:
+            dispatcher.reschedule_event(self.transit_event,transit_queue.peek_lead_time() + self.transit_time_sec)
+        else:
+            self.transit_event = None
+
+        # switch to aggregate mode if the waiting queue is too long, otherwise wake up the
+        # lane group if it is idle
+        if self.waiting_queue.size>self.aggregate_threshold:
+            self.start_aggregate(dispatcher)
+        else:
+            self.schedule_service_waiting_queue(dispatcher)
+
     def service_waiting_queue(self, dispatcher:'Dispatcher') -> None:
 
-        # schedule the next vehicle release dispatch
-        self.schedule_service_waiting_queue(dispatcher)
+        # this service event has fired
+        self.service_event = None
 
-        # ignore if waiting queue is empty
+        # go idle if waiting queue is empty. A vehicle arriving to the waiting
+        # queue will wake the lane group up.
         if self.waiting_queue.get_total_vehicles()==0:
             return
 
-        # otherwise get the first vehicle
-        vehicle = self.waiting_queue.peek_lead_vehicle()
+        # schedule the next vehicle release dispatch, unless blocked
+        if self.release_lead_vehicle(dispatcher):
+            self.schedule_service_waiting_queue(dispatcher)
+
+    # Release the lead vehicle of the waiting queue if there is space in its next link.
+    # Otherwise register with the downstream lane groups and return False.
+    def release_lead_vehicle(self, dispatcher:'Dispatcher') -> bool:
+
+        # get the next link of the first vehicle
+        next_link = self.waiting_queue.peek_lead_next_link()
 
-        # compute space in the next link
+        # compute space in the next link: the downstream lane group with the most supply
         nextlg = None
+        nextlgs = None
         nextlg_supply = float('inf')
         if not self.link.is_sink:
-            next_link_id = vehicle.next_link_id
-            if next_link_id in self.link.endnode.out_links.keys():
-                nextlgs = self.link.endnode.out_links[next_link_id].lgs
-                nextlgs_supply = [lg.longitudinal_supply for lg in nextlgs]
-                nextlg_ind = np.argmax(nextlgs_supply)
-                nextlg = nextlgs[nextlg_ind]
-                nextlg_supply = nextlgs_supply[nextlg_ind]
+            nextlgs = self.lgs_by_link[next_link]
+            nextlg = nextlgs[0]
+            nextlg_supply = nextlg.longitudinal_supply
+            for lg in nextlgs:
+                if lg.longitudinal_supply > nextlg_supply:
+                    nextlg = lg
+                    nextlg_supply = lg.longitudinal_supply
 
         # release the vehicle if there is space
         if nextlg_supply >= 1:
 
-            # increment exit counter
-            self.exit_count += 1
-
-            # send vehicle to next link
-            if not self.link.is_sink:
+            # update counters
+            self.counters.vehicles[self.index] -= 1
+            self.counters.exits[self.index] += 1
+
+            # send vehicle to next link, or remove it from the network
+            timestamp, next_link, vehicle = self.waiting_queue.remove_lead_vehicle()
+            if self.link.is_sink:
+                if vehicle is not None:
+                    self.vehicle_writer.write_event(dispatcher.current_time,vehicle,self,'x')
+            elif nextlg.outbox is not None:
+                nextlg.send_vehicle(vehicle,dispatcher)
+            else:
                 nextlg.link.add_vehicle(vehicle,dispatcher,joinlg=nextlg)
 
             self.update_long_supply()
 
+            # space has opened in this lane group
+            self.wake_blocked_upstream(dispatcher)
+            return True
+
+        # otherwise sleep until the downstream lane groups free up
+        for lg in nextlgs:
+            lg.blocked_upstream.add(self)
+        return False
+
+    # Aggregate mode. Instead of an event per vehicle for its transit and its service, a
+    # periodic poke every aggregate_dt moves the vehicles that have completed their transit
+    # to the waiting queue, and releases a batch from the head of the waiting queue at the
+    # current saturation flow rate. Vehicles stay in the queues throughout, so they are
+    # conserved across the switches.
+    def start_aggregate(self, dispatcher:'Dispatcher') -> None:
+        if self.service_event is not None:
+            dispatcher.cancel_event(self.service_event)
+            self.service_event = None
+        if self.transit_event is not None:
+            dispatcher.cancel_event(self.transit_event)
+            self.transit_event = None
+        self.poke_event = dispatcher.register_event(
+            EventPeriodicPoke(dispatcher,45,dispatcher.current_time+self.aggregate_dt,self,self.aggregate_dt))
+
+    # back to an event per vehicle
+    def stop_aggregate(self, dispatcher:'Dispatcher') -> None:
+        dispatcher.cancel_event(self.poke_event)
+        self.poke_event = None
+        if self.transit_queue.size>0:
+            self.transit_event = dispatcher.register_event(
+                EventTransitToWaiting(dispatcher,self.transit_queue.peek_lead_time() + self.transit_time_sec,self))
+        self.schedule_service_waiting_queue(dispatcher)
+
+    def poke(self, dispatcher:'Dispatcher', timestamp:float) -> None:
+
+        # vehicles that have completed their transit, in FIFO order
+        if self.transit_queue.size>0:
+            n = self.transit_queue.count_lead_entered_by(timestamp - self.transit_time_sec)
+            if n>0:
+                _, next_links = self.transit_queue.remove_lead_vehicles(n)
+                self.waiting_queue.add_vehicles(timestamp,next_links)
+
+        # services of the period, at its saturation flow rate. Service periods are
+        # memoryless, so the one that overruns the period is dropped. Service that cannot
+        # be used, because the queue is empty or blocked, is lost.
+        remaining = self.aggregate_dt
+        while self.waiting_queue.size>0:
+            service_period = get_service_period(self.saturation_flow_rate_vps,self.rng)
+            if service_period is None or service_period>remaining or not self.release_lead_vehicle(dispatcher):
+                break
+            remaining -= service_period
+
+        # back to an event per vehicle once the queue has drained
+        if self.waiting_queue.size==0:
+            self.stop_aggregate(dispatcher)
+
+    # The vehicle is counted here until it is handed to the region that owns this lane group
+    def send_vehicle(self, vehicle:Optional['Vehicle'], dispatcher:'Dispatcher') -> None:
+        self.outbox.append((dispatcher.current_time,self.index,-1 if vehicle is None else vehicle.id))
+        self.counters.vehicles[self.index] += 1
+        self.longitudinal_supply -= 1
+
     def schedule_service_waiting_queue(self, dispatcher:'Dispatcher') -> None:
+
+        # nothing to do if already scheduled, in aggregate mode, or if there is nobody to serve
+        if (self.service_event is not None) or (self.poke_event is not None) or self.waiting_queue.get_total_vehicles()==0:
+            return
+
         nowtime = dispatcher.current_time
-        service_period = get_service_period(self.saturation_flow_rate_vps)
+        service_period = get_service_period(self.saturation_flow_rate_vps,self.rng)
         if service_period is not None:
             timestamp = nowtime + service_period
-            dispatcher.register_event(EventSeviceLanegroupWaitingQueue(dispatcher, timestamp, self))
+            event = dispatcher.acquire_event(EventSeviceLanegroupWaitingQueue, timestamp, self)
+            self.service_event = dispatcher.register_event(event)
+
+    def wake_blocked_upstream(self, dispatcher:'Dispatcher') -> None:
+        if len(self.blocked_upstream)==0 or self.longitudinal_supply<1:
+            return
+        lgs = self.blocked_upstream
+        self.blocked_upstream = set()
+        for lg in lgs:
+            lg.schedule_service_waiting_queue(dispatcher)
 
     def __str__(self) -> str:
         return "({},{})".format(self.link.id, self.start_lane)
 
-    def __key(self):
-        return (self.link.id, self.start_lane)
-
+    # lane groups are unique objects, so equality is identity and the hash is the dense index
     def __hash__(self):
-        return hash(self.__key())
-
-    def __eq__(self, other):
-        if isinstance(other, LaneGroup):
-            return self.__key() == other.__key()
-        return NotImplemented
+        return self.index
 
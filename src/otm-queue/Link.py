@@ -1,7 +1,6 @@
 from typing import TYPE_CHECKING, Optional
 import numpy as np
 from SimpleClasses import RoadParams
-import random
 
 if TYPE_CHECKING:
     from Splits import SplitMatrixProfile
@@ -9,10 +8,12 @@ if TYPE_CHECKING:
     from core import Node
     from Events import Dispatcher
     from Vehicle import Vehicle
+    from Streams import RandomStream
 
 class Link:
 
     id: int
+    index: int                        # dense link index in the network
     full_lanes: int
     length: float
     startnode: 'Node'
@@ -22,13 +23,17 @@ class Link:
     lgs: list['LaneGroup']
     is_source: bool
     is_sink: bool
+    rng: Optional['RandomStream']     # routing in the absence of a split profile
+    outlink_ids: list[int]            # ids of the out links of the end node
+    outlink_indices: list[int]        # dense indices of the out links of the end node
 
-    # nextlink -> lanegroups in this link from which nextlink is reachable
+    # next link index -> lanegroups in this link from which the next link is reachable
     nextlink2mylgs: dict[int, list['LaneGroup']]
 
     def __init__(self,network,linkid:int,jsonlink:dict,roadparam:dict) -> None:
 
         self.id = linkid
+        self.index = -1
         self.full_lanes = int(jsonlink['full_lanes'])
         self.length = float(jsonlink['length'])
         self.startnode = network.nodes[int(jsonlink['start'])]
@@ -43,14 +48,18 @@ class Link:
         self.is_source = False
         self.is_sink = False
         self.nextlink2mylgs = dict()
+        self.rng = None
+        self.outlink_ids = list()
+        self.outlink_indices = list()
 
+    # dense index of the next link, None for sinks
     def sample_next_link(self) -> Optional[int]:
         if self.is_sink:
             return None
         if self.split_profile is not None:
             return self.split_profile.sample_output_link()
         else:
-            return random.choice(list(self.endnode.out_links.keys()))
+            return self.outlink_indices[int(self.rng.uniform()*len(self.outlink_indices))]
 
     def get_lanegroup_for_startlane(self,startlane:int) -> Optional['LaneGroup']:
         v = [lg for lg in self.lgs if lg.start_lane==startlane]
@@ -71,22 +80,26 @@ class Link:
         ind = np.argmax([lg.get_supply_per_lane() for lg in candidate_lanegroups])
         return candidate_lanegroups[ind]
 
-    def add_vehicle(self,vehicle:'Vehicle',dispatcher:'Dispatcher',joinlg:Optional['LaneGroup']=None):
+    # vehicle is None unless it has been materialized for per-vehicle output. timestamp is
+    # the entry time, if earlier than the current time.
+    def add_vehicle(self,vehicle:Optional['Vehicle'],dispatcher:'Dispatcher',joinlg:Optional['LaneGroup']=None,
+                    timestamp:Optional[float]=None):
 
         # sample its next link
-        next_link_id = self.sample_next_link()
-        vehicle.next_link_id = next_link_id
+        next_link = self.sample_next_link()
+        if vehicle is not None:
+            vehicle.next_link = -1 if next_link is None else next_link
 
         # pick from among the eligible lane groups, unless joinlg is already given
         if joinlg is None:
-            candidate_lane_groups: list[LaneGroup] = self.get_lanegroups_for_nextlink(vehicle.next_link_id)
+            candidate_lane_groups: list[LaneGroup] = self.get_lanegroups_for_nextlink(next_link)
             joinlg = self.argmax_supply(candidate_lane_groups)
 
         # add to joinlanegroup
-        joinlg.add_vehicle_to_queue(vehicle,'t', dispatcher)
+        joinlg.add_vehicle_to_queue(vehicle,next_link,'t',dispatcher,timestamp)
 
     def get_num_vehicles(self) -> float:
         return sum([lg.get_total_vehicles() for lg in self.lgs])
 
     def exit_count(self) -> int:
-        return sum(lg.exit_count for lg in self.lgs)
+        return sum(lg.get_exit_count() for lg in self.lgs)
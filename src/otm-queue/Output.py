@@ -1,7 +1,10 @@
 from abstract import AbstractOutput, AbstractOutputTimed
 from typing import TYPE_CHECKING
+import numpy as np
 if TYPE_CHECKING:
     from core import Scenario
+    from LaneGroup import LaneGroup
+    from Vehicle import Vehicle
 
 def read_links(scenario,request):
     if 'links' in request.keys():
@@ -9,11 +12,22 @@ def read_links(scenario,request):
     else:
         return list(scenario.network.links.values())
 
+# dense indices of the lane groups of the links, contiguous per link, and the position
+# of the first lane group of each link, for np.add.reduceat
+def get_lanegroup_indices(links) -> tuple[np.ndarray,np.ndarray]:
+    indices = [lg.index for link in links for lg in link.lgs]
+    offsets = np.cumsum([0]+[len(link.lgs) for link in links[:-1]])
+    return np.array(indices,dtype=np.int64), offsets
+
+def get_lanegroup_header(links) -> str:
+    return 'time,'+','.join(["({};{})".format(link.id, lg.start_lane) for link in links for lg in link.lgs])
+
 class OutputLinkFlow(AbstractOutputTimed):
 
     def __init__(self,scenario:'Scenario',request:dict[str,str]) -> None:
         super().__init__(scenario,request)
         self.links = read_links(scenario,request)
+        self.lg_indices, self.offsets = get_lanegroup_indices(self.links)
 
     def get_name(self) -> str:
         return "linkflw"
@@ -21,14 +35,15 @@ class OutputLinkFlow(AbstractOutputTimed):
     def get_header(self) -> str:
         return 'time,'+','.join([str(link.id) for link in self.links])
 
-    def get_str(self) -> str:
-        return ','.join([str(link.exit_count()) for link in self.links])
+    def get_values(self) -> np.ndarray:
+        return np.add.reduceat(self.scenario.network.counters.exits[self.lg_indices],self.offsets)
 
 class OutputLinkVeh(AbstractOutputTimed):
 
     def __init__(self,scenario:'Scenario',request:dict[str,str]) -> None:
         super().__init__(scenario,request)
         self.links = read_links(scenario,request)
+        self.lg_indices, self.offsets = get_lanegroup_indices(self.links)
 
     def get_name(self) -> str:
         return "linkveh"
@@ -36,52 +51,40 @@ class OutputLinkVeh(AbstractOutputTimed):
     def get_header(self) -> str:
         return 'time,'+','.join([str(link.id) for link in self.links])
 
-    def get_str(self) -> str:
-        return ','.join([str(link.get_num_vehicles()) for link in self.links])
+    def get_values(self) -> np.ndarray:
+        return np.add.reduceat(self.scenario.network.counters.vehicles[self.lg_indices],self.offsets)
 
 class OutputLanegroupFlow(AbstractOutputTimed):
 
     def __init__(self,scenario:'Scenario',request:dict[str,str]) -> None:
         super().__init__(scenario,request)
         self.links = read_links(scenario,request)
+        self.lg_indices, _ = get_lanegroup_indices(self.links)
 
     def get_name(self) -> str:
         return "lgflw"
 
     def get_header(self) -> str:
-        header = 'time,'
-        for link in self.scenario.network.links.values():
-            for lg in link.lgs:
-                header += "({};{}),".format(link.id, lg.start_lane)
-        return header[:-1]
+        return get_lanegroup_header(self.links)
 
-    def get_str(self) -> str: 
-        z = ''
-        for link in self.scenario.network.links.values():
-            z += ','+','.join([str(lg.exit_count) for lg in link.lgs])
-        return z[1:]
+    def get_values(self) -> np.ndarray:
+        return self.scenario.network.counters.exits[self.lg_indices]
 
 class OutputLanegroupVeh(AbstractOutputTimed):
 
     def __init__(self,scenario:'Scenario',request:dict[str,str]) -> None:
         super().__init__(scenario,request)
         self.links = read_links(scenario,request)
+        self.lg_indices, _ = get_lanegroup_indices(self.links)
 
     def get_name(self) -> str:
         return "lgveh"
 
     def get_header(self) -> str:
-        header = 'time,'
-        for link in self.scenario.network.links.values():
-            for lg in link.lgs:
-                header += "({};{}),".format(link.id, lg.start_lane)
-        return header[:-1]
+        return get_lanegroup_header(self.links)
 
-    def get_str(self) -> str:
-        z = ''
-        for link in self.scenario.network.links.values():
-            z += ','+','.join([str(lg.get_total_vehicles()) for lg in link.lgs])
-        return z[1:]
+    def get_values(self) -> np.ndarray:
+        return self.scenario.network.counters.vehicles[self.lg_indices]
 
 class OutputControllerEvents(AbstractOutput):
 
@@ -100,3 +103,25 @@ class OutputControllerEvents(AbstractOutput):
 
     def get_header(self) -> str:
         return 'time,id,event'
+
+class OutputVehicleEvents(AbstractOutput):
+
+    # One row each time a vehicle enters a transit queue (t), a waiting queue (w),
+    # or leaves the network (x). Vehicle objects are only created in the lane groups
+    # of the requested links.
+
+    def __init__(self,scenario:'Scenario',request:dict[str,str]) -> None:
+        super().__init__(scenario,request)
+        self.links = read_links(scenario,request)
+        for link in self.links:
+            for lg in link.lgs:
+                lg.register_vehicle_writer(self)
+
+    def get_name(self) -> str:
+        return "veh"
+
+    def get_header(self) -> str:
+        return 'time,id,link,lane,queue'
+
+    def write_event(self,timestamp:float,vehicle:'Vehicle',lg:'LaneGroup',queuestr:str) -> None:
+        self.write_row([timestamp,vehicle.id,lg.link.id,lg.start_lane,queuestr])
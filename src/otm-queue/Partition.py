@@ -0,0 +1,264 @@
+from typing import Optional, Union
+from collections import deque
+import multiprocessing
+import static
+from core import Scenario, Network, read_json
+from abstract import AbstractOutputTimed
+from Vehicle import Vehicle
+
+# Partitioned execution. The nodes of the network are split into regions, and each region
+# is simulated by its own process and dispatcher. Every process builds the whole network,
+# but only simulates the links it owns, which are the links that end at its nodes. The
+# demands and splits of a link go to its owner, and all processes run all controllers.
+#
+# A boundary link starts at a node of another region. All vehicles entering it come from
+# the region of its start node, where its lane groups are ghosts with an outbox (see
+# LaneGroup.send_vehicle). Vehicles released into a ghost become messages (time, lane
+# group, vehicle id), and the owner adds them to the transit queue of the lane group, with
+# their original entry time, at the next synchronization.
+#
+# Synchronization is conservative, in windows of length lookahead, the smallest transit
+# time of a boundary link. A vehicle sent at t within a window reaches the waiting queue at
+# t plus the transit time, after the end of the window, so it is delivered before it can
+# have any effect downstream. Results are those of the sequential simulation, except:
+#   - Supply approximation. A region sees the supply of a ghost lane group as it was at
+#     the last synchronization, minus the vehicles it has sent to it since. This is a lower
+#     bound of the true supply, so boundary links are never overfilled, but space that
+#     opens during a window is only seen at the next synchronization. Vehicles blocked by
+#     a ghost are woken up then.
+#   - Vehicles in flight are counted in the outputs of the sending region until they are
+#     delivered, so the merged outputs count them in the right link, but events at equal
+#     times may be ordered differently.
+# Timed outputs are summed across regions, the controller events are those of region 0,
+# and vehicle events are merged in time order. Vehicle ids are unique across regions.
+
+VEHICLE_ID_BLOCK = 10**12
+
+# Contiguous regions of roughly equal numbers of nodes, in breadth first order of the
+# undirected network. Returns node id -> region.
+def partition_network(network:Network, num_regions:int) -> dict[int,int]:
+    neighbors = {nodeid:set() for nodeid in network.nodes.keys()}
+    for link in network.links.values():
+        neighbors[link.startnode.id].add(link.endnode.id)
+        neighbors[link.endnode.id].add(link.startnode.id)
+    order = list()
+    visited = set()
+    for root in sorted(network.nodes.keys()):
+        if root in visited:
+            continue
+        visited.add(root)
+        queue = deque([root])
+        while len(queue)>0:
+            nodeid = queue.popleft()
+            order.append(nodeid)
+            for other in sorted(neighbors[nodeid]):
+                if other not in visited:
+                    visited.add(other)
+                    queue.append(other)
+    return {nodeid:(i*num_regions)//len(order) for i, nodeid in enumerate(order)}
+
+def get_link_owner(node2region:dict[int,int], link) -> int:
+    return node2region[link.endnode.id]
+
+def is_boundary_link(node2region:dict[int,int], link) -> bool:
+    return (not link.is_source) and node2region[link.startnode.id]!=node2region[link.endnode.id]
+
+def get_lookahead(network:Network, node2region:dict[int,int]) -> float:
+    times = [lg.transit_time_sec for link in network.linklist if is_boundary_link(node2region,link) for lg in link.lgs]
+    return min(times) if len(times)>0 else float('inf')
+
+class Region:
+
+    # The part of a partitioned run that is simulated in one process
+
+    index: int
+    scenario: Scenario
+    outboxes: dict[int,list[tuple[float,int,int]]]  # destination region -> messages
+    ghosts: list                    # lane groups of other regions fed by this one
+    boundary_lgs: list              # lane groups of this region fed by other regions
+
+    def __init__(self, index:int, scenario:Scenario, node2region:dict[int,int], inputs:dict) -> None:
+        self.index = index
+        self.scenario = scenario
+        network = scenario.network
+        owned = {link.id for link in network.linklist if get_link_owner(node2region,link)==index}
+
+        self.outboxes = dict()
+        self.ghosts = list()
+        self.boundary_lgs = list()
+        for link in network.linklist:
+            if not is_boundary_link(node2region,link):
+                continue
+            if link.id in owned:
+                self.boundary_lgs.extend(link.lgs)
+            elif node2region[link.startnode.id]==index:
+                outbox = self.outboxes.setdefault(get_link_owner(node2region,link),list())
+                for lg in link.lgs:
+                    lg.outbox = outbox
+                    self.ghosts.append(lg)
+
+        # vehicle ids, demands and splits of this region
+        static.vehicle_id_count = index*VEHICLE_ID_BLOCK
+        scenario.set_state_and_inputs(
+            demands=[x for x in inputs.get('demands',list()) if int(x['link']) in owned],
+            splits=[x for x in inputs.get('splits',list()) if int(x['link_in']) in owned])
+
+    # messages to other regions, and the supply of the boundary lane groups
+    def get_outgoing(self) -> tuple[dict[int,list[tuple[float,int,int]]],dict[int,float]]:
+        counters = self.scenario.network.counters
+        messages = dict()
+        for region, outbox in self.outboxes.items():
+            if len(outbox)>0:
+                messages[region] = list(outbox)
+                for t, lgindex, vehid in outbox:
+                    counters.vehicles[lgindex] -= 1
+                outbox.clear()
+        return messages, {lg.index:lg.longitudinal_supply for lg in self.boundary_lgs}
+
+    def set_incoming(self, messages:list[tuple[float,int,int]], sent:dict[int,list[tuple[float,int,int]]],
+                     supplies:dict[int,float]) -> None:
+        scenario = self.scenario
+        dispatcher = scenario.dispatcher
+        lgs = scenario.network.lanegroups
+
+        # vehicles from other regions, in the order they were sent
+        for t, lgindex, vehid in messages:
+            lg = lgs[lgindex]
+            lg.link.add_vehicle(None if vehid<0 else Vehicle(vehid),dispatcher,joinlg=lg,timestamp=t)
+
+        # supply of the ghosts, less the vehicles just sent to them
+        in_flight = dict()
+        for outbox in sent.values():
+            for t, lgindex, vehid in outbox:
+                in_flight[lgindex] = in_flight.get(lgindex,0) + 1
+        for lg in self.ghosts:
+            lg.longitudinal_supply = supplies[lg.index] - in_flight.get(lg.index,0)
+        for lg in self.ghosts:
+            lg.wake_blocked_upstream(dispatcher)
+
+def run_region(conn, index:int, network:Union[str,dict], control:Union[str,dict], inputs:dict,
+               output_requests:list[dict[str,str]], node2region:dict[int,int], random_seed:Optional[int],
+               scheduler:Optional[str], hybrid_threshold:Optional[int], hybrid_dt:float,
+               duration:float, window:float) -> None:
+    scenario = Scenario(network, control, output_requests=output_requests,
+                        random_seed=random_seed, scheduler=scheduler,
+                        hybrid_threshold=hybrid_threshold, hybrid_dt=hybrid_dt)
+    region = Region(index, scenario, node2region, inputs)
+
+    # the first window starts the lane groups and controllers, the others only dispatch,
+    # so that they are started once as in a sequential run. Lane groups blocked by a
+    # ghost are woken by set_incoming.
+    now = min(window,duration)
+    scenario.advance_to(now)
+    while True:
+        messages, supplies = region.get_outgoing()
+        conn.send((messages, supplies))
+        incoming, all_supplies = conn.recv()
+        region.set_incoming(incoming, messages, all_supplies)
+        if now>=duration:
+            break
+        now = min(now+window,duration)
+        scenario.dispatcher.advance_to(now)
+    conn.send(scenario.get_output_data())
+    conn.close()
+
+# output name -> (columns, data) of a partitioned run, from those of the regions
+def merge_outputs(scenario:Scenario, data:list[dict]) -> dict:
+    merged = dict()
+    for output in scenario.outputs:
+        name = output.get_name()
+        if isinstance(output,AbstractOutputTimed):
+            columns, x = data[0][name]
+            x = x.copy()
+            for d in data[1:]:
+                x[:,1:] += d[name][1][:,1:]
+            merged[name] = (columns, x)
+        elif name=='ctrl':
+            merged[name] = data[0][name]
+        else:
+            rows = [row for d in data for row in d[name][1]]
+            rows.sort(key=lambda row:row[0])
+            merged[name] = (data[0][name][0], rows)
+    return merged
+
+class PartitionedRunner:
+
+    network: Union[str,dict]
+    control: Union[str,dict]
+    inputs: dict
+    output_requests: list[dict[str,str]]
+    random_seed: Optional[int]
+    scheduler: Optional[str]
+    hybrid_threshold: Optional[int]     # see Scenario
+    hybrid_dt: float
+    scenario: Scenario                  # for the topology and the output columns, not simulated
+    node2region: dict[int,int]
+    num_regions: int
+    lookahead: float                    # [sec] smallest transit time of a boundary link
+
+    def __init__(self,
+                 network_file:Union[str,dict],
+                 control_file:Union[str,dict],
+                 input_file:Union[str,dict],
+                 output_requests:list[dict[str,str]],
+                 num_regions:int=2,
+                 node2region:Optional[dict[int,int]]=None,
+                 random_seed:Optional[int]=None,
+                 scheduler:Optional[str]=None,
+                 hybrid_threshold:Optional[int]=None,
+                 hybrid_dt:float=1.0) -> None:
+        self.network = read_json(network_file)
+        self.control = read_json(control_file)
+        self.inputs = read_json(input_file)
+        self.output_requests = output_requests
+        self.random_seed = random_seed
+        self.scheduler = scheduler
+        self.hybrid_threshold = hybrid_threshold
+        self.hybrid_dt = hybrid_dt
+        self.scenario = Scenario(self.network, self.control, output_requests=output_requests)
+        network = self.scenario.network
+        self.node2region = partition_network(network,num_regions) if node2region is None else node2region
+        self.num_regions = max(self.node2region.values()) + 1
+        self.lookahead = get_lookahead(network,self.node2region)
+
+    # Run for duration seconds. Returns output name -> (columns, data), see Scenario.get_output_data
+    def run(self, duration:float) -> dict:
+
+        if self.lookahead<=0:
+            raise(Exception("Error: A boundary link has no transit time"))
+        window = min(self.lookahead,duration)
+
+        context = multiprocessing.get_context()
+        conns = list()
+        processes = list()
+        for index in range(self.num_regions):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=run_region,
+                                      args=(child_conn, index, self.network, self.control, self.inputs,
+                                            self.output_requests, self.node2region, self.random_seed,
+                                            self.scheduler, self.hybrid_threshold, self.hybrid_dt,
+                                            duration, window))
+            process.start()
+            conns.append(parent_conn)
+            processes.append(process)
+
+        try:
+            # route the messages and supplies of every window
+            now = 0.0
+            while now<duration:
+                now = min(now+window,duration)
+                outgoing = [conn.recv() for conn in conns]
+                supplies = dict()
+                incoming = [list() for _ in range(self.num_regions)]
+                for messages, region_supplies in outgoing:
+                    supplies.update(region_supplies)
+                    for region, x in messages.items():
+                        incoming[region].extend(x)
+                for index, conn in enumerate(conns):
+                    conn.send((incoming[index], supplies))
+            data = [conn.recv() for conn in conns]
+        finally:
+            for process in processes:
+                process.join()
+
+        return merge_outputs(self.scenario, data)
@@ -0,0 +1,174 @@
+from typing import Optional, Union
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from statistics import NormalDist
+import os
+import numpy as np
+from core import Scenario, read_json
+from Compiled import load_inputs
+
+# Monte Carlo replications of a scenario across a process pool. The json inputs are
+# parsed once in the parent and shipped to the workers. Each worker builds the
+# Scenario once and resets it, with a new seed, for every replication it runs.
+# Outputs are kept in memory and returned to the parent.
+
+# Scenario built by the initializer of each worker process
+worker_scenario: Optional[Scenario] = None
+
+def init_worker(network:Union[str,dict], control:Union[str,dict], output_requests:list[dict[str,str]],
+                scheduler:Optional[str], cache_folder:Optional[str]=None,
+                hybrid_threshold:Optional[int]=None, hybrid_dt:float=1.0) -> None:
+    global worker_scenario
+    worker_scenario = Scenario(network, control,
+                               output_requests=output_requests,
+                               scheduler=scheduler,
+                               cache_folder=cache_folder,
+                               hybrid_threshold=hybrid_threshold,
+                               hybrid_dt=hybrid_dt)
+
+def run_replication(seed:int, inputs:dict, duration:float) -> dict[str,tuple[list[str],Union[np.ndarray,list[list]]]]:
+    scenario = worker_scenario
+    scenario.reset(random_seed=seed)
+    scenario.set_state_and_inputs(demands=inputs.get('demands'), splits=inputs.get('splits'))
+    scenario.advance(duration)
+    return scenario.get_output_data()
+
+class ReplicationStatistics:
+
+    # Streaming mean and variance across replications (Welford), for each time step and
+    # column of the requested timed outputs. Memory does not grow with the number of
+    # replications.
+
+    names: list[str]                # output names, e.g. 'linkveh'
+    count: int                      # number of replications
+    columns: dict[str,list[str]]    # output name -> column names, without time
+    times: dict[str,np.ndarray]
+    mean: dict[str,np.ndarray]      # output name -> (time steps, columns)
+    m2: dict[str,np.ndarray]        # sum of squared deviations from the mean
+
+    def __init__(self, names:list[str]) -> None:
+        self.names = names
+        self.count = 0
+        self.columns = dict()
+        self.times = dict()
+        self.mean = dict()
+        self.m2 = dict()
+
+    def add(self, data:dict[str,tuple[list[str],Union[np.ndarray,list[list]]]]) -> None:
+        self.count += 1
+        for name in self.names:
+            columns, rows = data[name]
+            x = np.asarray(rows,dtype=float)
+            if self.count==1:
+                self.columns[name] = columns[1:]
+                self.times[name] = x[:,0]
+                self.mean[name] = np.zeros(x[:,1:].shape)
+                self.m2[name] = np.zeros(x[:,1:].shape)
+            elif x.shape[0]!=self.times[name].shape[0]:
+                raise(Exception(f"Error: Replications of {name} have different lengths"))
+            x = x[:,1:]
+            delta = x - self.mean[name]
+            self.mean[name] += delta / self.count
+            self.m2[name] += delta * (x - self.mean[name])
+
+    # sample variance
+    def get_variance(self, name:str) -> np.ndarray:
+        if self.count<2:
+            return np.full(self.mean[name].shape,np.inf)
+        return self.m2[name] / (self.count-1)
+
+    # Half width of the confidence interval of the mean. Uses the normal approximation,
+    # so it should only be trusted after a few tens of replications.
+    def get_half_width(self, name:str, confidence:float=0.95) -> np.ndarray:
+        z = NormalDist().inv_cdf(0.5 + confidence/2)
+        return z * np.sqrt(self.get_variance(name) / max(self.count,1))
+
+    # all half widths are within the targets (output name -> half width)
+    def is_precise(self, targets:dict[str,float], confidence:float=0.95) -> bool:
+        return all(np.max(self.get_half_width(name,confidence))<=target for name, target in targets.items())
+
+class ReplicationRunner:
+
+    network: Union[str,dict]       # parsed, or as given when the workers load a compiled scenario
+    control: Union[str,dict]
+    inputs: dict
+    output_requests: list[dict[str,str]]
+    max_workers: Optional[int]
+    scheduler: Optional[str]
+    cache_folder: Optional[str]     # workers load the compiled scenario, see Compiled.py
+    hybrid_threshold: Optional[int] # see Scenario
+    hybrid_dt: float
+
+    def __init__(self,
+                 network_file:Union[str,dict],
+                 control_file:Union[str,dict],
+                 input_file:Union[str,dict],
+                 output_requests:list[dict[str,str]],
+                 max_workers:Optional[int]=None,
+                 scheduler:Optional[str]=None,
+                 cache_folder:Optional[str]=None,
+                 hybrid_threshold:Optional[int]=None,
+                 hybrid_dt:float=1.0) -> None:
+        self.output_requests = output_requests
+        self.max_workers = max_workers
+        self.scheduler = scheduler
+        self.cache_folder = cache_folder
+        self.hybrid_threshold = hybrid_threshold
+        self.hybrid_dt = hybrid_dt
+        if cache_folder is None:
+            self.network = read_json(network_file)
+            self.control = read_json(control_file)
+            self.inputs = read_json(input_file)
+        else:
+            # compile once here, so that the workers only load
+            Scenario(network_file, control_file, cache_folder=cache_folder)
+            self.network = network_file
+            self.control = control_file
+            self.inputs = load_inputs(input_file, cache_folder)
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.max_workers,
+                                   initializer=init_worker,
+                                   initargs=(self.network, self.control, self.output_requests,
+                                             self.scheduler, self.cache_folder,
+                                             self.hybrid_threshold, self.hybrid_dt))
+
+    # Run one replication per seed. Returns seed -> output name -> (column names, data), see Scenario.get_output_data
+    def run(self, seeds:list[int], duration:float) -> dict[int,dict[str,tuple[list[str],list[list]]]]:
+        with self.get_executor() as executor:
+            futures = {seed:executor.submit(run_replication, seed, self.inputs, duration) for seed in seeds}
+            return {seed:future.result() for seed, future in futures.items()}
+
+    # Run replications until the half width of the confidence interval of every
+    # (time step, column) of the target outputs is at most the target, or until
+    # max_replications. New replications stop being launched as soon as the targets
+    # are met; those already running are included in the statistics.
+    def run_until(self,
+                  targets:dict[str,float],
+                  duration:float,
+                  confidence:float=0.95,
+                  min_replications:int=10,
+                  max_replications:int=1000,
+                  seed0:int=0) -> ReplicationStatistics:
+
+        stats = ReplicationStatistics(list(targets.keys()))
+        num_in_flight = self.max_workers if self.max_workers is not None else os.cpu_count()
+        seeds = list(range(seed0, seed0+max_replications))
+        with self.get_executor() as executor:
+            running = set()
+            while True:
+
+                # keep the pool busy until the targets are met
+                while len(seeds)>0 and len(running)<num_in_flight:
+                    running.add(executor.submit(run_replication, seeds.pop(0), self.inputs, duration))
+
+                if len(running)==0:
+                    break
+
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stats.add(future.result())
+
+                if stats.count>=min_replications and stats.is_precise(targets,confidence):
+                    seeds = list()
+
+        return stats
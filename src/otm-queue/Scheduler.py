@@ -0,0 +1,135 @@
+from typing import Optional
+from abstract import AbstractScheduler, SchedulerEntry
+import heapq
+
+class HeapScheduler(AbstractScheduler):
+    entries: list[SchedulerEntry]
+
+    def __init__(self) -> None:
+        self.entries = list()
+
+    def push(self, entry:SchedulerEntry) -> None:
+        heapq.heappush(self.entries,entry)
+
+    def pop(self) -> SchedulerEntry:
+        return heapq.heappop(self.entries)
+
+    def remove_cancelled(self) -> None:
+        self.entries = [e for e in self.entries if not e[3].cancelled]
+        heapq.heapify(self.entries)
+
+    def clear(self) -> None:
+        self.entries = list()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+class CalendarScheduler(AbstractScheduler):
+
+    # Calendar queue (R. Brown, 1988). Entries are hashed by timestamp into a ring of
+    # buckets of fixed width. A bucket covers the times [k*width,(k+1)*width) for every
+    # k that equals its index modulo the number of buckets (one k per "year"). Each
+    # bucket is a small heap, so entries with the same timestamp are ordered exactly
+    # as in HeapScheduler. The ring is resized, and the width re-estimated, whenever
+    # the number of entries leaves [num_buckets/2, 2*num_buckets].
+
+    buckets: list[list[SchedulerEntry]]
+    width: float        # [sec]
+    size: int
+    current_day: int    # k of the bucket being dispatched
+
+    min_buckets = 2
+    width_samples = 25  # number of entries used to estimate the bucket width
+
+    def __init__(self, width:float=1.0) -> None:
+        self.width = width
+        self.clear()
+
+    def clear(self) -> None:
+        self.buckets = [list() for _ in range(self.min_buckets)]
+        self.size = 0
+        self.current_day = 0
+
+    def push(self, entry:SchedulerEntry) -> None:
+        day = int(entry[0]/self.width)
+        heapq.heappush(self.buckets[day % len(self.buckets)],entry)
+        self.size += 1
+        if day<self.current_day:
+            self.current_day = day
+        if self.size>2*len(self.buckets):
+            self.resize(2*len(self.buckets))
+
+    def pop(self) -> SchedulerEntry:
+
+        if self.size==0:
+            raise(IndexError("pop from empty scheduler"))
+
+        # scan one year starting from the current day
+        num_buckets = len(self.buckets)
+        day = self.current_day
+        bucket = None
+        for _ in range(num_buckets):
+            b = self.buckets[day % num_buckets]
+            if len(b)>0 and int(b[0][0]/self.width)<=day:
+                bucket = b
+                break
+            day += 1
+
+        # nothing in this year: jump directly to the earliest entry
+        if bucket is None:
+            bucket = min((b for b in self.buckets if len(b)>0), key=lambda b: b[0])
+            day = int(bucket[0][0]/self.width)
+
+        entry = heapq.heappop(bucket)
+        self.current_day = day
+        self.size -= 1
+
+        if num_buckets>self.min_buckets and 2*self.size<num_buckets:
+            self.resize(num_buckets//2)
+
+        return entry
+
+    def remove_cancelled(self) -> None:
+        for i, b in enumerate(self.buckets):
+            self.buckets[i] = [e for e in b if not e[3].cancelled]
+            heapq.heapify(self.buckets[i])
+        self.size = sum(len(b) for b in self.buckets)
+        if len(self.buckets)>self.min_buckets and 2*self.size<len(self.buckets):
+            self.resize(max(self.min_buckets,self.size))
+
+    def resize(self, num_buckets:int) -> None:
+        entries = [e for b in self.buckets for e in b]
+        width = self.estimate_width(entries)
+        if width is not None:
+            self.width = width
+        self.buckets = [list() for _ in range(num_buckets)]
+        for e in entries:
+            self.buckets[int(e[0]/self.width) % num_buckets].append(e)
+        for b in self.buckets:
+            heapq.heapify(b)
+        if len(entries)>0:
+            self.current_day = int(min(e[0] for e in entries)/self.width)
+
+    # Brown's heuristic: three times the average separation of the earliest entries
+    def estimate_width(self, entries:list[SchedulerEntry]) -> Optional[float]:
+        times = heapq.nsmallest(self.width_samples,(e[0] for e in entries))
+        if len(times)<2 or times[-1]<=times[0]:
+            return None
+        return 3.0 * (times[-1]-times[0]) / (len(times)-1)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self):
+        return (e for b in self.buckets for e in b)
+
+def get_scheduler(name:Optional[str]=None) -> AbstractScheduler:
+    if name is None or name=='heap':
+        return HeapScheduler()
+    elif name=='calendar':
+        return CalendarScheduler()
+    else:
+        raise(Exception(f"Error: Unknown scheduler {name}"))
@@ -2,6 +2,7 @@ from typing import TYPE_CHECKING, Optional
 from typing import Any
 from enum import Enum
 from abstract import AbstractActuator, AbstractCommand
+from static import parse_list
 
 if TYPE_CHECKING:
     from core import Scenario
@@ -26,10 +27,9 @@ class SignalPhase:
         self.phaseid = int(jsonphase['phase'])
 
         # populate lanegroups
-        rcids = [int(rcid) for rcid in jsonphase['roadconnections'].split(',')]
         self.lanegroups = set()
-        for rcid in rcids:
-            self.lanegroups = self.lanegroups.union(set(rc2inlgs[rcid]))
+        for rcid in parse_list(jsonphase['roadconnections'],int):
+            self.lanegroups.update(rc2inlgs[rcid])
 
     def set_bulb_color(self,to_color:BulbColor,dispatcher:'Dispatcher') -> None:
 
@@ -1,13 +1,13 @@
 from dataclasses import dataclass
 
-@dataclass
+@dataclass(slots=True)
 class RoadConnection:
     id:int
     in_link:int
     in_link_lanes:tuple[int,int]
     out_link:int
 
-@dataclass
+@dataclass(slots=True)
 class RoadParams:
     capacity : float
     speed : float
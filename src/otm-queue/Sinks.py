@@ -0,0 +1,215 @@
+from typing import Optional, TextIO
+import json
+import os
+import numpy as np
+from abstract import AbstractSink
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+class CSVSink(AbstractSink):
+
+    filename: str
+    file: Optional[TextIO]
+
+    def __init__(self, filename:str) -> None:
+        self.filename = filename
+        self.file = None
+
+    def open(self, columns:list[str]) -> None:
+        self.file = open(self.filename, 'w')
+        self.file.write(','.join(columns)+'\n')
+
+    def write(self, timestamp:float, values) -> None:
+        self.file.write(f"{timestamp},"+','.join([str(x) for x in values])+'\n')
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class ColumnarSink(AbstractSink):
+
+    # Records kept in preallocated NumPy arrays, one time array and one value column per
+    # output column, which double in size when full. With a filename the columns are
+    # also saved to a compressed npz file when the sink is closed.
+
+    filename: Optional[str]
+    columns: list[str]
+    times: np.ndarray           # (capacity,)
+    values: np.ndarray          # (capacity, columns without time)
+    size: int
+
+    initial_capacity = 256
+
+    def __init__(self, filename:Optional[str]=None) -> None:
+        self.filename = filename
+        self.columns = list()
+        self.times = np.empty(0)
+        self.values = np.empty((0,0))
+        self.size = 0
+
+    def open(self, columns:list[str]) -> None:
+        self.columns = columns
+        self.times = np.empty(self.initial_capacity)
+        self.values = np.empty((self.initial_capacity,len(columns)-1))
+        self.size = 0
+
+    def grow(self) -> None:
+        capacity = 2*len(self.times)
+        times = np.empty(capacity)
+        times[:self.size] = self.times[:self.size]
+        values = np.empty((capacity,self.values.shape[1]))
+        values[:self.size] = self.values[:self.size]
+        self.times = times
+        self.values = values
+
+    def write(self, timestamp:float, values) -> None:
+        if self.size==len(self.times):
+            self.grow()
+        self.times[self.size] = timestamp
+        self.values[self.size] = values
+        self.size += 1
+
+    # views of the recorded part of the arrays
+    def get_times(self) -> np.ndarray:
+        return self.times[:self.size]
+
+    def get_values(self) -> np.ndarray:
+        return self.values[:self.size]
+
+    def get_data(self) -> tuple[list[str],np.ndarray]:
+        return self.columns, np.column_stack((self.get_times(),self.get_values()))
+
+    def close(self) -> None:
+        if self.filename is not None:
+            save_npz(self.filename, self.columns, self.get_times(), self.get_values())
+
+class MemmapSink(AbstractSink):
+
+    # Append-only fixed width records in a memory-mapped file, for outputs too long to
+    # keep in RAM. The file starts with the number of records written (int64),
+    # followed by the records: the time (float64) and one float32 or int32 value per
+    # column. Column names and the value type go to a json header next to it. The
+    # record count is updated after each record, so the file can be read with
+    # read_memmap while the simulation runs. The mapping doubles when full and the
+    # file is trimmed on close.
+
+    filename: str
+    dtype: str                          # 'float32' or 'int32'
+    record_dtype: Optional[np.dtype]
+    count: Optional[np.memmap]          # (1,) int64
+    records: Optional[np.memmap]
+    size: int
+    capacity: int
+
+    initial_capacity = 4096
+
+    def __init__(self, filename:str, dtype:Optional[str]=None) -> None:
+        self.filename = filename
+        self.dtype = 'float32' if dtype is None else dtype
+        if self.dtype not in ['float32','int32']:
+            raise(Exception(f"Error: Unsupported memmap type {self.dtype}"))
+        self.record_dtype = None
+        self.count = None
+        self.records = None
+        self.size = 0
+        self.capacity = 0
+
+    def open(self, columns:list[str]) -> None:
+        self.record_dtype = get_record_dtype(self.dtype,len(columns)-1)
+        with open(get_header_filename(self.filename),'w') as f:
+            json.dump({'columns':columns, 'dtype':self.dtype}, f)
+        self.size = 0
+        self.capacity = self.initial_capacity
+        with open(self.filename,'wb') as f:
+            f.truncate(MEMMAP_OFFSET + self.capacity*self.record_dtype.itemsize)
+        self.map()
+
+    def map(self) -> None:
+        self.count = np.memmap(self.filename, dtype=np.int64, mode='r+', shape=(1,))
+        self.records = np.memmap(self.filename, dtype=self.record_dtype, mode='r+',
+                                 offset=MEMMAP_OFFSET, shape=(self.capacity,))
+
+    def unmap(self) -> None:
+        self.records.flush()
+        self.count.flush()
+        self.records = None
+        self.count = None
+
+    def grow(self) -> None:
+        self.unmap()
+        self.capacity *= 2
+        with open(self.filename,'r+b') as f:
+            f.truncate(MEMMAP_OFFSET + self.capacity*self.record_dtype.itemsize)
+        self.map()
+
+    def write(self, timestamp:float, values) -> None:
+        if self.size==self.capacity:
+            self.grow()
+        self.records['time'][self.size] = timestamp
+        self.records['values'][self.size] = values
+        self.size += 1
+        self.count[0] = self.size
+
+    def close(self) -> None:
+        if self.records is None:
+            return
+        self.unmap()
+        with open(self.filename,'r+b') as f:
+            f.truncate(MEMMAP_OFFSET + self.size*self.record_dtype.itemsize)
+
+# bytes before the first record of a memmap file
+MEMMAP_OFFSET = 8
+
+def get_record_dtype(dtype:str, num_values:int) -> np.dtype:
+    return np.dtype([('time',np.float64), ('values',dtype,(num_values,))])
+
+def get_header_filename(filename:str) -> str:
+    return os.path.splitext(filename)[0]+'.json'
+
+# Column names and a read-only view of the records written so far to a memmap file,
+# with fields 'time' and 'values'. Nothing is copied, and the file may still be open
+# for writing.
+def read_memmap(filename:str) -> tuple[list[str],np.ndarray]:
+    with open(get_header_filename(filename)) as f:
+        header = json.load(f)
+    record_dtype = get_record_dtype(header['dtype'],len(header['columns'])-1)
+    count = int(np.fromfile(filename, dtype=np.int64, count=1)[0])
+    if count==0:
+        return header['columns'], np.empty(0,dtype=record_dtype)
+    return header['columns'], np.memmap(filename, dtype=record_dtype, mode='r',
+                                        offset=MEMMAP_OFFSET, shape=(count,))
+
+def save_npz(filename:str, columns:list[str], times:np.ndarray, values:np.ndarray) -> None:
+    np.savez_compressed(filename, columns=np.array(columns), time=times, values=values)
+
+# (column names, one row per record with the time first)
+def read_npz(filename:str) -> tuple[list[str],np.ndarray]:
+    with np.load(filename) as data:
+        return data['columns'].tolist(), np.column_stack((data['time'],data['values']))
+
+def to_dataframe(columns:list[str], data) -> 'pd.DataFrame':
+    if pd is None:
+        raise(Exception("Error: pandas is not installed"))
+    return pd.DataFrame(data, columns=columns)
+
+# Sink for a timed output. sink_type is 'csv', 'memory', 'npz' (memory, saved to a
+# compressed file on close) or 'mmap' (memory-mapped file of dtype 'float32' or 'int32').
+# By default outputs go to csv with an output folder and stay in memory without one.
+def make_sink(sink_type:Optional[str], folder_prefix:Optional[str], name:str, dtype:Optional[str]=None) -> AbstractSink:
+    if sink_type is None:
+        sink_type = 'memory' if folder_prefix is None else 'csv'
+    if sink_type=='memory':
+        return ColumnarSink()
+    if folder_prefix is None:
+        raise(Exception(f"Error: The {sink_type} sink requires an output folder"))
+    if sink_type=='csv':
+        return CSVSink(f"{folder_prefix}_{name}.csv")
+    elif sink_type=='npz':
+        return ColumnarSink(f"{folder_prefix}_{name}.npz")
+    elif sink_type=='mmap':
+        return MemmapSink(f"{folder_prefix}_{name}.bin", dtype)
+    else:
+        raise(Exception(f"Error: Unknown sink type {sink_type}"))
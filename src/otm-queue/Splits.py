@@ -2,6 +2,8 @@
 from typing import TYPE_CHECKING, Optional
 from Events import Dispatcher, EventSplitChange
 from Link import Link
+from Streams import RandomStream, STREAM_SPLIT
+from static import parse_list
 # from SimpleClasses import VehicleType
 import numpy as np
 
@@ -10,6 +12,27 @@ if TYPE_CHECKING:
 
 Link2Split = tuple[np.array,np.array]  # list of outlink ids and corresponding splits
 
+# Vose's alias method. Returns, for each of the n columns, the probability of keeping
+# the column and the alternative column, so that sampling takes a single uniform draw.
+def build_alias_table(p:np.array) -> tuple[list[float],list[int]]:
+    n = p.shape[0]
+    scaled = (n * p / p.sum()).tolist()
+    prob = [1.0] * n
+    alias = list(range(n))
+    small = [i for i in range(n) if scaled[i]<1.0]
+    large = [i for i in range(n) if scaled[i]>=1.0]
+    while len(small)>0 and len(large)>0:
+        s = small.pop()
+        l = large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] = scaled[l] + scaled[s] - 1.0
+        if scaled[l]<1.0:
+            small.append(l)
+        else:
+            large.append(l)
+    return prob, alias
+
 class Profile2D:
     dt: Optional[float]
     values: dict[int,np.array]  # linkout->profile
@@ -23,7 +46,7 @@ class Profile2D:
         linkoutlist = list()
         for strid, v in splitjson.items():
             linkoutid = int(strid)
-            vals = np.array([float(s) for s in v.split(',')])
+            vals = np.array(parse_list(v,float))
             if linkoutid in self.values.keys():
                 print(f"Warning: Overwriting split profile")
             else:
@@ -55,19 +78,28 @@ class SplitMatrixProfile:
     linkin: Link
     dt: Optional[float]
     profile: Profile2D    # link out id -> split profile
+    rng: RandomStream
 
     # current status
     outlink2split: Link2Split   # out link id -> split
+    links: dict[int,Link]
+    alias_links: list[int]      # alias table for outlink2split, with dense link indices
+    alias_prob: list[float]
+    alias_index: list[int]
 
     def __init__(self,splitjson:dict[str,str],scenario:'Scenario') -> None:
         linkinid = int(splitjson['link_in'])
         self.dt = float(splitjson['dt']) if 'dt' in splitjson.keys() else None
         self.linkin = scenario.network.links[linkinid]
+        self.links = scenario.network.links
         # noinspection PyTypeChecker
         self.profile = Profile2D(splitjson['link_out_value'],self.dt)
+        self.rng = scenario.random_streams.get_stream(STREAM_SPLIT,linkinid)
 
     def set_all_current_splits(self, newsplit:Link2Split) -> None:
         self.outlink2split = newsplit
+        self.alias_links = [self.links[int(linkid)].index for linkid in newsplit[0]]
+        self.alias_prob, self.alias_index = build_alias_table(newsplit[1])
 
     def get_change_following(self,now:float) -> Optional[tuple[float,Link2Split]]:
 
@@ -80,9 +112,13 @@ class SplitMatrixProfile:
 
         return index*self.dt , self.profile.get_ith_value(index)
 
-    # return an output link id according to split ratios for this commodity and line
+    # return the dense index of an output link according to split ratios for this commodity and line
     def sample_output_link(self) -> int :
-        return np.random.choice(self.outlink2split[0], p=self.outlink2split[1])
+        x = self.rng.uniform() * len(self.alias_links)
+        i = int(x)
+        if x-i >= self.alias_prob[i]:
+            i = self.alias_index[i]
+        return self.alias_links[i]
 
     def register_next_change(self, dispatcher:Dispatcher, time:float, splitvalue:Link2Split) -> None:
         if splitvalue is not None:
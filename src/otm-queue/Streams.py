@@ -0,0 +1,139 @@
+from typing import Optional
+import numpy as np
+
+# stream kinds, used as the first element of the stream key
+STREAM_DEMAND = 0
+STREAM_LANEGROUP = 1
+STREAM_SPLIT = 2
+STREAM_LINK = 3
+
+class RandomStream:
+
+    # Buffered random variates for a single simulation component. Exponential and
+    # uniform variates come from separate generators, and both generators produce the
+    # same sequence whatever the buffer size, so results do not depend on how the
+    # buffers are chunked. Generators are created on first use, since most
+    # components of a large network never draw.
+
+    entropy: int
+    key: tuple[int,...]
+    exp_generator: Optional[np.random.Generator]
+    uni_generator: Optional[np.random.Generator]
+    exp_buffer: list[float]
+    exp_index: int
+    uni_buffer: list[float]
+    uni_index: int
+    buffer_size: int
+
+    # generator states before the buffers were drawn, so that checkpoints need not store the buffers
+    exp_buffer_state: Optional[dict]
+    uni_buffer_state: Optional[dict]
+
+    def __init__(self, entropy:int, key:tuple[int,...], buffer_size:int=1024) -> None:
+        self.entropy = entropy
+        self.key = key
+        self.exp_generator = None
+        self.uni_generator = None
+        self.buffer_size = buffer_size
+        self.exp_buffer = list()
+        self.exp_index = 0
+        self.uni_buffer = list()
+        self.uni_index = 0
+        self.exp_buffer_state = None
+        self.uni_buffer_state = None
+
+    def get_generator(self, i:int) -> np.random.Generator:
+        return np.random.default_rng(np.random.SeedSequence(self.entropy, spawn_key=self.key+(i,)))
+
+    # standard (rate 1) exponential variate
+    def exponential(self) -> float:
+        if self.exp_index>=len(self.exp_buffer):
+            if self.exp_generator is None:
+                self.exp_generator = self.get_generator(0)
+            self.exp_buffer_state = self.exp_generator.bit_generator.state
+            self.exp_buffer = self.exp_generator.standard_exponential(self.buffer_size).tolist()
+            self.exp_index = 0
+        x = self.exp_buffer[self.exp_index]
+        self.exp_index += 1
+        return x
+
+    # next n standard exponential variates, continuing the same sequence as exponential()
+    def exponentials(self, n:int) -> np.ndarray:
+        available = len(self.exp_buffer) - self.exp_index
+        if available>=n:
+            x = np.array(self.exp_buffer[self.exp_index:self.exp_index+n])
+            self.exp_index += n
+            return x
+        if self.exp_generator is None:
+            self.exp_generator = self.get_generator(0)
+        head = np.array(self.exp_buffer[self.exp_index:])
+        self.exp_index = len(self.exp_buffer)
+        return np.concatenate((head,self.exp_generator.standard_exponential(n-available)))
+
+    # uniform variate in [0,1)
+    def uniform(self) -> float:
+        if self.uni_index>=len(self.uni_buffer):
+            if self.uni_generator is None:
+                self.uni_generator = self.get_generator(1)
+            self.uni_buffer_state = self.uni_generator.bit_generator.state
+            self.uni_buffer = self.uni_generator.random(self.buffer_size).tolist()
+            self.uni_index = 0
+        x = self.uni_buffer[self.uni_index]
+        self.uni_index += 1
+        return x
+
+    # (generator state, buffer size, buffer index) for both generators, or None if the
+    # stream has not been used. The state is the one the buffer was drawn from, or the
+    # current one if the buffer is used up.
+    def get_state(self) -> Optional[tuple]:
+        if self.exp_generator is None and self.uni_generator is None:
+            return None
+        return (get_generator_state(self.exp_generator,self.exp_buffer_state,len(self.exp_buffer),self.exp_index) +
+                get_generator_state(self.uni_generator,self.uni_buffer_state,len(self.uni_buffer),self.uni_index))
+
+    def set_state(self, state:Optional[tuple]) -> None:
+        self.exp_generator = None
+        self.uni_generator = None
+        self.exp_buffer = list()
+        self.exp_index = 0
+        self.uni_buffer = list()
+        self.uni_index = 0
+        self.exp_buffer_state = None
+        self.uni_buffer_state = None
+        if state is None:
+            return
+        exp_state, exp_size, exp_index, uni_state, uni_size, uni_index = state
+        if exp_state is not None:
+            self.exp_generator = self.get_generator(0)
+            self.exp_generator.bit_generator.state = exp_state
+            self.exp_buffer_state = exp_state
+            self.exp_buffer = self.exp_generator.standard_exponential(exp_size).tolist()
+            self.exp_index = exp_index
+        if uni_state is not None:
+            self.uni_generator = self.get_generator(1)
+            self.uni_generator.bit_generator.state = uni_state
+            self.uni_buffer_state = uni_state
+            self.uni_buffer = self.uni_generator.random(uni_size).tolist()
+            self.uni_index = uni_index
+
+def get_generator_state(generator:Optional[np.random.Generator], buffer_state:Optional[dict],
+                        size:int, index:int) -> tuple[Optional[dict],int,int]:
+    if generator is None:
+        return None, 0, 0
+    if index>=size:
+        return generator.bit_generator.state, 0, 0
+    return buffer_state, size, index
+
+class RandomStreams:
+
+    # Factory of per-component streams. The stream for a key depends only on the
+    # scenario seed and the key, not on the order in which streams are created.
+
+    entropy: int
+
+    def __init__(self, random_seed:Optional[int]=None) -> None:
+        self.entropy = np.random.SeedSequence(random_seed).entropy
+
+    def get_stream(self, kind:int, *ids:int) -> RandomStream:
+        key = (kind,) + tuple(int(i) for i in ids)
+        return RandomStream(self.entropy, key)
@@ -0,0 +1,89 @@
+# Synthetic one-way grid of signalized intersections. Eastbound and southbound links
+# enter every intersection and the ones on the west and north boundaries are sources.
+# Returns the network, control and input json objects.
+def make_grid_scenario(rows:int, cols:int, demand_vph:float=600.0, length:float=200.0) -> tuple[dict,dict,dict]:
+
+    nodes = dict()
+    links = dict()
+    roadconnections = dict()
+    actuators = dict()
+    controllers = dict()
+    demands = list()
+    splits = list()
+
+    def add_node() -> int:
+        nodeid = len(nodes)
+        nodes[str(nodeid)] = {'x':None, 'y':None}
+        return nodeid
+
+    def add_link(start:int, end:int) -> int:
+        linkid = len(links)
+        links[str(linkid)] = {'full_lanes':'2', 'length':str(length), 'start':str(start), 'end':str(end), 'roadparam':'0'}
+        return linkid
+
+    def add_rc(in_link:int, out_link:int) -> int:
+        rcid = len(roadconnections)
+        roadconnections[str(rcid)] = {'in_link':str(in_link), 'out_link':str(out_link)}
+        return rcid
+
+    grid = [[add_node() for _ in range(cols)] for _ in range(rows)]
+
+    # eastbound links, west_in[i][j] enters node (i,j)
+    west_in = [[0]*cols for _ in range(rows)]
+    east_out = [[0]*cols for _ in range(rows)]
+    for i in range(rows):
+        source = add_node()
+        west_in[i][0] = add_link(source, grid[i][0])
+        demands.append({'link':str(west_in[i][0]), 'value':str(demand_vph)})
+        for j in range(cols):
+            end = grid[i][j+1] if j+1<cols else add_node()
+            east_out[i][j] = add_link(grid[i][j], end)
+            if j+1<cols:
+                west_in[i][j+1] = east_out[i][j]
+
+    # southbound links, north_in[i][j] enters node (i,j)
+    north_in = [[0]*cols for _ in range(rows)]
+    south_out = [[0]*cols for _ in range(rows)]
+    for j in range(cols):
+        source = add_node()
+        north_in[0][j] = add_link(source, grid[0][j])
+        demands.append({'link':str(north_in[0][j]), 'value':str(demand_vph)})
+        for i in range(rows):
+            end = grid[i+1][j] if i+1<rows else add_node()
+            south_out[i][j] = add_link(grid[i][j], end)
+            if i+1<rows:
+                north_in[i+1][j] = south_out[i][j]
+
+    # road connections, signals, and splits at every intersection
+    for i in range(rows):
+        for j in range(cols):
+            w, n, e, s = west_in[i][j], north_in[i][j], east_out[i][j], south_out[i][j]
+            ew = [add_rc(w,e), add_rc(w,s)]
+            ns = [add_rc(n,s), add_rc(n,e)]
+            actid = len(actuators)
+            actuators[str(actid)] = {
+                'type':'signal',
+                'target':{'type':'node', 'id':str(grid[i][j])},
+                'signal':[
+                    {'phase':'1', 'roadconnections':','.join(str(x) for x in ew)},
+                    {'phase':'2', 'roadconnections':','.join(str(x) for x in ns)}
+                ]
+            }
+            controllers[str(actid)] = {
+                'type':'sig_pretimed',
+                'target_actuators':str(actid),
+                'parameters':[{'name':'cycle', 'value':'60'}, {'name':'offset', 'value':str(5*(i+j) % 60)}],
+                'stages':[{'phases':'1', 'duration':'30'}, {'phases':'2', 'duration':'30'}]
+            }
+            splits.append({'node':str(grid[i][j]), 'link_in':str(w), 'link_out_value':{str(e):'0.7', str(s):'0.3'}})
+            splits.append({'node':str(grid[i][j]), 'link_in':str(n), 'link_out_value':{str(s):'0.7', str(e):'0.3'}})
+
+    network = {
+        'nodes':nodes,
+        'links':links,
+        'roadparams':{'0':{'capacity':'1800', 'speed':'50', 'jam_density':'100'}},
+        'roadconnections':roadconnections
+    }
+    control = {'actuators':actuators, 'controllers':controllers}
+    inputs = {'demands':demands, 'splits':splits}
+    return network, control, inputs
@@ -0,0 +1,133 @@
+from typing import TYPE_CHECKING, Iterable
+import numpy as np
+
+if TYPE_CHECKING:
+    from core import Network
+    from Demand import Demand
+
+# Dense arrays of a network for the engines that count vehicles instead of queueing them
+# (see Batched.py and Fluid.py). The vehicles of a lane group are counted per slot, the
+# position of their next link among the out links of the end node of the link (slot 0
+# for the sinks), so that quantities per (lane group, slot) are arrays of shape
+# (lane groups, slots, ...) and can be flattened to (lane groups * slots, ...).
+
+# x summed over its second axis, the slots. Faster than x.sum(axis=1) for so few slots.
+def sum_slots(x:np.ndarray) -> np.ndarray:
+    total = x[:,0].copy()
+    for s in range(1,x.shape[1]):
+        total += x[:,s]
+    return total
+
+class SlotTopology:
+
+    links: list                         # dense link index -> link
+    num_slots: int                      # most out links of a link, at least 1
+    lg_link: np.ndarray                 # lane group -> dense link index
+    link_lgs: np.ndarray                # (links, most lane groups of a link) lane group indices, -1 padded
+    slot_link: np.ndarray               # flat (lane group, slot) -> dense index of the next link, -1 for none
+    slot_order: np.ndarray              # flat (lane group, slot) indices with a next link, sorted by it
+    slot_starts: np.ndarray             # start of each run of slot_order with the same next link
+    slot_links: np.ndarray              # next link of each run
+    max_vehicles: np.ndarray            # 0 for the sources, which are only entered by demands
+    nom_rate_vps: np.ndarray            # saturation flow rates
+    transit_time_sec: np.ndarray
+    sink_lgs: np.ndarray
+
+    # routing. split[l,s] is the probability of going from link l to slot s: that of the
+    # split profile of the link, otherwise uniform over the out links
+    split: np.ndarray
+    split_links: list                   # (link index, SplitMatrixProfile, slot of each out link)
+    split_index: list[int]              # profile index in effect, per split
+    demands: list                       # (Demand, lane group of each slot)
+
+    def __init__(self, network:'Network') -> None:
+
+        links = network.linklist
+        N = network.num_lgs
+        self.num_slots = max([1]+[len(link.outlink_indices) for link in links])
+        K = self.num_slots
+        self.lg_link = np.array([lg.link.index for lg in network.lanegroups],dtype=np.int64)
+        most_lgs = max(len(link.lgs) for link in links)
+        self.link_lgs = np.full((len(links),most_lgs),-1,dtype=np.int64)
+        for link in links:
+            self.link_lgs[link.index,:len(link.lgs)] = [lg.index for lg in link.lgs]
+        slot_link = np.full((N,K),-1,dtype=np.int64)
+        for lg in network.lanegroups:
+            outlinks = lg.link.outlink_indices
+            slot_link[lg.index,:len(outlinks)] = outlinks
+        self.slot_link = slot_link.ravel()
+        order = np.argsort(self.slot_link,kind='stable')
+        self.slot_order = order[self.slot_link[order]>=0]
+        sorted_links = self.slot_link[self.slot_order]
+        self.slot_starts = np.nonzero(np.diff(sorted_links,prepend=-1))[0]
+        self.slot_links = sorted_links[self.slot_starts]
+
+        self.max_vehicles = np.array([0.0 if lg.link.is_source else lg.max_vehicles for lg in network.lanegroups])
+        self.nom_rate_vps = np.array([lg.nom_saturation_flow_rate_vps for lg in network.lanegroups])
+        self.transit_time_sec = np.array([lg.transit_time_sec for lg in network.lanegroups])
+        self.sink_lgs = np.array([lg.index for lg in network.lanegroups if lg.link.is_sink],dtype=np.int64)
+
+        self.links = links
+        self.set_inputs(list())
+
+    # Read the split profiles of the links and the given demands
+    def set_inputs(self, demands:Iterable['Demand']) -> None:
+        K = self.num_slots
+        self.split = np.zeros((len(self.links),K))
+        self.split_links = list()
+        for link in self.links:
+            n = len(link.outlink_indices)
+            if n==0:
+                self.split[link.index,0] = 1.0
+            else:
+                self.split[link.index,:n] = 1.0/n
+            if link.split_profile is not None:
+                slots = [link.outlink_ids.index(int(linkid)) for linkid in link.split_profile.profile.linksout]
+                self.split_links.append((link.index,link.split_profile,np.array(slots,dtype=np.int64)))
+        self.split_index = [-1] * len(self.split_links)
+
+        # demands join the first lane group for the next link, as in Link.add_vehicle
+        self.demands = list()
+        for demand in demands:
+            link = demand.link
+            nexts = link.outlink_indices if len(link.outlink_indices)>0 else [None]
+            slot_lgs = np.zeros(K,dtype=np.int64)
+            for s, next_link in enumerate(nexts):
+                if len(link.nextlink2mylgs)==0 or next_link in link.nextlink2mylgs:
+                    slot_lgs[s] = link.get_lanegroups_for_nextlink(next_link)[0].index
+                else:
+                    slot_lgs[s] = link.lgs[0].index     # not reachable, has no split
+            self.demands.append((demand,slot_lgs))
+
+    def get_slot(self, lg, next_link:int) -> int:
+        outlinks = lg.link.outlink_indices
+        return outlinks.index(next_link) if next_link in outlinks else 0
+
+    def update_splits(self, time:float) -> None:
+        for i, (linkindex, smp, slots) in enumerate(self.split_links):
+            dt = smp.profile.dt
+            index = 0 if (dt is None or dt==0) else min(int(time/dt),smp.profile.num_times-1)
+            if index==self.split_index[i]:
+                continue
+            self.split_index[i] = index
+            linksout, values = smp.profile.get_ith_value(index)
+            self.split[linkindex,:] = 0.0
+            self.split[linkindex,slots] = values / values.sum()
+
+    # demand of a link at a time [vps]
+    def get_demand_vps(self, demand:'Demand', time:float) -> float:
+        index = 0 if demand.dt is None else min(int(time/demand.dt),demand.profile.shape[0]-1)
+        return demand.profile[index] / 3600.0
+
+    # (links, most lane groups of a link, ...) values of the lane groups of each link, 0 padded
+    def get_link_lg_values(self, x:np.ndarray) -> np.ndarray:
+        lgs = self.link_lgs
+        mask = (lgs>=0).reshape(lgs.shape + (1,)*(x.ndim-1))
+        return np.where(mask, x[np.maximum(lgs,0)], 0)
+
+    # x (lane groups * slots, ...) summed by next link -> (links, ...)
+    def sum_by_next_link(self, x:np.ndarray) -> np.ndarray:
+        total = np.zeros((self.link_lgs.shape[0],)+x.shape[1:],dtype=x.dtype)
+        if self.slot_order.shape[0]>0:
+            total[self.slot_links] = np.add.reduceat(x[self.slot_order],self.slot_starts,axis=0)
+        return total
@@ -1,34 +1,26 @@
 from static import get_vehicle_id
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Optional
 
 if TYPE_CHECKING:
-    from LaneGroup import VehicleQueue
+    from LaneGroup import VehicleQueue, LaneGroup
 
+# Vehicle objects are only created for lane groups with per-vehicle output.
+# Queues otherwise store vehicles as entry times and next link indices.
 class Vehicle:
+    __slots__ = ('id','next_link','my_queue','lg')
 
     id:int
-    next_link_id:int
+    next_link:int           # dense index of the next link, -1 for none
     my_queue:'VehicleQueue'
     lg:'LaneGroup'
 
-    def __init__(self) -> None :
-        self.id = get_vehicle_id()
-        self.next_link_id = -1
+    def __init__(self, vehid:Optional[int]=None) -> None :
+        self.id = get_vehicle_id() if vehid is None else vehid
+        self.next_link = -1
         self.my_queue = None
         self.lg = None
-        self.release_event = None
 
+    # the lane group takes care of the queues, the vehicle only keeps track of its position
     def move_to_queue(self,to_lg:'LaneGroup',to_queue:'VehicleQueue') -> None:
-
-        from_queue = self.my_queue
-
-        # remove vehicle from its current queue
-        if from_queue is not None:
-            from_queue.remove_lead_vehicle()
-
-        # add to the to_queue
-        to_queue.add_vehicle(self)
-
-        # update vehicle queue
         self.my_queue = to_queue
         self.lg = to_lg
\ No newline at end of file
@@ -1,20 +1,29 @@
 from abc import ABC, abstractmethod
-from typing import TYPE_CHECKING,Optional, Any
+from typing import TYPE_CHECKING,Optional, Any, TextIO
+import numpy as np
 if TYPE_CHECKING:
     from core import Scenario
     from Events import Dispatcher
     from Output import OutputControllerEvents
 
 class AbstractEvent(ABC):
+    __slots__ = ('dispatcher','dispatch_order','timestamp','recipient','cancelled','pending')
     timestamp: float
     dispatch_order: int
     recipient: Any
+    cancelled: bool     # cancelled events are dropped when popped from the dispatcher
+    pending: bool       # the event is in the dispatcher
+
+    # recycle instances through the dispatcher's free list (see Dispatcher.acquire_event)
+    pooled = False
 
     def __init__(self, dispatcher, dispatch_order: int, timestamp: float, recipient: Any) -> None:
         self.dispatcher = dispatcher
         self.dispatch_order = dispatch_order
         self.timestamp = timestamp
         self.recipient = recipient
+        self.cancelled = False
+        self.pending = False
 
     @abstractmethod
     def action(self) -> None:
@@ -38,7 +47,39 @@ class AbstractEvent(ABC):
             self.recipient
         )
 
+# the event is in the scheduler of the given dispatcher
+def is_pending(event:Optional[AbstractEvent], dispatcher:'Dispatcher') -> bool:
+    return (event is not None) and event.pending and (event.dispatcher is dispatcher)
+
+# A scheduler entry is (timestamp, dispatch_order, insertion sequence, event)
+SchedulerEntry = tuple[float,int,int,AbstractEvent]
+
+class AbstractScheduler(ABC):
+
+    # insert an entry
+    @abstractmethod
+    def push(self, entry:SchedulerEntry) -> None: pass
+
+    # remove and return the smallest entry
+    @abstractmethod
+    def pop(self) -> SchedulerEntry: pass
+
+    # drop all entries whose event has been cancelled
+    @abstractmethod
+    def remove_cancelled(self) -> None: pass
+
+    @abstractmethod
+    def clear(self) -> None: pass
+
+    @abstractmethod
+    def __len__(self) -> int: pass
+
+    # iterate over all entries, in no particular order
+    @abstractmethod
+    def __iter__(self): pass
+
 class EventPoke(AbstractEvent):
+    __slots__ = ()
 
     def __init__(self,dispatcher, dispatch_order:int, timestamp:float, recipient) -> None:
         super().__init__(dispatcher, dispatch_order, timestamp, recipient)
@@ -46,6 +87,21 @@ class EventPoke(AbstractEvent):
     def action(self):
         self.recipient.poke(self.dispatcher,self.timestamp)
 
+# A poke that re-inserts itself every period. It is re-registered before the recipient
+# is poked, so the recipient sees it as pending and may cancel it.
+class EventPeriodicPoke(AbstractEvent):
+    __slots__ = ('period',)
+    period: float
+
+    def __init__(self,dispatcher, dispatch_order:int, timestamp:float, recipient, period:float) -> None:
+        super().__init__(dispatcher, dispatch_order, timestamp, recipient)
+        self.period = period
+
+    def action(self):
+        timestamp = self.timestamp
+        self.dispatcher.reschedule_event(self,timestamp + self.period)
+        self.recipient.poke(self.dispatcher,timestamp)
+
 class AbstractCommand(ABC):
     pass
 
@@ -56,6 +112,7 @@ class AbstractActuator(ABC):
     dt:Optional[float]     # dt<=0 means event based (vehicle model) or dt=sim dt (fluid model)
     target:Any
     command:Optional[AbstractCommand]
+    poke_event:Optional[EventPeriodicPoke]
 
     @abstractmethod
     def process_command(self, timestamp: float,dispatcher:'Dispatcher') -> None: pass
@@ -69,6 +126,7 @@ class AbstractActuator(ABC):
         self.type = jsonact['type']
         self.dt = float(jsonact['dt']) if 'dt' in jsonact.keys() else None
         self.command = None
+        self.poke_event = None
 
         jsontarget = jsonact['target']
 
@@ -84,9 +142,9 @@ class AbstractActuator(ABC):
         # process the command
         self.process_command(timestamp,dispatcher)
 
-        # wake up in dt, if dt is defined
-        if self.dt is not None:
-            dispatcher.register_event(EventPoke(dispatcher,3,timestamp+self.dt,self))
+        # wake up every dt, if dt is defined
+        if self.dt is not None and not is_pending(self.poke_event,dispatcher):
+            self.poke_event = dispatcher.register_event(EventPeriodicPoke(dispatcher,3,timestamp+self.dt,self,self.dt))
 
 class AbstractController(ABC):
     id:int
@@ -95,6 +153,7 @@ class AbstractController(ABC):
     command:dict[int, Optional[AbstractCommand]] # actuator id -> command
     dt:Optional[float]
     event_writer:Optional['OutputControllerEvents']
+    poke_event:Optional[EventPeriodicPoke]
 
     @abstractmethod
     def update_command(self, dispatcher) -> None: pass
@@ -104,7 +163,7 @@ class AbstractController(ABC):
 
     def write_event(self,timestamp:float,val:str) -> None:
         if self.event_writer is not None:
-            self.event_writer.file.write('{},{},{}\n'.format(timestamp,self.id,val))
+            self.event_writer.write_row([timestamp,self.id,val])
 
     def __init__(self,id:int,jsoncntrl,acts:dict[int,AbstractActuator]):
         self.id = id
@@ -113,6 +172,7 @@ class AbstractController(ABC):
         self.dt = None if 'dt' not in jsoncntrl.keys() else float(jsoncntrl['dt'])
         self.type = jsoncntrl['type']
         self.event_writer = None
+        self.poke_event = None
 
     def add_acuator(self,act:AbstractActuator):
         self.actuators[act.id] = act
@@ -121,6 +181,10 @@ class AbstractController(ABC):
         if self.event_writer is None:
             self.event_writer = x
 
+    # whether the controller has been poked and will wake up again in this dispatcher
+    def is_started(self, dispatcher) -> bool:
+        return is_pending(self.poke_event,dispatcher)
+
     def poke(self,dispatcher, timestamp:float ) -> None:
 
         self.update_command(dispatcher)
@@ -131,14 +195,34 @@ class AbstractController(ABC):
             if act.dt is None:
                 act.poke(dispatcher,timestamp)
 
-        # wake up in dt, if dt is defined
-        if (self.dt is not None) and (self.dt > 0):
-            dispatcher.register_event(EventPoke(dispatcher, 20, timestamp + self.dt, self))
+        # wake up every dt, if dt is defined
+        if (self.dt is not None) and (self.dt > 0) and not is_pending(self.poke_event,dispatcher):
+            self.poke_event = dispatcher.register_event(EventPeriodicPoke(dispatcher, 20, timestamp + self.dt, self, self.dt))
+
+class AbstractSink(ABC):
+
+    # storage for the records of a timed output: a timestamp and one value per column
+
+    @abstractmethod
+    def open(self, columns:list[str]) -> None: pass
+
+    @abstractmethod
+    def write(self, timestamp:float, values) -> None: pass
+
+    @abstractmethod
+    def close(self) -> None: pass
+
+    # (column names, one row per record with the time first), or None if the records
+    # are not kept in memory
+    def get_data(self) -> Optional[tuple[list[str],np.ndarray]]:
+        return None
 
 class AbstractOutput(ABC):
 
     scenario : 'Scenario'
     mytype : str
+    file : Optional[TextIO]
+    rows : Optional[list[list]]     # kept in memory when there is no output folder
 
     @abstractmethod
     def get_name(self) -> str: pass
@@ -150,34 +234,56 @@ class AbstractOutput(ABC):
         self.scenario = scenario
         self.mytype = request['type']
         self.file = None
+        self.rows = None
 
-    def open_output_file(self, dispatcher: 'Dispatcher', folder_prefix:str) -> None:
-        self.file = open(f"{folder_prefix}_{self.get_name()}.csv", 'w')
-        self.file.write(self.get_header()+'\n')
+    # folder_prefix=None keeps the output in memory
+    def open_output_file(self, dispatcher: 'Dispatcher', folder_prefix:Optional[str]) -> None:
+        if folder_prefix is None:
+            self.rows = list()
+        else:
+            self.file = open(f"{folder_prefix}_{self.get_name()}.csv", 'w')
+            self.file.write(self.get_header()+'\n')
+
+    def write_row(self,row:list) -> None:
+        if self.file is not None:
+            self.file.write(','.join([str(x) for x in row])+'\n')
+        else:
+            self.rows.append(row)
+
+    def get_columns(self) -> list[str]:
+        return self.get_header().split(',')
 
     def close(self) -> None:
-        self.file.close()
+        if self.file is not None:
+            self.file.close()
 
 class AbstractOutputTimed(AbstractOutput, ABC):
     dt:float
+    sink_type:Optional[str]     # 'csv', 'memory', 'npz' or 'mmap'. See Sinks.make_sink
+    sink_dtype:Optional[str]    # value type of the 'mmap' sink
+    sink:Optional[AbstractSink] # set by the scenario before the output is opened
 
     @abstractmethod
-    def get_str(self) -> str: pass
+    def get_values(self) -> np.ndarray: pass
 
     def __init__(self,scenario:'Scenario',request:dict[str,str]) -> None:
         super().__init__(scenario,request)
         self.dt = float(request['dt'])
+        self.sink_type = request.get('sink')
+        self.sink_dtype = request.get('dtype')
+        self.sink = None
 
     def open_output_file(self, dispatcher, folder_prefix) -> None:
-        super().open_output_file(dispatcher, folder_prefix)
-        dispatcher.register_event(EventPoke(dispatcher,
-                                            dispatch_order=70,
-                                            timestamp=0.0,
-                                            recipient=self))
+        self.sink.open(self.get_columns())
+        dispatcher.register_event(EventPeriodicPoke(dispatcher,
+                                                    dispatch_order=70,
+                                                    timestamp=0.0,
+                                                    recipient=self,
+                                                    period=self.dt))
 
     def poke(self,dispatcher:'Dispatcher', timestamp:float) -> None:
-        self.file.write('{},{}\n'.format(timestamp,self.get_str()))
-        dispatcher.register_event(EventPoke(dispatcher,
-                                            dispatch_order=70,
-                                            timestamp=timestamp + self.dt,
-                                            recipient=self))
+        self.sink.write(timestamp,self.get_values())
+
+    def close(self) -> None:
+        if self.sink is not None:
+            self.sink.close()
@@ -0,0 +1,228 @@
+import gc
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from core import Scenario
+from abstract import EventPoke
+from Events import Dispatcher, EventSeviceLanegroupWaitingQueue
+from Scheduler import get_scheduler
+from LaneGroup import VehicleQueue
+from Vehicle import Vehicle
+from Replication import ReplicationRunner
+from Synthetic import make_grid_scenario
+
+def write_scenario_files(folder:str, network:dict, control:dict, inputs:dict) -> tuple[str,str,str]:
+    files = list()
+    for name, obj in [('network',network), ('control',control), ('input',inputs)]:
+        filename = os.path.join(folder,f"{name}.json")
+        with open(filename,'w') as f:
+            json.dump(obj,f)
+        files.append(filename)
+    return files[0], files[1], files[2]
+
+class NullRecipient:
+    def poke(self, dispatcher, timestamp:float) -> None:
+        pass
+
+# Classic hold model: keep num_events pending, repeatedly pop one and push it back
+# at an exponentially distributed time in the future.
+def benchmark_scheduler_hold(num_events:int, num_holds:int, seed:int=0) -> dict[str,float]:
+    result = dict()
+    for name in ['heap','calendar']:
+        rng = np.random.default_rng(seed)
+        increments = rng.exponential(1.0,num_holds)
+        dispatcher = Dispatcher(get_scheduler(name))
+        scheduler = dispatcher.scheduler
+        recipient = NullRecipient()
+        for t in rng.exponential(1.0,num_events):
+            dispatcher.register_event(EventPoke(dispatcher,0,float(t),recipient))
+        start = time.perf_counter()
+        for k in range(num_holds):
+            entry = scheduler.pop()
+            event = entry[3]
+            event.timestamp = entry[0] + increments[k]
+            dispatcher.register_event(event)
+        result[name] = time.perf_counter() - start
+    return result
+
+def benchmark_scheduler_network(rows:int, cols:int, duration:float, seed:int=0) -> dict[str,float]:
+    result = dict()
+    network, control, inputs = make_grid_scenario(rows,cols)
+    with tempfile.TemporaryDirectory() as folder:
+        network_file, control_file, _ = write_scenario_files(folder,network,control,inputs)
+        for name in ['heap','calendar']:
+            scenario = Scenario(network_file,control_file,random_seed=seed,scheduler=name)
+            scenario.set_state_and_inputs(demands=inputs['demands'],splits=inputs['splits'])
+            start = time.perf_counter()
+            scenario.advance(duration)
+            result[name] = time.perf_counter() - start
+    return result
+
+def measure_bytes(build) -> tuple[int,object]:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    obj = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, obj
+
+# Bytes per vehicle in a compact queue and as a materialized Vehicle object, and per
+# pending event in the dispatcher.
+def benchmark_memory(n:int=100000) -> dict[str,float]:
+    result = dict()
+
+    def build_queue():
+        queue = VehicleQueue('transit')
+        for k in range(n):
+            queue.add_vehicle(float(k),k%4)
+        return queue
+    nbytes, _ = measure_bytes(build_queue)
+    result['compact vehicle'] = nbytes / n
+
+    def build_vehicles():
+        vehicles = list()
+        for k in range(n):
+            v = Vehicle()
+            v.next_link = k%4
+            vehicles.append(v)
+        return vehicles
+    nbytes, _ = measure_bytes(build_vehicles)
+    result['Vehicle object'] = nbytes / n
+
+    def build_events():
+        dispatcher = Dispatcher()
+        recipient = NullRecipient()
+        for k in range(n):
+            dispatcher.register_event(EventSeviceLanegroupWaitingQueue(dispatcher,float(k),recipient))
+        return dispatcher
+    nbytes, _ = measure_bytes(build_events)
+    result['pending event'] = nbytes / n
+
+    return result
+
+class GCCounter:
+
+    # counts garbage collections per generation and the time spent in them
+
+    def __init__(self) -> None:
+        self.collections = [0,0,0]
+        self.pause = 0.0
+        self.start = 0.0
+
+    def callback(self, phase:str, info:dict) -> None:
+        if phase=='start':
+            self.start = time.perf_counter()
+        else:
+            self.pause += time.perf_counter() - self.start
+            self.collections[info['generation']] += 1
+
+    def __enter__(self):
+        gc.collect()
+        gc.callbacks.append(self.callback)
+        return self
+
+    def __exit__(self, *args) -> None:
+        gc.callbacks.remove(self.callback)
+
+# Garbage collections, GC pause, and allocated memory blocks during a grid run, with and
+# without event pooling.
+def benchmark_allocations(rows:int, cols:int, duration:float, seed:int=0) -> dict[str,dict]:
+    result = dict()
+    network, control, inputs = make_grid_scenario(rows,cols)
+    with tempfile.TemporaryDirectory() as folder:
+        network_file, control_file, _ = write_scenario_files(folder,network,control,inputs)
+        for pool_events in [False, True]:
+            scenario = Scenario(network_file,control_file,random_seed=seed)
+            scenario.dispatcher.pool_events = pool_events
+            scenario.set_state_and_inputs(demands=inputs['demands'],splits=inputs['splits'])
+            tracemalloc.start()
+            with GCCounter() as counter:
+                start = time.perf_counter()
+                scenario.advance(duration)
+                elapsed = time.perf_counter() - start
+            allocated = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            result['pooled' if pool_events else 'not pooled'] = {
+                'time':elapsed,
+                'collections':counter.collections,
+                'gc pause':counter.pause,
+                'peak bytes':allocated
+            }
+    return result
+
+# Time to build the scenario of a signalized grid from json files, and from its compiled
+# file, for each grid size. Returns size -> (links, road connections, json seconds,
+# compiled seconds)
+def benchmark_load(sizes:list[int]) -> dict[int,tuple[int,int,float,float]]:
+    result = dict()
+    for n in sizes:
+        network, control, inputs = make_grid_scenario(n,n)
+        with tempfile.TemporaryDirectory() as folder:
+            network_file, control_file, _ = write_scenario_files(folder,network,control,inputs)
+            start = time.perf_counter()
+            Scenario(network_file,control_file)
+            json_time = time.perf_counter() - start
+            Scenario(network_file,control_file,cache_folder=folder)
+            start = time.perf_counter()
+            Scenario(network_file,control_file,cache_folder=folder)
+            compiled_time = time.perf_counter() - start
+        result[n] = (len(network['links']), len(network['roadconnections']), json_time, compiled_time)
+    return result
+
+# Wall time of a grid run with per-second link and lane group outputs, for each sink
+def benchmark_outputs(rows:int, cols:int, duration:float, seed:int=0) -> dict[str,float]:
+    result = dict()
+    network, control, inputs = make_grid_scenario(rows,cols)
+    with tempfile.TemporaryDirectory() as folder:
+        for sink in ['csv','memory','npz']:
+            output_requests = [{'type':'link_veh', 'dt':'1', 'sink':sink},
+                               {'type':'lg_flw', 'dt':'1', 'sink':sink}]
+            scenario = Scenario(network,control,output_requests=output_requests,output_folder=folder,
+                                prefix=sink,random_seed=seed)
+            scenario.set_state_and_inputs(demands=inputs['demands'],splits=inputs['splits'])
+            start = time.perf_counter()
+            scenario.advance(duration)
+            scenario.close_outputs()
+            result[sink] = time.perf_counter() - start
+    return result
+
+# Wall time of the same set of replications with increasing numbers of workers
+def benchmark_replications(rows:int, cols:int, duration:float, num_seeds:int, workers:list[int]) -> dict[int,float]:
+    result = dict()
+    network, control, inputs = make_grid_scenario(rows,cols)
+    output_requests = [{'type':'link_veh', 'dt':'60'}]
+    for max_workers in workers:
+        runner = ReplicationRunner(network, control, inputs, output_requests, max_workers=max_workers)
+        start = time.perf_counter()
+        runner.run(list(range(num_seeds)),duration)
+        result[max_workers] = time.perf_counter() - start
+    return result
+
+if __name__ == '__main__':
+
+    for n, (num_links, num_rcs, t, tc) in benchmark_load([25,50,100,160]).items():
+        print(f"load, {n}x{n} grid, {num_links} links, {num_rcs} road connections: json {t:.2f}s, compiled {tc:.2f}s")
+
+    r = benchmark_outputs(10,10,1800.0)
+    print("outputs, 1 sec: " + ', '.join(f"{k} {v:.2f}s" for k,v in r.items()))
+
+    r = benchmark_replications(5,5,1800.0,16,[1,2,4,os.cpu_count()])
+    print("replications, 16 seeds: " + ', '.join(f"{k} workers {v:.2f}s" for k,v in r.items()))
+
+    for k,v in benchmark_allocations(10,10,1800.0).items():
+        print(f"allocations, {k}: time {v['time']:.2f}s, gc collections {v['collections']}, "
+              f"gc pause {v['gc pause']*1000:.1f}ms, peak {v['peak bytes']/1e6:.1f}MB")
+
+    for k,v in benchmark_memory().items():
+        print(f"memory, {k}: {v:.0f} bytes")
+
+    for num_events in [1000, 100000]:
+        r = benchmark_scheduler_hold(num_events,200000)
+        print(f"hold model, {num_events} events: " + ', '.join(f"{k} {v:.2f}s" for k,v in r.items()))
+
+    for n in [5, 15]:
+        r = benchmark_scheduler_network(n,n,1800.0)
+        print(f"grid {n}x{n}, 1800 sec: " + ', '.join(f"{k} {v:.2f}s" for k,v in r.items()))
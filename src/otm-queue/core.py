@@ -1,19 +1,48 @@
-from typing import TYPE_CHECKING, Optional
+from typing import TYPE_CHECKING, Optional, Union
 import json
+import gc
+from contextlib import contextmanager
 from SimpleClasses import RoadConnection
 from Link import Link
 from Demand import Demand
 from Splits import SplitMatrixProfile
 from Signal import ActuatorSignal
 from Controller import ControllerStage
-from LaneGroup import LaneGroup
+from LaneGroup import LaneGroup, LaneGroupCounters
 import numpy as np
 from Events import Dispatcher, EventDemandChange, EventSplitChange
+from Scheduler import get_scheduler
+from static import parse_list
+import static
+from Streams import RandomStreams, STREAM_LANEGROUP, STREAM_LINK
 from Output import *
+from Sinks import make_sink, to_dataframe
+from Checkpoint import get_state, set_state, to_blob, from_blob
+from Fluid import FluidModel
+from Compiled import get_content_hash, get_cache_file, load_compiled, save_compiled, compile_scenario, decompile_scenario
 import os
 if TYPE_CHECKING:
     from abstract import *
 
+# json objects may be given as file names or already parsed
+def read_json(x:Union[str,dict]) -> dict:
+    if isinstance(x,dict):
+        return x
+    with open(x) as f:
+        return json.load(f)
+
+# Building a large network allocates many long lived objects, and the collections
+# triggered along the way find nothing to free
+@contextmanager
+def paused_gc():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
 class Node:
     id: int
     in_links: dict[int,"Link"]
@@ -44,9 +73,17 @@ class Network:
     nodes: dict[int,Node]
     links: dict[int,"Link"]
     roadconn: dict[int,RoadConnection]
+    link2outrcs: dict[int,list[RoadConnection]]    # link id -> road connections leaving it
+    rc2inlgs: dict[int,list['LaneGroup']]          # road connection id -> lane groups it leaves from
     num_lgs: int
+    linklist: list['Link']              # dense link index -> link
+    lanegroups: list['LaneGroup']       # dense lane group index -> lane group, contiguous per link
+    lgs_by_link: list[list['LaneGroup']]    # dense link index -> lane groups
+    counters: LaneGroupCounters
 
-    def __init__(self,netjson:dict[str,dict]) -> None:
+    # layout optionally gives the lane groups of each link, link id -> [(start lane, number of
+    # lanes)], instead of deriving them from the road connections (see Compiled.py)
+    def __init__(self,netjson:dict[str,dict],layout:Optional[dict[int,list[tuple[int,int]]]]=None) -> None:
 
         # read road parameters
         roadparams:dict = dict()
@@ -85,15 +122,20 @@ class Network:
                 for link in node.in_links.values():
                     link.is_sink = True
 
+            outlink_ids = list(node.out_links.keys())
+            for link in node.in_links.values():
+                link.outlink_ids = outlink_ids
+
         # read road connections
         self.roadconn = dict()
+        self.link2outrcs = {linkid:list() for linkid in self.links.keys()}
         for strid, roadconnjson in netjson['roadconnections'].items():
 
             in_link_id = int(roadconnjson['in_link'])
             in_link = self.links[in_link_id]
 
             if 'in_link_lanes' in roadconnjson.keys():
-                x = [int(s) for s in roadconnjson['in_link_lanes'].split('-')]
+                x = parse_list(roadconnjson['in_link_lanes'],int,'-')
                 in_link_lanes = (x[0],x[1])
             else:
                 in_link_lanes = (1,in_link.full_lanes)
@@ -105,13 +147,20 @@ class Network:
                 out_link=int(roadconnjson['out_link']))
 
             self.roadconn[rc.id] = rc
+            self.link2outrcs[in_link_id].append(rc)
 
         # Create lane groups .....................................
         self.num_lgs = 0
         for link in self.links.values():
 
-            # collect outgoing road connections
-            out_rcs = [rc for rc in self.roadconn.values() if rc.in_link==link.id]
+            if layout is not None:
+                link.lgs = [LaneGroup(link=link, num_lanes=num_lanes, start_lane=start_lane, rp=link.roadparam)
+                            for start_lane, num_lanes in layout[link.id]]
+                self.num_lgs += len(link.lgs)
+                continue
+
+            # outgoing road connections
+            out_rcs = self.link2outrcs[link.id]
 
             # create set of all intersections of out_rcs up lanes
             lane_sets:set[tuple[int,int]] = set()
@@ -152,6 +201,38 @@ class Network:
             link.lgs = lanegroups
             self.num_lgs += len(lanegroups)
 
+        # dense link and lane group indices, and counters
+        self.linklist = list(self.links.values())
+        for index, link in enumerate(self.linklist):
+            link.index = index
+        for link in self.linklist:
+            link.outlink_indices = [self.links[linkid].index for linkid in link.outlink_ids]
+        self.lanegroups = [lg for link in self.linklist for lg in link.lgs]
+        self.lgs_by_link = [link.lgs for link in self.linklist]
+        self.counters = LaneGroupCounters(self.num_lgs)
+        for index, lg in enumerate(self.lanegroups):
+            lg.set_index(index,self.counters,self.lgs_by_link)
+
+        # make road connection to incoming lanegroup map
+        self.rc2inlgs = dict()
+        for rc in self.roadconn.values():
+            in_link = self.links[rc.in_link]
+            lanes = rc.in_link_lanes
+            self.rc2inlgs[rc.id] = [lg for lg in in_link.lgs if
+                                    (lg.start_lane >= lanes[0]) and
+                                    (lg.start_lane+lg.num_lanes -1 <= lanes[1]) ]
+
+        # populate link.nextlink2mylgs
+        for link in self.linklist:
+            if not link.is_sink:
+                exiting_rcs = self.link2outrcs[link.id]
+                if len(exiting_rcs)==0:
+                    for nextlink in link.endnode.out_links.values():
+                        link.nextlink2mylgs[nextlink.index] = link.lgs
+                else:
+                    for rc in exiting_rcs:
+                        link.nextlink2mylgs[self.links[rc.out_link].index]  = self.rc2inlgs[rc.id]
+
 class Scenario:
     dispatcher : "Dispatcher"
     network : Network
@@ -159,75 +240,106 @@ class Scenario:
     actuators : dict[int,"AbstractActuator"]       # TODO WHY?
     demands : dict[int,'Demand']
     outputs : list['AbstractOutput']
-    folder_prefix : str
+    folder_prefix : Optional[str]       # None keeps outputs in memory
+    scheduler_name : Optional[str]
+    random_streams : RandomStreams
+    engine : str                        # 'event' or 'fluid'
+    fluid : Optional[FluidModel]        # the model of the fluid engine
+
+    # construction arguments, to build copies of the scenario in other processes
+    network_file : Union[str,dict]
+    control_file : Union[str,dict]
+    output_requests : Optional[list[dict[str,str]]]
+    cache_folder : Optional[str]
+    hybrid_threshold : Optional[int]
+    hybrid_dt : float
 
     def __init__(self,
-         network_file:str,
-         control_file:str,
+         network_file:Union[str,dict],
+         control_file:Union[str,dict],
          output_requests: Optional[list[dict[str, str]]] = None,
          output_folder: Optional[str] = None,
          prefix: Optional[str] = None,
          check: Optional[bool] = False,
-         random_seed: Optional[int] = None
+         random_seed: Optional[int] = None,
+         scheduler: Optional[str] = None,
+         cache_folder: Optional[str] = None,
+         engine: Optional[str] = None,
+         fluid_dt: float = 1.0,
+         hybrid_threshold: Optional[int] = None,
+         hybrid_dt: float = 1.0
     ) -> None:
 
-        if random_seed is not None:
-            np.random.seed(random_seed)
-
-        # read network
-        with open(network_file) as f:
-            jsonobj = json.load(f)
-        self.network = Network(jsonobj)
+        self.network_file = network_file
+        self.control_file = control_file
+        self.output_requests = output_requests
+        self.cache_folder = cache_folder
+        self.hybrid_threshold = hybrid_threshold
+        self.hybrid_dt = hybrid_dt
+
+        # with a cache folder, the network and control are compiled on first use and loaded
+        # from the compiled file afterwards
+        compiled = None
+        if cache_folder is not None:
+            cache_file = get_cache_file(cache_folder,'scenario',get_content_hash(network_file,control_file))
+            if os.path.exists(cache_file):
+                compiled = load_compiled(cache_file)
+
+        with paused_gc():
+
+            # read network
+            if compiled is None:
+                self.network = Network(read_json(network_file))
+                jsonobj = read_json(control_file)
+            else:
+                netjson, layout, jsonobj = decompile_scenario(compiled)
+                self.network = Network(netjson,layout)
+
+            # per-component random streams
+            self.set_random_seed(random_seed)
+
+            # read actuators
+            self.actuators = dict()
+            for strid,jsonact in jsonobj['actuators'].items():
+                actid = int(strid)
+                acttype = jsonact['type']
+                if acttype=='signal':
+                    self.actuators[actid] = ActuatorSignal(actid,self,jsonact,self.network.rc2inlgs)
+                else:
+                    raise(Exception("Error: Unknown actuator type {acttype}"))
+
+            # read controllers
+            self.controllers = dict()
+            for strid, jsoncnt in jsonobj['controllers'].items():
+                cntid = int(strid)
+                cnttype = jsoncnt['type']
+                cntacts = {s:self.actuators[s] for s in parse_list(jsoncnt['target_actuators'],int)}
+                if cnttype=='sig_pretimed':
+                    self.controllers[cntid] = ControllerStage(cntid, jsoncnt, cntacts)
+                else:
+                    raise(Exception(f"Error: Unknown controller type {cnttype}"))
 
-        # make road connection to incoming lanegroup map
-        rc2inlgs = dict()
-        for rc in self.network.roadconn.values():
-            in_link = self.network.links[rc.in_link]
-            lanes = rc.in_link_lanes
-            rc2inlgs[rc.id] = [lg for lg in in_link.lgs if
-                             (lg.start_lane >= lanes[0]) and
-                             (lg.start_lane+lg.num_lanes -1 <= lanes[1]) ]
+        if cache_folder is not None and compiled is None:
+            save_compiled(cache_file,compile_scenario(self.network,jsonobj))
 
+        self.demands = dict()
 
-        # populate link.nextlink2mylgs
-        for link in self.network.links.values():
-            if not link.is_sink:
-                exiting_rcs = [rc for rc in self.network.roadconn.values() if rc.in_link==link.id]
-                if len(exiting_rcs)==0:
-                    for nextlink in link.endnode.out_links.values():
-                        link.nextlink2mylgs[nextlink.id] = link.lgs
-                else:
-                    for rc in exiting_rcs:
-                        link.nextlink2mylgs[rc.out_link]  = rc2inlgs[rc.id]
-
-        with open(control_file) as f:
-            jsonobj = json.load(f)
-
-        # read actuators
-        self.actuators = dict()
-        for strid,jsonact in jsonobj['actuators'].items():
-            actid = int(strid)
-            acttype = jsonact['type']
-            if acttype=='signal':
-                self.actuators[actid] = ActuatorSignal(actid,self,jsonact,rc2inlgs)
-            else:
-                raise(Exception("Error: Unknown actuator type {acttype}"))
-
-        # read controllers
-        self.controllers = dict()
-        for strid, jsoncnt in jsonobj['controllers'].items():
-            cntid = int(strid)
-            cnttype = jsoncnt['type']
-            cntacts = {int(s):self.actuators[int(s)] for s in jsoncnt['target_actuators'].split(',')}
-            if cnttype=='sig_pretimed':
-                self.controllers[cntid] = ControllerStage(cntid, jsoncnt, cntacts)
-            else:
-                raise(Exception(f"Error: Unknown controller type {cnttype}"))
+        # engine. 'event' (default) queues individual vehicles, 'fluid' advances the
+        # queues as continuous quantities every fluid_dt seconds (see Fluid.py)
+        self.engine = 'event' if engine is None else engine
+        if self.engine=='event':
+            self.fluid = None
+        elif self.engine=='fluid':
+            self.fluid = FluidModel(self,fluid_dt)
+        else:
+            raise(Exception(f"Error: Unknown engine {engine}"))
 
-        # output requests
+        # output requests. Without an output folder, outputs are kept in memory.
+        self.outputs = list()
+        self.folder_prefix = None
         if output_requests is not None:
-            self.folder_prefix = os.path.join(output_folder,prefix)
-            self.outputs = list()
+            if output_folder is not None:
+                self.folder_prefix = os.path.join(output_folder,prefix)
             for request in output_requests:
                 mytype = request['type']
                 if mytype=='link_flw':
@@ -240,16 +352,30 @@ class Scenario:
                     output = OutputLanegroupVeh(self,request)
                 elif mytype=='ctrl':
                     output = OutputControllerEvents(self,request)
+                elif mytype=='veh':
+                    if self.fluid is not None:
+                        raise(Exception("Error: The fluid engine has no vehicle events"))
+                    output = OutputVehicleEvents(self,request)
                 else:
                     raise(Exception("Unknown output type"))
                 self.outputs.append(output)
 
-        # build and attach dispatcher
-        self.dispatcher = Dispatcher()
+        # hybrid fidelity: lane groups with more than hybrid_threshold waiting vehicles
+        # discharge in aggregate every hybrid_dt seconds (see LaneGroup.start_aggregate).
+        # Not for the lane groups that write vehicle events.
+        if hybrid_threshold is not None:
+            if self.fluid is not None:
+                raise(Exception("Error: The fluid engine has no hybrid mode"))
+            for lg in self.network.lanegroups:
+                if lg.vehicle_writer is None:
+                    lg.aggregate_threshold = hybrid_threshold
+                    lg.aggregate_dt = hybrid_dt
 
-        # open output files
-        for output in self.outputs:
-            output.open_output_file(self.dispatcher, self.folder_prefix)
+        # build and attach dispatcher. scheduler is 'heap' (default) or 'calendar'
+        self.scheduler_name = scheduler
+        self.dispatcher = Dispatcher(get_scheduler(scheduler))
+
+        self.open_outputs()
 
         if check:
             self.check()
@@ -273,23 +399,27 @@ class Scenario:
                 if len(queueid)>3:
                     nextlinkid = queueid[3]
                 elif len(link.endnode.out_links)==1:
-                    nextlinkid = link.endnode.out_links.values()
-                    nextlinkid = nextlinkid[0]
+                    nextlinkid = link.outlink_ids[0]
                 elif link.is_sink:
                     nextlinkid = None
                 else:
                     raise(Exception("n398-5g"))
-                lg.set_vehicles(vehs,queue,nextlinkid,self.dispatcher)
+                next_link = None if nextlinkid is None else self.network.links[nextlinkid].index
+                if self.fluid is not None:
+                    self.fluid.add_vehicles(lg,vehs,queue,next_link)
+                else:
+                    lg.set_vehicles(vehs,queue,next_link,self.dispatcher)
 
-        # demands
+        # demands. The fluid engine reads the profiles directly.
         if demands is not None:
             self.demands = dict()
             for x in demands:
                 demand:Demand = Demand(x,self)
                 linkid = demand.link.id
                 self.demands[linkid] = demand
-                self.dispatcher.register_event(
-                    EventDemandChange(self.dispatcher, now, demand, demand.profile[0]))
+                if self.fluid is None:
+                    self.dispatcher.register_event(
+                        EventDemandChange(self.dispatcher, now, demand, demand.profile[0]))
                 # TODO IS 0 ABOVE CORRECT?
 
         # splits
@@ -297,9 +427,13 @@ class Scenario:
             for x in splits:
                 spm = SplitMatrixProfile(x,self)
                 spm.linkin.split_profile = spm
-                self.dispatcher.register_event(
-                    EventSplitChange(self.dispatcher, now, spm,
-                                     spm.profile.get_value_for_time(now)))
+                if self.fluid is None:
+                    self.dispatcher.register_event(
+                        EventSplitChange(self.dispatcher, now, spm,
+                                         spm.profile.get_value_for_time(now)))
+
+        if self.fluid is not None and (demands is not None or splits is not None):
+            self.fluid.set_inputs(self.demands.values())
 
 
     def check(self) -> bool:
@@ -322,53 +456,149 @@ class Scenario:
         for link in self.network.links.values():
             for lg in link.lgs:
                 lg2nextlinks[lg.get_id()] = set()
-            for linkid, lgs in link.nextlink2mylgs.items():
+            for next_link, lgs in link.nextlink2mylgs.items():
                 for lg in lgs:
-                    lg2nextlinks[lg.get_id()].add(linkid)
+                    lg2nextlinks[lg.get_id()].add(self.network.linklist[next_link].id)
         return lg2nextlinks
 
-    def reset(self) -> None:
-        self.dispatcher = Dispatcher()
+    def set_random_seed(self,random_seed:Optional[int]) -> None:
+        self.random_streams = RandomStreams(random_seed)
+        for link in self.network.links.values():
+            link.rng = self.random_streams.get_stream(STREAM_LINK,link.id)
+            for lg in link.lgs:
+                lg.rng = self.random_streams.get_stream(STREAM_LANEGROUP,link.id,lg.start_lane)
+
+    # Return to the state right after construction, with new random streams. Demands
+    # and splits must be set again. Outputs restart, and vehicle ids start from 1.
+    def reset(self,random_seed:Optional[int]=None) -> None:
+        static.vehicle_id_count = 0
+        self.dispatcher = Dispatcher(get_scheduler(self.scheduler_name))
+        self.set_random_seed(random_seed)
         for link in self.network.links.values():
+            link.split_profile = None
             for lg in link.lgs:
                 lg.clear()
+        self.demands = dict()
         for controller in self.controllers.values():
             controller.reset()
+        if self.fluid is not None:
+            self.fluid.clear()
+            self.fluid.set_inputs(list())
+        self.close_outputs()
+        self.open_outputs()
 
     def set_vehicles(self,queue2vehicles) -> None:
         # state is a 2D numpy array of integers.
         # Each row contains the number of vehicles to assign to a queue in a lanegroup
         # (link_id, start_lane, 0 for transit;1 for waiting, number of vehicles)
+        # Vehicles go to the only next link of the link.
         for i in range(queue2vehicles.shape[0]):
-            link = self.network.links[queue2vehicles[i,0]]
-            lg = link.get_lanegroup_for_startlane(queue2vehicles[i,1])
-            if queue2vehicles[i,2]==0:
-                lg.set_transit_vehicles(queue2vehicles[i,3])
+            link = self.network.links[int(queue2vehicles[i,0])]
+            lg = link.get_lanegroup_for_startlane(int(queue2vehicles[i,1]))
+            queue = 't' if queue2vehicles[i,2]==0 else 'w'
+            if link.is_sink:
+                next_link = None
+            elif len(link.outlink_indices)==1:
+                next_link = link.outlink_indices[0]
+            else:
+                raise(Exception(f"Error: Link {link.id} has several next links"))
+            if self.fluid is not None:
+                self.fluid.add_vehicles(lg,float(queue2vehicles[i,3]),queue,next_link)
             else:
-                lg.set_waiting_vehicles(queue2vehicles[i,3])
+                lg.set_vehicles(int(queue2vehicles[i,3]),queue,next_link,self.dispatcher)
 
+    # Number of vehicles in each queue, in the format of the vehicles argument of
+    # set_state_and_inputs: (link id, start lane, 't' or 'w', next link id or None) -> vehicles
     def get_vehicles(self) -> dict:
-        # TODO Implement this
-        pass
-
-    def set_controller_command(self,command) -> None:
-        # TODO Implement this
-        pass
+        if self.fluid is not None:
+            return self.fluid.get_vehicles()
+        vehicles = dict()
+        linklist = self.network.linklist
+        for lg in self.network.lanegroups:
+            for queuestr, queue in (('t',lg.transit_queue),('w',lg.waiting_queue)):
+                for k, num in queue.counts.items():
+                    nextlinkid = None if k<0 else linklist[k].id
+                    vehicles[(lg.link.id,lg.start_lane,queuestr,nextlinkid)] = num
+        return vehicles
+
+    # Apply commands to actuators, actuator id -> command. The commands hold until the
+    # controller of the actuator updates them.
+    def set_controller_command(self,command:dict[int,'AbstractCommand']) -> None:
+        for actid, c in command.items():
+            act = self.actuators[actid]
+            act.command = c
+            for controller in self.controllers.values():
+                if actid in controller.actuators:
+                    controller.command[actid] = c
+            act.process_command(self.dispatcher.current_time,self.dispatcher)
+
+    # The complete dynamic state of the simulation as a compressed binary blob: pending
+    # events, queue contents, demands, splits, control and random streams
+    def get_checkpoint(self) -> bytes:
+        if self.fluid is not None:
+            raise(Exception("Error: Checkpoints are not supported by the fluid engine"))
+        return to_blob(get_state(self))
+
+    # Return to the state saved by get_checkpoint, in a scenario built from the same
+    # network, control and output requests. Outputs restart.
+    def restore_checkpoint(self,blob:bytes) -> None:
+        set_state(self,from_blob(blob))
 
     def advance(self, duration):
-
-        # initialize the links
-        for link in self.network.links.values():
-            for lg in link.lgs:
-                lg.schedule_service_waiting_queue(self.dispatcher)
-
-        # initialize the controllers
+        self.advance_to(self.dispatcher.current_time + duration)
+
+    def advance_to(self, stop_time:float) -> None:
+
+        # initialize the links. Lane groups that wait for supply downstream stay asleep
+        # until they are woken, so that a run split into several calls equals a single call.
+        if self.fluid is None:
+            lgs = self.network.lanegroups
+            blocked = set()
+            for lg in lgs:
+                blocked.update(lg.blocked_upstream)
+            for lg in lgs:
+                if lg not in blocked:
+                    lg.schedule_service_waiting_queue(self.dispatcher)
+
+        # start the controllers, once. A controller whose timing has changed must be poked
+        # by whoever changed it.
         for cnt in self.controllers.values():
-            cnt.poke(self.dispatcher, self.dispatcher.current_time)
+            if not cnt.is_started(self.dispatcher):
+                cnt.poke(self.dispatcher, self.dispatcher.current_time)
+
+        if self.fluid is not None:
+            self.fluid.start(self.dispatcher)
 
         # dispatch all events
-        self.dispatcher.advance(duration)
+        self.dispatcher.advance_to(stop_time)
+
+    def open_outputs(self) -> None:
+        for output in self.outputs:
+            if isinstance(output,AbstractOutputTimed):
+                output.sink = make_sink(output.sink_type, self.folder_prefix, output.get_name(), output.sink_dtype)
+            output.open_output_file(self.dispatcher, self.folder_prefix)
 
     def close_outputs(self):
         for output in self.outputs:
-            output.close()
\ No newline at end of file
+            output.close()
+
+    # outputs kept in memory: output name -> (column names, data). The data of timed
+    # outputs is a 2D array with the time in the first column; event outputs are lists of rows.
+    def get_output_data(self) -> dict[str,tuple[list[str],Union[np.ndarray,list[list]]]]:
+        data = dict()
+        for output in self.outputs:
+            if isinstance(output,AbstractOutputTimed):
+                sinkdata = output.sink.get_data()
+                if sinkdata is not None:
+                    data[output.get_name()] = sinkdata
+            elif output.rows is not None:
+                data[output.get_name()] = (output.get_columns(),output.rows)
+        return data
+
+    # an output kept in memory as a pandas DataFrame
+    def get_output_dataframe(self, name:str) -> 'pd.DataFrame':
+        data = self.get_output_data()
+        if name not in data:
+            raise(Exception(f"Error: Output {name} is not kept in memory"))
+        columns, rows = data[name]
+        return to_dataframe(columns, rows)
\ No newline at end of file
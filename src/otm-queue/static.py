@@ -1,9 +1,18 @@
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 import numpy as np
 
+if TYPE_CHECKING:
+    from Streams import RandomStream
+
 vehicle_id_count = 0
 
-def get_service_period(rate: float) -> Optional[float]:
+# json lists are strings of separated values, or already parsed (see Compiled.py)
+def parse_list(x, totype, sep:str=',') -> list:
+    if isinstance(x,str):
+        return [totype(s) for s in x.split(sep)]
+    return [totype(s) for s in x]
+
+def get_service_period(rate: float, stream: Optional['RandomStream'] = None) -> Optional[float]:
 
     if rate<=0:
         return None
@@ -12,7 +21,10 @@ def get_service_period(rate: float) -> Optional[float]:
 
     period = 0.0
     if process == 'poisson':
-        period = -np.log(1.0 - np.random.rand()) / rate
+        if stream is None:
+            period = -np.log(1.0 - np.random.rand()) / rate
+        else:
+            period = stream.exponential() / rate
     elif process == 'deterministic':
         period = 1.0 / rate
     else:
@@ -4,6 +4,32 @@ from core import Scenario
 import os
 import pandas as pd
 import json
+import numpy as np
+from Events import Dispatcher, EventTransitToWaiting, EventSeviceLanegroupWaitingQueue
+from Scheduler import get_scheduler
+from Streams import RandomStreams, RandomStream
+from Splits import build_alias_table
+from LaneGroup import VehicleQueue
+from Replication import ReplicationRunner, ReplicationStatistics
+from abstract import EventPoke, EventPeriodicPoke
+from Sinks import read_npz, read_memmap
+from Compiled import load_inputs
+from Branching import branch
+from Incremental import IncrementalRunner
+from Partition import PartitionedRunner, is_boundary_link
+from Batched import BatchedScenario, batch_branch
+from Synthetic import make_grid_scenario
+import tempfile
+
+class Recorder:
+    def __init__(self) -> None:
+        self.times = list()
+
+    def poke(self, dispatcher, timestamp:float) -> None:
+        self.times.append(timestamp)
+
+    def service_waiting_queue(self, dispatcher) -> None:
+        self.times.append(dispatcher.current_time)
 
 class MyTestCase(unittest.TestCase):
 
@@ -17,7 +43,8 @@ class MyTestCase(unittest.TestCase):
                 { 'type':'link_veh', 'dt':'1', 'links':'1,2,3,4,5,6,7,8' },
                 { 'type':'lg_flw', 'dt':'10', 'links':'1,2,3,4,5,6,7,8' },
                 { 'type':'lg_veh', 'dt':'10' },
-                { 'type':'ctrl' }
+                { 'type':'ctrl' },
+                { 'type':'veh', 'links':'2,5,7' }
             ],
             output_folder = '../../output',
             prefix = 'run1',
@@ -59,6 +86,621 @@ class MyTestCase(unittest.TestCase):
         scenario.close_outputs()
 
 
+    def test_counters(self) -> None:
+
+        with open('../../cfg/intersection_input.json') as f:
+            inputs = json.load(f)
+        requests = [ { 'type':'link_veh', 'dt':'100' },
+                     { 'type':'lg_veh', 'dt':'100', 'links':'2,5' },
+                     { 'type':'lg_flw', 'dt':'100', 'links':'2,5' } ]
+        scenario = Scenario('../../cfg/intersection_network.json', '../../cfg/intersection_control.json',
+                            output_requests=requests, random_seed=3)
+        scenario.set_state_and_inputs(demands=inputs['demands'], splits=inputs['splits'])
+        scenario.advance(2000)
+
+        # the incremental counters agree with the queues
+        network = scenario.network
+        for lg in network.lanegroups:
+            self.assertEqual(network.counters.vehicles[lg.index],
+                             lg.transit_queue.size + lg.waiting_queue.size)
+        linkveh, lgveh, lgflw = scenario.outputs
+        self.assertEqual(list(linkveh.get_values()), [link.get_num_vehicles() for link in network.links.values()])
+
+        # lane group outputs only include the requested links
+        lgs = network.links[2].lgs + network.links[5].lgs
+        self.assertEqual(lgveh.get_columns(), ['time'] + [str(lg).replace(',',';') for lg in lgs])
+        self.assertEqual(list(lgveh.get_values()), [lg.get_total_vehicles() for lg in lgs])
+        self.assertEqual(list(lgflw.get_values()), [lg.get_exit_count() for lg in lgs])
+        self.assertEqual(scenario.get_output_data()['lgflw'][1].shape, (21,1+len(lgs)))
+
+    def test_segmented_run(self) -> None:
+
+        # a congested run split into segments equals a single run
+        network, control, inputs = make_grid_scenario(3, 3, demand_vph=3000)
+        def run(num_segments):
+            scenario = Scenario(network, control, output_requests=[{'type':'link_veh','dt':'10'}, {'type':'lg_flw','dt':'10'},
+                                                                   {'type':'ctrl'}],
+                                random_seed=5)
+            scenario.set_state_and_inputs(demands=inputs['demands'], splits=inputs['splits'])
+            for _ in range(num_segments):
+                scenario.advance(2000/num_segments)
+            self.assertTrue(any(len(lg.blocked_upstream)>0 for lg in scenario.network.lanegroups))
+            return scenario.get_output_data()
+        single = run(1)
+        segmented = run(20)
+        for name in ['linkveh', 'lgflw']:
+            np.testing.assert_array_equal(segmented[name][1], single[name][1])
+        self.assertEqual(segmented['ctrl'][1], single['ctrl'][1])
+
+    def test_dense_indexing(self) -> None:
+
+        scenario = Scenario('../../cfg/intersection_network.json', '../../cfg/intersection_control.json')
+        network = scenario.network
+        for index, link in enumerate(network.linklist):
+            self.assertEqual(link.index, index)
+            self.assertIs(network.lgs_by_link[index], link.lgs)
+            self.assertEqual([network.linklist[k].id for k in link.outlink_indices],
+                             list(link.endnode.out_links.keys()))
+        self.assertEqual(network.lanegroups, [lg for link in network.linklist for lg in link.lgs])
+        for index, lg in enumerate(network.lanegroups):
+            self.assertEqual(lg.index, index)
+
+    def test_compiled_scenario(self) -> None:
+
+        network_file = '../../cfg/intersection_network.json'
+        control_file = '../../cfg/intersection_control.json'
+        input_file = '../../cfg/intersection_input.json'
+        requests = [ { 'type':'link_veh', 'dt':'10' }, { 'type':'ctrl' } ]
+
+        # plain, compiling, and loading from the compiled files
+        data = list()
+        with tempfile.TemporaryDirectory() as cache_folder:
+            for cache in [None, cache_folder, cache_folder]:
+                scenario = Scenario(network_file, control_file, output_requests=requests,
+                                    random_seed=7, cache_folder=cache)
+                inputs = json.load(open(input_file)) if cache is None else load_inputs(input_file, cache)
+                scenario.set_state_and_inputs(demands=inputs['demands'], splits=inputs['splits'])
+                scenario.advance(1000)
+                data.append(scenario.get_output_data())
+                self.assertEqual([lg.get_id() for lg in scenario.network.lanegroups],
+                                 scenario.get_lanegroup_ids())
+            self.assertEqual(len(os.listdir(cache_folder)), 2)
+
+        for d in data[1:]:
+            self.assertEqual(d['ctrl'], data[0]['ctrl'])
+            np.testing.assert_array_equal(d['linkveh'][1], data[0]['linkveh'][1])
+
+    def test_checkpoint(self) -> None:
+
+        with open('../../cfg/intersection_input.json') as f:
+            inputs = json.load(f)
+        requests = [ { 'type':'link_veh', 'dt':'10' }, { 'type':'lg_flw', 'dt':'10' },
+                     { 'type':'ctrl' }, { 'type':'veh', 'links':'2,5' } ]
+        def make_scenario():
+            return Scenario('../../cfg/intersection_network.json', '../../cfg/intersection_control.json',
+                            output_requests=requests, random_seed=11)
+
+        # warm up, save, and continue
+        scenario = make_scenario()
+        scenario.set_state_and_inputs(demands=inputs['demands'], splits=inputs['splits'])
+        scenario.advance(1000)
+        blob = scenario.get_checkpoint()
+        sizes = {name:len(x) for name, (columns, x) in scenario.get_output_data().items()}
+        vehicles = scenario.get_vehicles()
+        scenario.advance(1500)
+        data = scenario.get_output_data()
+
+        # continuing from the checkpoint gives the same outputs
+        restored = make_scenario()
+        restored.restore_checkpoint(blob)
+        self.assertEqual(restored.get_vehicles(), vehicles)
+        restored.advance(1500)
+        for name, (columns, x) in restored.get_output_data().items():
+            if isinstance(x,np.ndarray):
+                np.testing.assert_array_equal(x, data[name][1][sizes[name]:])
+            else:
+                self.assertEqual(x, data[name][1][sizes[name]:])
+        np.testing.assert_array_equal(restored.network.counters.exits, scenario.network.counters.exits)
+
+    def test_demand_arrivals(self) -> None:
+
+        with open('../../cfg/intersection_input.json') as f:
+            splits = json.load(f)['splits']
+        demands = [{'link':'2', 'dt':'200', 'value':'1000,500,100,0'}]
+        requests = [{'type':'link_veh', 'dt':'200', 'links':'2'}, {'type':'link_flw', 'dt':'200', 'links':'2'}]
+        def make_scenario(seed):
+            scenario = Scenario('../../cfg/intersection_network.json', '../../cfg/intersection_control.json',
+                                output_requests=requests, random_seed=seed)
+            scenario.set_state_and_inputs(demands=demands, splits=splits)
+            return scenario
+
+        # arrivals to link 2 in each interval of the profile, over several seeds, are those
+        # of a Poisson process at the rate of the interval
+        arrivals = np.zeros(4)
+        num_seeds = 10
+        for seed in range(num_seeds):
+            scenario = make_scenario(seed)
+            scenario.advance(800)
+            data = scenario.get_output_data()
+            entered = data['linkveh'][1][:,1] + data['linkflw'][1][:,1]
+            arrivals += np.diff(entered)
+        expected = num_seeds * np.array([1000,500,100,0]) * 200 / 3600
+        self.assertTrue(np.all(np.abs(arrivals - expected) <= 4*np.sqrt(expected)))
+        self.assertEqual(arrivals[3], 0)
+
+        # a checkpoint within a batch restores the remaining arrivals and the stream state
+        # they were drawn from
+        scenario = make_scenario(1)
+        scenario.advance(300)
+        demand = scenario.demands[2]
+        self.assertLess(demand.arrival_index, len(demand.arrival_times))
+        restored = make_scenario(1)
+        restored.restore_checkpoint(scenario.get_checkpoint())
+        other = restored.demands[2]
+        self.assertEqual(other.arrival_times[other.arrival_index:], demand.arrival_times[demand.arrival_index:])
+        self.assertEqual(other.batch_rng_state, demand.batch_rng_state)
+        self.assertEqual(other.rng.get_state(), demand.rng.get_state())
+
+    def test_incremental(self) -> None:
+
+        # a congested grid, whose first demand changes at 1500
+        network, control, inputs = make_grid_scenario(3, 3, demand_vph=3000)
+        requests = [ { 'type':'link_veh', 'dt':'10' }, { 'type':'ctrl' } ]
+        inputs['demands'][0] = {'link':inputs['demands'][0]['link'], 'dt':'500', 'value':'3000,3000,1500,3000'}
+        changed = json.loads(json.dumps(inputs))
+        changed['demands'][0]['value'] = '3000,3000,1500,500'
+        timings = [ {'time':1250, 'controller':0, 'offset':10} ]
+
+        def run_plain(x):
+            scenario = Scenario(network, control, output_requests=requests, random_seed=5)
+            scenario.set_state_and_inputs(demands=x['demands'], splits=x['splits'])
+            scenario.advance(2000)
+            return scenario.get_output_data()
+
+        with tempfile.TemporaryDirectory() as cache_folder, tempfile.TemporaryDirectory() as other_folder:
+            runner = IncrementalRunner(network, control, requests, cache_folder, random_seed=5, checkpoint_dt=100)
+            data = [runner.run(inputs, 2000)]
+            self.assertEqual(runner.restart_time, 0)
+            data.append(runner.run(changed, 2000))
+            self.assertEqual(runner.restart_time, 1400)
+            timed_data = runner.run(changed, 2000, timings)
+            self.assertEqual(runner.restart_time, 1200)
+
+            # same results as a single call to Scenario.advance
+            for x, y in zip(data, [run_plain(inputs), run_plain(changed)]):
+                np.testing.assert_array_equal(x['linkveh'][1], y['linkveh'][1])
+                self.assertEqual(x['ctrl'][1], y['ctrl'][1])
+
+            # and, with timing changes, as a run from zero
+            runner = IncrementalRunner(network, control, requests, other_folder, random_seed=5, checkpoint_dt=100)
+            y = runner.run(changed, 2000, timings)
+            self.assertEqual(runner.restart_time, 0)
+            np.testing.assert_array_equal(timed_data['linkveh'][1], y['linkveh'][1])
+            self.assertEqual(timed_data['ctrl'][1], y['ctrl'][1])
+
+    def test_partitioned(self) -> None:
+
+        # without congestion at the region boundaries, the result is that of a sequential run
+        network, control, inputs = make_grid_scenario(2,3)
+        requests = [ { 'type':'link_veh', 'dt':'60' }, { 'type':'lg_flw', 'dt':'60' }, { 'type':'ctrl' } ]
+        scenario = Scenario(network, control, output_requests=requests, random_seed=4)
+        scenario.set_state_and_inputs(demands=inputs['demands'], splits=inputs.get('splits'))
+        scenario.advance(1200)
+        expected = scenario.get_output_data()
+
+        runner = PartitionedRunner(network, control, inputs, requests, num_regions=3, random_seed=4)
+        self.assertEqual(runner.num_regions, 3)
+        data = runner.run(1200)
+        for name in ['linkveh','lgflw']:
+            np.testing.assert_array_equal(expected[name][1], data[name][1])
+        self.assertEqual(expected['ctrl'][1], data['ctrl'][1])
+
+    def test_partitioned_congested(self) -> None:
+
+        # with congestion at the region boundaries, vehicles are neither lost nor duplicated
+        # between regions: those that entered have exited or are in the network
+        network, control, inputs = make_grid_scenario(3,3,demand_vph=3000)
+        requests = [ { 'type':'link_veh', 'dt':'10' }, { 'type':'link_flw', 'dt':'10' } ]
+        runner = PartitionedRunner(network, control, inputs, requests, num_regions=3, random_seed=5)
+        data = runner.run(2000)
+        links = [runner.scenario.network.links[int(linkid)] for linkid in data['linkveh'][0][1:]]
+        self.assertEqual(data['linkflw'][0], data['linkveh'][0])
+        veh = data['linkveh'][1][:,1:]
+        flw = data['linkflw'][1][:,1:]
+
+        boundary = np.array([is_boundary_link(runner.node2region,link) for link in links])
+        max_vehicles = np.array([sum(lg.max_vehicles for lg in link.lgs) for link in links])
+        self.assertTrue((veh[:,boundary]>=max_vehicles[boundary]).any())
+
+        source = np.array([link.is_source for link in links])
+        sink = np.array([link.is_sink for link in links])
+        entered = veh[:,source].sum(axis=1) + flw[:,source].sum(axis=1)
+        exited = flw[:,sink].sum(axis=1)
+        self.assertGreater(exited[-1], 0)
+        np.testing.assert_array_equal(entered, exited + veh.sum(axis=1))
+
+    def test_branching(self) -> None:
+
+        with open('../../cfg/intersection_input.json') as f:
+            inputs = json.load(f)
+        scenario = Scenario('../../cfg/intersection_network.json', '../../cfg/intersection_control.json',
+                            output_requests=[ { 'type':'link_veh', 'dt':'10' } ], random_seed=3)
+        scenario.set_state_and_inputs(demands=inputs['demands'], splits=inputs['splits'])
+        scenario.advance(1000)
+        now = scenario.dispatcher.current_time
+        candidates = [ {}, {0:{'cycle':30, 'durations':[10,10,10]}}, {0:{'offset':20}} ]
+
+        # forked and restored branches agree, and leave the scenario as it was
+        forked = branch(scenario, candidates, 900, use_fork=True)
+        pooled = branch(scenario, candidates, 900, use_fork=False, max_workers=2)
+        self.assertEqual(forked, pooled)
+        self.assertEqual(scenario.dispatcher.current_time, now)
+
+        # the branch without changes continues as the scenario does
+        sinks = [lg.index for lg in scenario.network.lanegroups if lg.link.is_sink]
+        exits = scenario.network.counters.exits[sinks].sum()
+        scenario.advance(900)
+        self.assertEqual(forked[0]['exits'], scenario.network.counters.exits[sinks].sum() - exits)
+
+        # branches rebuilt in a process pool keep their outputs in memory, whatever the sinks
+        with tempfile.TemporaryDirectory() as folder:
+            scenario = Scenario('../../cfg/intersection_network.json', '../../cfg/intersection_control.json',
+                                output_requests=[ { 'type':'link_veh', 'dt':'10', 'sink':'npz' },
+                                                  { 'type':'lg_veh', 'dt':'10', 'sink':'mmap', 'dtype':'int32' } ],
+                                output_folder=folder, prefix='branch', random_seed=3)
+            scenario.set_state_and_inputs(demands=inputs['demands'], splits=inputs['splits'])
+            scenario.advance(1000)
+            pooled = branch(scenario, candidates, 900, use_fork=False, max_workers=2)
+            self.assertEqual(branch(scenario, candidates, 900, use_fork=True), pooled)
+            scenario.close_outputs()
+
+    def test_batched(self) -> None:
+
+        with open('../../cfg/intersection_input.json') as f:
+            inputs = json.load(f)
+        def make_scenario():
+            scenario = Scenario('../../cfg/intersection_network.json', '../../cfg/intersection_control.json', random_seed=3)
+            scenario.set_state_and_inputs(demands=inputs['demands'], splits=inputs['splits'])
+            return scenario
+        scenario = make_scenario()
+        scenario.advance(600)
+        candidates = [ {}, {0:{'cycle':30, 'durations':[10,10,10]}}, {0:{'offset':20}} ]
+        batch = BatchedScenario(scenario, candidates, dt=1.0, random_seed=1)
+
+        # starts from the queues of the scenario
+        for b in range(len(candidates)):
+            self.assertEqual(list(batch.vehicles[:,b]), list(scenario.network.counters.vehicles))
+
+        # stages are those of the controllers with the timing of each candidate
+        for b, candidate in enumerate(candidates):
+            controller = make_scenario().controllers[0]
+            if 0 in candidate:
+                controller.set_timing(**candidate[0])
+            for t in np.arange(600,700,3.7):
+                self.assertEqual(batch.get_stages(t)[0,b], controller.get_stage_for_time(t).index)
+
+        # no vehicle is lost or overfills a lane group
+        batch.advance(600)
+        R = batch.transit.shape[0] // batch.vehicles.shape[0]
+        in_queues = batch.waiting.sum(axis=1) + batch.transit.sum(axis=1).reshape(R,*batch.vehicles.shape).sum(axis=0)
+        np.testing.assert_array_equal(batch.vehicles, in_queues)
+        finite = np.isfinite([lg.max_vehicles for lg in scenario.network.lanegroups])
+        self.assertTrue(np.all(batch.vehicles[finite] <= batch.topology.max_vehicles[finite,None]))
+        self.assertEqual(len(batch_branch(scenario, candidates, 60)), len(candidates))
+
+    def test_fluid(self) -> None:
+
+        with open('../../cfg/intersection_input.json') as f:
+            inputs = json.load(f)
+        def run(engine, seed):
+            scenario = Scenario('../../cfg/intersection_network.json', '../../cfg/intersection_control.json',
+                                output_requests=[{'type':'link_flw','dt':'10'}, {'type':'link_veh','dt':'10'}, {'type':'ctrl'}],
+                                random_seed=seed, engine=engine)
+            scenario.set_state_and_inputs(demands=inputs['demands'], splits=inputs['splits'])
+            scenario.advance(2000)
+            return scenario
+        fluid = run('fluid', None)
+        events = [run(None, seed).get_output_data() for seed in range(4)]
+
+        # same outputs, and the fluid quantities agree with the mean of the event engine
+        data = fluid.get_output_data()
+        self.assertEqual(data['ctrl'][1], events[0]['ctrl'][1])
+        for name in ['linkflw', 'linkveh']:
+            self.assertEqual(data[name][1].shape, events[0][name][1].shape)
+        flows = np.mean([d['linkflw'][1][-1,1:] for d in events], axis=0)
+        np.testing.assert_allclose(data['linkflw'][1][-1,1:], flows, rtol=0.1, atol=5)
+        self.assertAlmostEqual(data['linkveh'][1][:,6].mean(), np.mean([d['linkveh'][1][:,6].mean() for d in events]), delta=15)
+
+        # vehicles are conserved
+        model = fluid.fluid
+        N = model.waiting.shape[0]
+        in_queues = model.waiting.sum(axis=1) + model.transit.sum(axis=1).reshape(-1,N).sum(axis=0)
+        np.testing.assert_allclose(fluid.network.counters.vehicles, in_queues, atol=1e-6)
+        with self.assertRaises(Exception):
+            Scenario('../../cfg/intersection_network.json', '../../cfg/intersection_control.json',
+                     output_requests=[{'type':'veh'}], engine='fluid')
+
+    def test_hybrid(self) -> None:
+
+        with open('../../cfg/intersection_input.json') as f:
+            inputs = json.load(f)
+        def run(seed, hybrid_threshold):
+            scenario = Scenario('../../cfg/intersection_network.json', '../../cfg/intersection_control.json',
+                                output_requests=[{'type':'link_veh','dt':'10'}],
+                                random_seed=seed, hybrid_threshold=hybrid_threshold, hybrid_dt=2.0)
+            scenario.set_state_and_inputs(demands=inputs['demands'], splits=inputs['splits'])
+            scenario.advance(2000)
+            return scenario
+
+        # the saturated left turn of link 6 stays aggregate, and the approaches whose demand
+        # has ended are back to an event per vehicle
+        scenario = run(0, 3)
+        self.assertIsNotNone(scenario.network.links[6].get_lanegroup_for_startlane(1).poke_event)
+        for linkid in [2, 4]:
+            for lg in scenario.network.links[linkid].lgs:
+                self.assertIsNone(lg.poke_event)
+
+        # vehicles are conserved: those that left the sources are in the sinks or have exited
+        counters = scenario.network.counters
+        for lg in scenario.network.lanegroups:
+            self.assertEqual(counters.vehicles[lg.index], lg.transit_queue.size + lg.waiting_queue.size)
+        links = scenario.network.linklist
+        sources = [lg.index for link in links if link.is_source for lg in link.lgs]
+        sinks = [lg.index for link in links if link.is_sink for lg in link.lgs]
+        self.assertEqual(counters.exits[sources].sum(), counters.vehicles[sinks].sum() + counters.exits[sinks].sum())
+
+        # branches rebuilt in a process pool continue in aggregate mode, as forked ones do
+        candidates = [ {}, {0:{'offset':20}} ]
+        forked = branch(scenario, candidates, 600, use_fork=True)
+        pooled = branch(scenario, candidates, 600, use_fork=False, max_workers=2)
+        self.assertEqual(forked, pooled)
+
+        # the aggregate mode settings are part of the checkpoint
+        restored = Scenario('../../cfg/intersection_network.json', '../../cfg/intersection_control.json',
+                            output_requests=[{'type':'link_veh','dt':'10'}])
+        restored.restore_checkpoint(scenario.get_checkpoint())
+        for lg in restored.network.lanegroups:
+            self.assertEqual((lg.aggregate_threshold, lg.aggregate_dt), (3, 2.0))
+        self.assertIsNotNone(restored.network.links[6].get_lanegroup_for_startlane(1).poke_event)
+
+        # same queues as the event engine, on average
+        def mean_queue(hybrid_threshold):
+            return np.mean([run(seed, hybrid_threshold).get_output_data()['linkveh'][1][:,6].mean() for seed in range(4)])
+        self.assertAlmostEqual(mean_queue(20), mean_queue(None), delta=10)
+
+    def test_cancel_event(self) -> None:
+
+        dispatcher = Dispatcher()
+        recorder = Recorder()
+        events = [dispatcher.register_event(EventPoke(dispatcher,0,float(t),recorder)) for t in range(200)]
+
+        # cancel the odd events, enough to trigger a compaction
+        for event in events[1::2]:
+            dispatcher.cancel_event(event)
+        self.assertEqual(dispatcher.get_num_pending_events(),100)
+
+        dispatcher.advance(1000)
+        self.assertEqual(recorder.times,[float(t) for t in range(0,200,2)])
+
+    def test_event_pool(self) -> None:
+
+        dispatcher = Dispatcher()
+        recorder = Recorder()
+        clazz = EventSeviceLanegroupWaitingQueue
+
+        # a pooled event is not reused while it is in the scheduler, even if cancelled
+        first = dispatcher.register_event(dispatcher.acquire_event(clazz,1.0,recorder))
+        dispatcher.cancel_event(first)
+        second = dispatcher.register_event(dispatcher.acquire_event(clazz,2.0,recorder))
+        self.assertIsNot(second,first)
+        dispatcher.advance_to(1.0)
+        third = dispatcher.register_event(dispatcher.acquire_event(clazz,3.0,recorder))
+        self.assertIs(third,first)
+        self.assertIsNot(dispatcher.acquire_event(clazz,4.0,recorder),second)
+        dispatcher.advance_to(10.0)
+        self.assertEqual(recorder.times,[2.0,3.0])
+
+        # a periodic poke stays a single entry in the scheduler
+        recorder = Recorder()
+        poke = dispatcher.register_event(EventPeriodicPoke(dispatcher,20,10.0,recorder,5.0))
+        for t in [10.0, 12.0, 15.0, 30.0]:
+            dispatcher.advance_to(t)
+            self.assertEqual([e[3] for e in dispatcher.scheduler], [poke])
+        self.assertEqual(recorder.times,[10.0,15.0,20.0,25.0,30.0])
+        self.assertRaises(Exception, dispatcher.reschedule_event, poke, 50.0)
+        self.assertEqual(dispatcher.get_num_pending_events(),1)
+
+    def test_calendar_scheduler(self) -> None:
+
+        # the calendar queue must dispatch in exactly the same order as the heap
+        times = dict()
+        for name in ['heap','calendar']:
+            dispatcher = Dispatcher(get_scheduler(name))
+            recorder = Recorder()
+            rng = np.random.default_rng(0)
+            for t in np.round(rng.exponential(100.0,5000)):
+                dispatcher.register_event(EventPoke(dispatcher,int(rng.integers(3)),float(t),recorder))
+            dispatcher.advance(1e6)
+            times[name] = recorder.times
+        self.assertEqual(len(times['calendar']),5000)
+        self.assertEqual(times['heap'],times['calendar'])
+
+    def test_random_stream_chunking(self) -> None:
+
+        # the sequence of a stream depends on the seed and key, not on the buffer size
+        streams = RandomStreams(24724)
+        a = streams.get_stream(1,2,3)
+        b = RandomStream(a.entropy,a.key,buffer_size=7)
+        self.assertEqual([a.exponential() for _ in range(100)],[b.exponential() for _ in range(100)])
+        self.assertEqual([a.uniform() for _ in range(100)],[b.uniform() for _ in range(100)])
+
+        c = RandomStreams(24724).get_stream(1,2,4)
+        self.assertNotEqual(RandomStreams(24724).get_stream(1,2,3).uniform(),c.uniform())
+
+    def test_alias_table(self) -> None:
+
+        # the alias table must reproduce the split ratios exactly
+        for p in [[0.3,0.4,0.3], [0.0,1.0], [0.8,0.2], [0.1,0.2,0.3,0.4]]:
+            prob, alias = build_alias_table(np.array(p))
+            n = len(p)
+            effective = np.zeros(n)
+            for i in range(n):
+                effective[i] += prob[i]/n
+                effective[alias[i]] += (1-prob[i])/n
+            np.testing.assert_allclose(effective,p)
+
+    def test_vehicle_queue(self) -> None:
+
+        # interleave additions and removals so that the ring wraps around and grows
+        queue = VehicleQueue('transit')
+        expected = list()
+        for k in range(100):
+            queue.add_vehicle(float(k),k%3 if k%4 else None)
+            expected.append((float(k),k%3 if k%4 else None,None))
+            if k%3==0:
+                self.assertEqual(queue.remove_lead_vehicle(),expected.pop(0))
+        self.assertEqual(queue.get_total_vehicles(),len(expected))
+        self.assertEqual(sum(queue.counts.values()),len(expected))
+        self.assertEqual(queue.counts[-1],sum(1 for e in expected if e[1] is None))
+        while len(expected)>0:
+            self.assertEqual(queue.remove_lead_vehicle(),expected.pop(0))
+
+    def test_transit_release(self) -> None:
+
+        scenario = Scenario('../../cfg/intersection_network.json', '../../cfg/intersection_control.json')
+        dispatcher = scenario.dispatcher
+        link = scenario.network.links[4]
+        lg = link.lgs[0]
+        lg.saturation_flow_rate_vps = 0.0     # vehicles stay in the waiting queue
+        def pending_transit_events():
+            return [e[3] for e in dispatcher.scheduler
+                    if isinstance(e[3],EventTransitToWaiting) and e[3].recipient is lg and not e[3].cancelled]
+
+        # vehicles enter at different times, with different next links
+        entries = [(0.0,0), (1.5,1), (1.5,2), (4.0,0)]
+        for t, k in entries:
+            dispatcher.advance_to(t)
+            lg.add_vehicle_to_queue(None, link.outlink_indices[k], 't', dispatcher)
+            self.assertEqual(len(pending_transit_events()), 1)
+
+        # each reaches the waiting queue at its entry time plus the transit time, in FIFO order
+        arrivals = [t + lg.transit_time_sec for t, k in entries]
+        for arrival in sorted(set(arrivals)):
+            dispatcher.advance_to(np.nextafter(arrival,0))
+            self.assertEqual(lg.waiting_queue.size, sum(a<arrival for a in arrivals))
+            dispatcher.advance_to(arrival)
+            self.assertEqual(lg.waiting_queue.size, sum(a<=arrival for a in arrivals))
+            self.assertEqual([e.timestamp for e in pending_transit_events()], [a for a in arrivals if a>arrival][:1])
+        times, next_links = lg.waiting_queue.get_contents()
+        np.testing.assert_array_equal(times, arrivals)
+        self.assertEqual(next_links.tolist(), [link.outlink_indices[k] for t, k in entries])
+        self.assertEqual(len(pending_transit_events()), 0)
+        self.assertIsNone(lg.transit_event)
+
+    def test_replications(self) -> None:
+
+        network_file = '../../cfg/intersection_network.json'
+        control_file = '../../cfg/intersection_control.json'
+        input_file = '../../cfg/intersection_input.json'
+        output_requests = [ { 'type':'link_veh', 'dt':'10' }, { 'type':'ctrl' } ]
+
+        # a single worker reuses its scenario, so this also checks Scenario.reset
+        runner = ReplicationRunner(network_file, control_file, input_file, output_requests, max_workers=1)
+        results = runner.run(seeds=[1,2,3], duration=600)
+
+        with open(input_file) as f:
+            inputs = json.load(f)
+        for seed in [1,3]:
+            scenario = Scenario(network_file, control_file, output_requests=output_requests, random_seed=seed)
+            scenario.set_state_and_inputs(demands=inputs['demands'], splits=inputs['splits'])
+            scenario.advance(600)
+            data = scenario.get_output_data()
+            self.assertEqual(results[seed]['ctrl'], data['ctrl'])
+            self.assertEqual(results[seed]['linkveh'][0], data['linkveh'][0])
+            np.testing.assert_array_equal(results[seed]['linkveh'][1], data['linkveh'][1])
+        self.assertFalse(np.array_equal(results[1]['linkveh'][1], results[2]['linkveh'][1]))
+
+    def test_columnar_output(self) -> None:
+
+        network_file = '../../cfg/intersection_network.json'
+        control_file = '../../cfg/intersection_control.json'
+        with open('../../cfg/intersection_input.json') as f:
+            inputs = json.load(f)
+
+        # the same run written to csv, kept in memory, and saved to npz
+        data = dict()
+        for sink in ['csv','memory','npz']:
+            requests = [ { 'type':'link_veh', 'dt':'10', 'sink':sink } ]
+            scenario = Scenario(network_file, control_file, output_requests=requests,
+                                output_folder='../../output', prefix='columnar', random_seed=5)
+            scenario.set_state_and_inputs(demands=inputs['demands'], splits=inputs['splits'])
+            scenario.advance(1000)
+            if sink=='memory':
+                df = scenario.get_output_dataframe('linkveh')
+            scenario.close_outputs()
+            data[sink] = scenario.get_output_data().get('linkveh')
+
+        self.assertIsNone(data['csv'])
+        columns, x = data['memory']
+        self.assertEqual(x.shape, (101,9))
+        csv = pd.read_csv('../../output/columnar_linkveh.csv')
+        self.assertEqual(list(csv.columns), columns)
+        np.testing.assert_array_equal(csv.values, x)
+        np.testing.assert_array_equal(df.values, x)
+        npz_columns, npz_x = read_npz('../../output/columnar_linkveh.npz')
+        self.assertEqual(npz_columns, columns)
+        np.testing.assert_array_equal(npz_x, x)
+
+    def test_memmap_output(self) -> None:
+
+        with open('../../cfg/intersection_input.json') as f:
+            inputs = json.load(f)
+        data = dict()
+        for sink in ['memory','mmap']:
+            requests = [ { 'type':'link_veh', 'dt':'1', 'sink':sink, 'dtype':'int32' } ]
+            scenario = Scenario('../../cfg/intersection_network.json', '../../cfg/intersection_control.json',
+                                output_requests=requests, output_folder='../../output', prefix='memmap', random_seed=5)
+            scenario.set_state_and_inputs(demands=inputs['demands'], splits=inputs['splits'])
+            if sink=='mmap':
+                # read while the simulation is running; later records do not change earlier ones
+                scenario.advance(3000)
+                columns, partial = read_memmap('../../output/memmap_linkveh.bin')
+                self.assertGreaterEqual(partial['time'][-1], 3000)
+                partial = np.array(partial)
+            scenario.advance(6000-scenario.dispatcher.current_time)
+            scenario.close_outputs()
+            data[sink] = scenario.get_output_data().get('linkveh')
+
+        self.assertIsNone(data['mmap'])
+        columns, x = data['memory']
+        mm_columns, records = read_memmap('../../output/memmap_linkveh.bin')
+        self.assertEqual(mm_columns, columns)
+        self.assertEqual(records['values'].dtype, np.int32)
+        np.testing.assert_array_equal(records['time'], x[:,0])
+        np.testing.assert_array_equal(records['values'], x[:,1:])
+        np.testing.assert_array_equal(partial, records[:len(partial)])
+
+    def test_replication_statistics(self) -> None:
+
+        rng = np.random.default_rng(0)
+        x = rng.normal(5.0,2.0,(20,6,3))
+        stats = ReplicationStatistics(['linkveh'])
+        for k in range(x.shape[0]):
+            rows = [[float(t)]+list(x[k,t,:]) for t in range(x.shape[1])]
+            stats.add({'linkveh':(['time','1','2','3'],rows)})
+        np.testing.assert_allclose(stats.mean['linkveh'],x.mean(axis=0))
+        np.testing.assert_allclose(stats.get_variance('linkveh'),x.var(axis=0,ddof=1))
+
+        # early stopping with a loose target stops at the minimum number of replications
+        runner = ReplicationRunner('../../cfg/intersection_network.json',
+                                   '../../cfg/intersection_control.json',
+                                   '../../cfg/intersection_input.json',
+                                   [ { 'type':'link_veh', 'dt':'60' } ],
+                                   max_workers=1)
+        stats = runner.run_until({'linkveh':1000.0}, duration=300, min_replications=3, max_replications=20)
+        self.assertEqual(stats.count,3)
+        self.assertEqual(stats.columns['linkveh'],['1','2','3','4','5','6','7','8'])
+
     def test_plot(self) -> None:
 
         output_folder = '../../output'